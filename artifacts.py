@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# Persistent cache of the preprocessing artifacts (the resampled images and
+# filters, the registered images and transforms, the fused image), kept
+# outside the working and output folders. An entry is a folder named after
+# a content hash of everything its files depend on, see artifact_key; the
+# entries are evicted in least recently used order once the cache exceeds
+# its size. The cache is opt-in: nothing is written unless a folder is
+# given, as the home folder may be ephemeral or limited, e.g., in a
+# container.
+
+def file_digest(fn, chunk_size=2**22):
+	# SHA-256 of the content of a file
+	h = hashlib.sha256()
+	with open(fn, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+def artifact_key(*parts):
+	# hash of the digests and parameters an artifact depends on
+	s = json.dumps(parts, sort_keys=True, default=str)
+	return hashlib.sha256(s.encode()).hexdigest()
+
+class ArtifactCache:
+	def __init__(self, path, max_size=None):
+		# path: folder of the cache
+		# max_size: bytes, no eviction if None
+		self.path = path
+		self.max_size = max_size
+		os.makedirs(path, exist_ok=True)
+
+	def entry_path(self, key):
+		return os.path.join(self.path, key)
+
+	def restore(self, key, files):
+		# copy the files {name: destination} of an entry; returns False if
+		# the entry is missing or incomplete
+		entry = self.entry_path(key)
+		if not os.path.isdir(entry):
+			return False
+		try:
+			for name, dst in files.items():
+				shutil.copyfile(os.path.join(entry, name), dst)
+			# the modification time of the entry orders the eviction
+			os.utime(entry)
+		except OSError:
+			return False
+		return True
+
+	def save(self, key, files):
+		# store the files {name: source} as an entry; written aside and
+		# renamed, as several processes may share the cache
+		entry = self.entry_path(key)
+		tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.path)
+		try:
+			for name, src in files.items():
+				shutil.copyfile(src, os.path.join(tmp, name))
+			with open(os.path.join(tmp, 'entry.json'), 'w') as f:
+				json.dump({'files': sorted(files), 'created': time.time()}, f)
+			os.rename(tmp, entry)
+		except OSError:
+			# stored meanwhile by another process
+			shutil.rmtree(tmp, ignore_errors=True)
+		self.evict()
+
+	def entries(self):
+		# (last use, size, path) of the entries, least recently used first
+		entries = []
+		for name in os.listdir(self.path):
+			entry = os.path.join(self.path, name)
+			if name.startswith('.') or not os.path.isdir(entry):
+				continue
+			try:
+				size = sum(e.stat().st_size for e in os.scandir(entry))
+				entries.append((os.stat(entry).st_mtime, size, entry))
+			except OSError:
+				continue
+		return sorted(entries)
+
+	def size(self):
+		return sum(size for _, size, _ in self.entries())
+
+	def evict(self):
+		# remove the least recently used entries until the cache fits in
+		# max_size
+		if self.max_size == None:
+			return
+		entries = self.entries()
+		total = sum(size for _, size, _ in entries)
+		for _, size, entry in entries:
+			if total <= self.max_size:
+				break
+			shutil.rmtree(entry, ignore_errors=True)
+			total -= size
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import warnings
+warnings.filterwarnings("ignore")
+
+from utils import *
+from pipeline import *
+
+from rich.console import Console
+from rich import box
+from rich.table import Table
+from rich.progress import Progress, TextColumn, \
+		BarColumn, TimeElapsedColumn
+
+# Cohort mode: preprocess and reconstruct many cases listed in a JSON
+# manifest, e.g.,
+#
+#   {"subjects": [
+#     {"name": "subj01", "stacks": ["subj01/ax.nii.gz", "subj01/cor.nii.gz"]},
+#     {"name": "subj02", "stacks": ["subj02/ax.nii.gz", "subj02/sag.nii.gz"],
+#      "size": [312, 384, 330]}
+#   ]}
+#
+# Relative paths are relative to the folder of the manifest, and the
+# results of each case are written to OUT_PATH/<name>/. The cases run on
+# a pool of processes, and a case is only started if its estimated peak
+# memory fits in what the running cases leave of --memory-limit.
+
+def physical_memory():
+	return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def init_worker(fft_backend, fft_workers, precision, cache_size,
+		n_operators):
+	set_fft_backend(fft_backend, fft_workers)
+	set_precision(precision)
+	set_operator_disk_cache_size(cache_size)
+	set_operator_cache_size(n_operators)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-V', '--version', action='version',
+			version='%s version : v %s %s' % (app_name, version, release_date),
+			help='show version')
+	parser.add_argument('-m', '--manifest', required=True,
+			help='JSON file listing the cases and their low-res images')
+	parser.add_argument('-o', '--out_path', default='./recons/')
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument('--ggr', action='store_true',
+			help='use GGR regularization, default')
+	group.add_argument('--tik', action='store_true',
+			help='use Tikhonov regularization')
+	parser.add_argument('-w', '--reg-weight', nargs='+', type=float,
+			help='weight(s) of the regularization, by default is 0.1',
+			default=[0.1])
+	parser.add_argument('--select-weight', choices=['lcurve', 'gcv'],
+			help='select one of the weights automatically, see recon.py')
+	parser.add_argument('--edge-enhance', nargs='?', type=float, const=0.8,
+			metavar='TAU',
+			help='edge-enhanced GGR with the TAU quantile as threshold, \
+					see recon.py')
+	parser.add_argument('--quantile-method', choices=['histogram', 'select'],
+			help='computation of the quantile of --edge-enhance, \
+					by default is histogram', default='histogram')
+	parser.add_argument('--keep-negative-values', action='store_true',
+			help='keep negative voxel values in the reconstructed images',
+			default=False)
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+			help='maximum number of cases processed concurrently, \
+					by default is the number of CPUs')
+	parser.add_argument('--memory-limit', type=float,
+			help='memory (GB) shared by the concurrent cases, \
+					by default is 80%% of the physical memory')
+	parser.add_argument('--threads', type=int, default=1,
+			help='threads of the preprocessing of each case, by default is 1')
+	parser.add_argument('--registration', choices=['crl', 'sitk'],
+			default='crl', help='registration engine: crlRigidRegistration, \
+					or SimpleITK in process; by default is crl')
+	parser.add_argument('--registration-timeout', type=float,
+			help='time limit of each registration in seconds')
+	parser.add_argument('--fft-backend', choices=['numpy', 'scipy', 'pyfftw'],
+			help='FFT library, by default is scipy', default='scipy')
+	parser.add_argument('--fft-workers', type=int,
+			help='threads of the FFTs of each case, \
+					by default the CPUs are shared by the jobs')
+	parser.add_argument('--precision', choices=['single', 'double'],
+			default='single',
+			help='floating-point precision of the deconvolution, \
+					by default is single')
+	parser.add_argument('--fast-padding', action='store_true', default=False,
+			help='zero-pad the images to sizes with small prime factors')
+	parser.add_argument('--cache-dir',
+			help='folder of the operator cache on disk shared by the cases, \
+					by default only the memory is used')
+	parser.add_argument('--cache-size', type=float, default=2,
+			help='size (GB) of the operator cache on disk, the least \
+					recently used operators are removed beyond it; \
+					by default is 2')
+	parser.add_argument('--operator-cache-size', type=int, default=1,
+			help='number of operators kept in memory by each worker \
+					process, the least recently used are dropped; they are \
+					reserved from the memory limit; by default is 1')
+	args = parser.parse_args()
+	if args.operator_cache_size < 0:
+		print('Error: --operator-cache-size should be non-negative')
+		exit(1)
+	error = regularization_error(args, args.reg_weight)
+	if error != None:
+		print('Error: %s' % error)
+		exit(1)
+	# the memory estimates depend on the precision
+	set_precision(args.precision)
+
+	out_path = args.out_path
+	if not out_path.endswith('/'):
+		out_path += '/'
+	cache_dir = args.cache_dir
+	memory_limit = args.memory_limit * 2**30 if args.memory_limit != None \
+			else 0.8 * physical_memory()
+	n_jobs = max(1, args.jobs)
+	fft_workers = args.fft_workers
+	if fft_workers == None:
+		fft_workers = max(1, os.cpu_count() // n_jobs)
+
+	options = {'reg': 'tik' if args.tik else 'ggr',
+			'reg_weights': args.reg_weight,
+			'select_method': args.select_weight,
+			'keep_negative_values': args.keep_negative_values,
+			'fast_padding': args.fast_padding,
+			'threads': args.threads, 'registration_workers': 1,
+			'registration_timeout': args.registration_timeout,
+			'registration': args.registration,
+			'registration_threads': args.threads,
+			'cache_dir': cache_dir,
+			'tau_percent': args.edge_enhance,
+			'quantile_method': args.quantile_method}
+
+	with open(args.manifest, 'r') as f:
+		manifest = json.load(f)
+	if isinstance(manifest, dict):
+		manifest = manifest['subjects']
+	root = os.path.dirname(os.path.abspath(args.manifest))
+
+	console = Console()
+	print_header(console)
+
+	subjects = []
+	for ii, s in enumerate(manifest):
+		stacks = [os.path.join(root, fn) for fn in s['stacks']]
+		name = s.get('name', split_filename(stacks[0])[1])
+		subjects.append({'name': name, 'stacks': stacks, 'size': s.get('size'),
+				'sz': None, 'memory': 0, 'error': None})
+	# the results of each case are written to OUT_PATH/<name>/
+	names = [s['name'] for s in subjects]
+	duplicates = sorted(set(n for n in names if names.count(n) > 1))
+	if len(duplicates) > 0:
+		console.print('[red bold]Error: the names of the cases should be '
+				'unique: %s' % ', '.join(duplicates))
+		exit(1)
+	# a case whose first stack cannot be read fails alone
+	for s in subjects:
+		try:
+			s['sz'] = reference_size(s['stacks'][0], s['size'])
+		except Exception as e:
+			s['error'] = e
+
+	table = Table(title='Summary of %s/batch.py execution' % app_name,
+			box=box.HORIZONTALS,
+			show_header=True, header_style='bold magenta')
+	table.add_column('Reg. method', justify='center')
+	table.add_column('Reg. weight', justify='center')
+	table.add_column('# cases', justify='center')
+	table.add_column('# jobs', justify='center')
+	table.add_column('Memory limit', justify='center')
+	table.add_column('Operator cache', justify='center')
+	# the operators kept in memory by each worker process outlive its
+	# cases, so that memory is reserved for the largest grid of the cohort
+	cache_memory = n_jobs * args.operator_cache_size * max([operator_memory(
+			s['sz'], options['reg'], fast_padding=args.fast_padding)
+			for s in subjects if s['error'] == None], default=0)
+	case_memory_limit = max(memory_limit - cache_memory, 0)
+	# each case sizes its deconvolution (tiles, out of core) to its share
+	options['memory_budget'] = case_memory_limit / n_jobs
+	for s in subjects:
+		if s['error'] == None:
+			s['memory'] = estimate_peak_memory(s['sz'], len(s['stacks']),
+					fast_padding=args.fast_padding,
+					memory_budget=options['memory_budget'],
+					edge=args.edge_enhance != None)
+	table.add_row(options['reg'].upper(),
+			', '.join('%g' % w for w in args.reg_weight),
+			str(len(subjects)), str(n_jobs), '%.1f GB' % (memory_limit / 2**30),
+			'%.1f GB' % (cache_memory / 2**30))
+	console.print(table, justify='center')
+	console.print('\n')
+
+	pending = [s for s in subjects if s['error'] == None]
+	running = {}
+	results = {s['name']: s['error'] for s in subjects
+			if s['error'] != None}
+	used_memory = 0
+	with Progress(TextColumn("[progress.description]{task.description}"),
+			"[progress.percentage]({task.percentage:>3.1f}%)",
+			BarColumn(bar_width=None), TimeElapsedColumn(),
+			console=console, refresh_per_second=2) as progress, \
+			ProcessPoolExecutor(max_workers=n_jobs,
+				initializer=init_worker,
+				initargs=(args.fft_backend, fft_workers,
+					args.precision, args.cache_size * 2**30,
+					args.operator_cache_size)) as pool:
+		task = progress.add_task('[blue]Reconstructing...', total=len(subjects),
+				completed=len(results))
+		while len(pending) > 0 or len(running) > 0:
+			# admit the cases, in order, whose memory fits in the budget; a
+			# case larger than the budget runs alone
+			for s in list(pending):
+				if len(running) >= n_jobs:
+					break
+				if used_memory + s['memory'] > case_memory_limit \
+						and len(running) > 0:
+					continue
+				if s['memory'] > case_memory_limit:
+					console.print('[yellow]Warning: %s needs about %.2f GB, '
+							'more than the memory limit' \
+							% (s['name'], s['memory'] / 2**30))
+				job = pool.submit(run_case, s['stacks'],
+						out_path + s['name'] + '/', options, s['size'])
+				running[job] = s
+				used_memory += s['memory']
+				pending.remove(s)
+
+			done, _ = wait(running, return_when=FIRST_COMPLETED)
+			for job in done:
+				s = running.pop(job)
+				used_memory -= s['memory']
+				try:
+					results[s['name']] = job.result()
+				except Exception as e:
+					results[s['name']] = e
+				progress.update(task, advance=1,
+						description='[blue]Reconstructing... %s' % s['name'])
+
+	table = Table(title='Cases', box=box.HORIZONTALS,
+			show_header=True, header_style='bold magenta')
+	table.add_column('Case', justify='center')
+	table.add_column('Image size', justify='center', no_wrap=True)
+	table.add_column('Est. memory', justify='center')
+	table.add_column('Time', justify='center')
+	table.add_column('Result', justify='left')
+	n_failed = 0
+	for s in subjects:
+		r = results[s['name']]
+		if isinstance(r, Exception):
+			n_failed += 1
+			row = ['-', '[red]failed: %s' % r]
+		else:
+			row = ['%.1f s' % r[1], r[0][-1]]
+		table.add_row(s['name'], str(s['sz']) if s['sz'] != None else '-',
+				'%.2f GB' % (s['memory'] / 2**30) if s['sz'] != None else '-',
+				*row)
+	console.print('\n')
+	console.print(table, justify='center')
+	console.print('\n')
+
+	if n_failed > 0:
+		console.print('[red bold]%d of %d cases failed' % (n_failed, len(subjects)))
+		exit(1)
+	console.print('ALL THE CASES HAVE BEEN RECONSTRUCTED.')
+	console.print('\n')
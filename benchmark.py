@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import SimpleITK as sitk
+from scipy import ndimage
+import gc
+import glob
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+import argparse
+
+import warnings
+warnings.filterwarnings("ignore")
+
+import utils
+from utils import *
+from pipeline import *
+from profiling import peak_rss, reset_peak_rss
+
+from rich.console import Console
+from rich import box
+from rich.table import Table
+
+# =========== Measurements =============
+def fingerprint(x):
+	# checksum of the bytes of an output, plus its norm and mean to compare
+	# outputs that only differ by floating-point rounding
+	x = np.ascontiguousarray(x, dtype=np.float32)
+	return {'checksum': hashlib.sha256(x.tobytes()).hexdigest()[:16],
+			'norm': float(np.linalg.norm(x.astype(np.float64))),
+			'mean': float(x.mean(dtype=np.float64)),
+			'shape': list(x.shape)}
+
+def run_stage(records, case, stage, fn, repeat=1, output=None):
+	# run fn repeat times and record the best wall time and the largest
+	# peak RSS; output(result) selects the array to fingerprint
+	best, peak = None, 0
+	for ii in range(0, repeat):
+		gc.collect()
+		reset_peak_rss()
+		t0 = time.perf_counter()
+		result = fn()
+		elapsed = time.perf_counter() - t0
+		peak = max(peak, peak_rss())
+		best = elapsed if best == None else min(best, elapsed)
+	record = {'case': case, 'stage': stage, 'time': best, 'peak_rss': peak}
+	if output != None:
+		record.update(fingerprint(output(result)))
+	records.append(record)
+	return result
+
+def reconstruct_stage(records, case, stacks, filters, mean, reg, reg_weight,
+		repeat, check_precision=False):
+	# the operators are built on each run, as in a fresh process
+	def run():
+		utils._operator_cache.clear()
+		return reconstruct(stacks, filters, mean, reg=reg,
+				reg_weights=[reg_weight])[0]
+	recons = run_stage(records, case, 'recon_' + reg, run, repeat,
+			output=lambda recons: recons[0][1])
+	if check_precision:
+		# error of the reconstruction relative to the double precision one
+		precision = utils._precision['name']
+		set_precision('double')
+		x = run()[0][1]
+		set_precision(precision)
+		err = np.abs(recons[0][1] - x)
+		records[-1]['precision_error'] = float(err.max() / np.abs(x).max())
+		records[-1]['precision_rms_error'] = float(
+				np.sqrt(np.mean(err**2, dtype=np.float64)
+				/ np.mean(x**2, dtype=np.float64)))
+
+def check_paths_stage(records, case, stacks, filters, mean, reg, reg_weight,
+		working_path=None):
+	# the tiled, out-of-core and series reconstructions solve the same
+	# system as the in-core one: their relative error to it, recorded as
+	# path_error, should stay at the rounding level, and the tiled one
+	# within the truncation of the operators at the halo of the blocks
+	def relative_error(x, ref):
+		return float(np.abs(x - ref).max() / np.abs(ref).max())
+	def run(**options):
+		return reconstruct(stacks, filters, mean, reg=reg,
+				reg_weights=[reg_weight], scratch_dir=working_path,
+				**options)[0][0][1]
+	ref = run()
+	shape = mean.shape
+	paths = [('tiled', lambda: run(tile_size=[(d + 1) // 2 for d in shape],
+				tile_workers=2)),
+			# a quarter of the in-core memory, for several slabs
+			('out_of_core', lambda: run(memory_budget=deconvolution_memory(
+				shape, True) / 4))]
+	for path, fn in paths:
+		x = run_stage(records, case, 'check_%s_%s' % (path, reg), fn)
+		records[-1]['path_error'] = relative_error(x, ref)
+	# two volumes sharing the denominators, with a shared reference, and
+	# with one reference per volume, the second volume twice the first
+	x = run_stage(records, case, 'check_series_%s' % reg,
+			lambda: reconstruct_series([stacks, stacks], filters, mean,
+				reg=reg, reg_weights=[reg_weight])[0][1])
+	records[-1]['path_error'] = max(relative_error(x[0], ref),
+			relative_error(x[1], ref))
+	x = run_stage(records, case, 'check_series_per_volume_%s' % reg,
+			lambda: reconstruct_series([stacks, [2 * y for y in stacks]],
+				filters, [mean, 2 * mean], reg=reg,
+				reg_weights=[reg_weight])[0][1])
+	records[-1]['path_error'] = max(relative_error(x[0], ref),
+			relative_error(x[1], 2 * ref))
+	# the weight selection reconstructs the selected weight as is
+	for method in ['lcurve', 'gcv']:
+		recons, criteria = run_stage(records, case,
+				'check_%s_%s' % (method, reg), lambda: reconstruct(stacks,
+					filters, mean, reg=reg, reg_weights=[reg_weight / 10,
+						reg_weight, reg_weight * 10], select_method=method))
+		w, x = recons[0]
+		records[-1]['path_error'] = relative_error(x, reconstruct(stacks,
+				filters, mean, reg=reg, reg_weights=[w])[0][0][1])
+	# both quantile methods of the edge-enhanced GGR are exact
+	if reg == 'ggr':
+		x = run_stage(records, case, 'check_edge_quantile', lambda: run(
+				tau_percent=0.8, quantile_method='histogram'))
+		records[-1]['path_error'] = relative_error(x,
+				run(tau_percent=0.8, quantile_method='select'))
+
+# =========== Cases =============
+def benchmark_phantom(records, path, regs, reg_weight, repeat, working_path,
+		check_precision=False, check_paths=False):
+	# preprocessing and reconstruction of the ACR phantom stacks; the
+	# registration runs only if crlRigidRegistration is installed
+	fns = []
+	for name in ['acr-axial', 'acr-coronal', 'acr-sagittal']:
+		fns += sorted(glob.glob(os.path.join(path, name, '*.nii*')))[:1]
+	if len(fns) < 2:
+		return 'no phantom images (*.nii, *.nii.gz) in %s' % path
+	case = 'phantom'
+
+	imgs = run_stage(records, case, 'read', lambda: read_stacks(fns), repeat)
+	img0x = run_stage(records, case, 'reference',
+			lambda: make_reference(imgs[0]), repeat)
+	imgs_x = [img0x] + run_stage(records, case, 'resample',
+			lambda: resample_stacks(imgs[1:], img0x), repeat)
+
+	note = None
+	if shutil.which('crlRigidRegistration') != None:
+		with tempfile.TemporaryDirectory(dir=working_path) as tmp_path:
+			names = ['stack%d' % ii for ii in range(0, len(imgs_x))]
+			x_fns = [os.path.join(tmp_path, s + '_x.nii') for s in names]
+			write_images(imgs_x, x_fns)
+			reg_fns = [os.path.join(tmp_path, 'reg_' + s + '_x.nii')
+					for s in names[1:]]
+			tfm_fns = [os.path.join(tmp_path, 'tfm2_' + s + '.tfm')
+					for s in names[1:]]
+			run_stage(records, case, 'register', lambda: list(register_stacks(
+					x_fns[0], x_fns[1:], reg_fns, tfm_fns)), 1)
+			imgs_x[1:] = [imread(fn) for fn in reg_fns]
+	else:
+		note = 'crlRigidRegistration not found, the phantom stacks are not aligned'
+
+	stacks = [sitk.GetArrayFromImage(img) for img in imgs_x]
+	filters = run_stage(records, case, 'filters',
+			lambda: make_filters(imgs, img0x), repeat)
+	mean = run_stage(records, case, 'fuse', lambda: fuse_stacks(stacks),
+			repeat, output=lambda z: z)
+	for reg in regs:
+		reconstruct_stage(records, case, stacks, filters, mean, reg,
+				reg_weight, repeat, check_precision)
+		if check_paths:
+			check_paths_stage(records, case, stacks, filters, mean, reg,
+					reg_weight, working_path)
+	return note
+
+def synthetic_volume(n, seed=0):
+	# piecewise constant volume of random ellipsoids in an n^3 cube
+	rng = np.random.default_rng(seed)
+	z, y, x = np.ogrid[0:n, 0:n, 0:n]
+	vol = np.zeros([n, n, n], dtype=np.float32)
+	for ii in range(0, 12):
+		c = rng.uniform(0.3, 0.7, 3) * n
+		r = rng.uniform(0.05, 0.3, 3) * n
+		inside = ((z-c[0])/r[0])**2 + ((y-c[1])/r[1])**2 + ((x-c[2])/r[2])**2 < 1
+		vol[inside] += rng.uniform(0.2, 1)
+	return vol
+
+def synthetic_stacks(vol, n_stacks, factor):
+	# low-res stacks of vol, blurred (Gaussian slice profile of FWHM
+	# factor, as modeled by make_filters) and subsampled along the x, y
+	# and z axes in turn, with shifted slice positions for the repeated
+	# orientations
+	imgs = []
+	for ii in range(0, n_stacks):
+		axis = 2 - ii % 3 # x, y, z -> numpy order z, y, x
+		offset = (ii // 3) % factor
+		lr = ndimage.gaussian_filter1d(vol, factor / 2.355, axis=axis)
+		sl = [slice(None)] * 3
+		sl[axis] = slice(offset, None, factor)
+		img = sitk.GetImageFromArray(np.ascontiguousarray(lr[tuple(sl)]))
+		spacing = [1.0] * 3
+		spacing[2 - axis] = float(factor)
+		origin = [0.0] * 3
+		origin[2 - axis] = float(offset)
+		img.SetSpacing(spacing)
+		img.SetOrigin(origin)
+		imgs.append(img)
+	return imgs
+
+def benchmark_synthetic(records, n, n_stacks, factor, regs, reg_weight,
+		repeat, check_precision=False, check_paths=False, working_path=None):
+	# the stacks are aligned by construction, so there is no registration
+	case = 'synthetic-%d-x%d' % (n, n_stacks)
+	imgs = synthetic_stacks(synthetic_volume(n), n_stacks, factor)
+
+	img0x = run_stage(records, case, 'reference',
+			lambda: make_reference(imgs[0]), repeat)
+	imgs_x = [img0x] + run_stage(records, case, 'resample',
+			lambda: resample_stacks(imgs[1:], img0x), repeat)
+	stacks = [sitk.GetArrayFromImage(img) for img in imgs_x]
+	filters = run_stage(records, case, 'filters',
+			lambda: make_filters(imgs, img0x), repeat)
+	mean = run_stage(records, case, 'fuse', lambda: fuse_stacks(stacks),
+			repeat, output=lambda z: z)
+	for reg in regs:
+		reconstruct_stage(records, case, stacks, filters, mean, reg,
+				reg_weight, repeat, check_precision)
+		if check_paths:
+			check_paths_stage(records, case, stacks, filters, mean, reg,
+					reg_weight, working_path)
+
+def compare_reference(records, reference, tol):
+	# status of each output against the reference report: 'same' checksum,
+	# 'close' norm and mean within tol, or 'DIFF'; and the time ratio
+	ref = {(r['case'], r['stage']): r for r in reference['records']}
+	for r in records:
+		if (r['case'], r['stage']) not in ref:
+			continue
+		s = ref[(r['case'], r['stage'])]
+		r['time_ratio'] = r['time'] / s['time'] if s['time'] > 0 else None
+		if 'checksum' not in r or 'checksum' not in s:
+			continue
+		if r['checksum'] == s['checksum']:
+			r['status'] = 'same'
+		elif r['shape'] == s['shape'] \
+				and abs(r['norm'] - s['norm']) <= tol * abs(s['norm']) \
+				and abs(r['mean'] - s['mean']) <= tol * max(abs(s['mean']), 1e-12):
+			r['status'] = 'close'
+		else:
+			r['status'] = 'DIFF'
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-V', '--version', action='version',
+			version='%s version : v %s %s' % (app_name, version, release_date),
+			help='show version')
+	parser.add_argument('-p', '--path', default='./data/',
+			help='folder of the acr-axial, acr-coronal and acr-sagittal \
+					phantom stacks, by default is ./data/')
+	parser.add_argument('-s', '--sizes', nargs='+', type=int,
+			default=[64, 96, 128],
+			help='sizes of the synthetic high-res volumes, \
+					by default are 64 96 128')
+	parser.add_argument('-n', '--n-stacks', nargs='+', type=int, default=[3],
+			help='numbers of synthetic low-res stacks, by default is 3')
+	parser.add_argument('--factor', type=int, default=3,
+			help='slice thickness of the synthetic stacks in high-res \
+					voxels, by default is 3')
+	parser.add_argument('--reg', nargs='+', choices=['ggr', 'tik'],
+			default=['ggr', 'tik'],
+			help='regularizations to benchmark, by default both')
+	parser.add_argument('-w', '--reg-weight', type=float, default=0.1,
+			help='weight of the regularization, by default is 0.1')
+	parser.add_argument('-r', '--repeat', type=int, default=1,
+			help='runs of each stage, the best time is kept; by default is 1')
+	parser.add_argument('--skip-phantom', action='store_true', default=False)
+	parser.add_argument('--skip-synthetic', action='store_true', default=False)
+	parser.add_argument('--fft-backend', choices=['numpy', 'scipy', 'pyfftw'],
+			help='FFT library, by default is scipy', default='scipy')
+	parser.add_argument('--fft-workers', type=int, default=-1,
+			help='number of threads of the FFTs, by default all the CPUs')
+	parser.add_argument('--precision', choices=['single', 'double'],
+			default='single',
+			help='floating-point precision of the deconvolution, \
+					by default is single')
+	parser.add_argument('--check-precision', action='store_true',
+			default=False,
+			help='also reconstruct in double precision and report the \
+					relative error of the reconstructions')
+	parser.add_argument('--check-paths', action='store_true', default=False,
+			help='also reconstruct by tiles, out of core, as a series, with \
+					the weight selection and with both quantile methods of \
+					the edge-enhanced GGR, and fail if they differ from the \
+					in-core reconstruction beyond --path-tolerance')
+	parser.add_argument('--path-tolerance', type=float, default=1e-3,
+			help='largest error, relative to the in-core reconstruction, \
+					of the paths of --check-paths, by default is 1e-3')
+	parser.add_argument('--working_path', default=None,
+			help='folder of the temporary files of the registration')
+	parser.add_argument('-o', '--output',
+			help='JSON file to write the results to, e.g., to be used as \
+					the reference of the next runs')
+	parser.add_argument('--reference',
+			help='JSON file of a previous run to compare the outputs and \
+					the times with')
+	parser.add_argument('--tolerance', type=float, default=1e-4,
+			help='relative tolerance of the comparison of the outputs with \
+					the reference, by default is 1e-4')
+	args = parser.parse_args()
+
+	try:
+		set_fft_backend(args.fft_backend, args.fft_workers)
+		set_precision(args.precision)
+	except ValueError as e:
+		print('Error: %s' % e)
+		exit()
+
+	console = Console()
+	print_header(console)
+
+	records, notes = [], []
+	if not args.skip_phantom:
+		console.print('[magenta]Benchmarking the phantom...')
+		note = benchmark_phantom(records, args.path, args.reg,
+				args.reg_weight, args.repeat, args.working_path,
+				args.check_precision, args.check_paths)
+		if note != None:
+			notes.append('phantom: ' + note)
+	if not args.skip_synthetic:
+		for n, n_stacks in itertools.product(args.sizes, args.n_stacks):
+			console.print('[magenta]Benchmarking synthetic volume %d^3, '
+					'%d stacks...' % (n, n_stacks))
+			benchmark_synthetic(records, n, n_stacks, args.factor, args.reg,
+					args.reg_weight, args.repeat, args.check_precision,
+					args.check_paths, args.working_path)
+
+	if args.reference != None:
+		with open(args.reference, 'r') as f:
+			compare_reference(records, json.load(f), args.tolerance)
+	for r in records:
+		if r.get('path_error', 0) > args.path_tolerance:
+			r['status'] = 'DIFF'
+
+	table = Table(title='%s benchmark' % app_name, box=box.HORIZONTALS,
+			show_header=True, header_style='bold magenta')
+	table.add_column('Case', justify='left')
+	table.add_column('Stage', justify='left')
+	table.add_column('Time (s)', justify='right')
+	table.add_column('Peak RSS (MB)', justify='right')
+	table.add_column('Checksum', justify='center')
+	if args.check_precision:
+		table.add_column('Error vs. double', justify='right')
+	if args.check_paths:
+		table.add_column('Error vs. in-core', justify='right')
+	if args.reference != None or args.check_paths:
+		table.add_column('Status', justify='center')
+	for r in records:
+		row = [r['case'], r['stage'], '%.3f' % r['time'],
+				'%.1f' % (r['peak_rss'] / 2**20), r.get('checksum', '')]
+		if args.check_precision:
+			row.append('%.2e' % r['precision_error']
+					if 'precision_error' in r else '')
+		if args.check_paths:
+			row.append('%.2e' % r['path_error'] if 'path_error' in r else '')
+		if args.reference != None or args.check_paths:
+			ratio = r.get('time_ratio')
+			row.append('%s%s' % (r.get('status', ''),
+					' x%.2f' % ratio if ratio != None else ''))
+		style = 'red' if r.get('status') == 'DIFF' else None
+		table.add_row(*row, style=style)
+	console.print('\n')
+	console.print(table, justify='center')
+	for note in notes:
+		console.print('[yellow]Note: %s' % note)
+
+	if args.output != None:
+		report = {'version': version, 'fft_backend': args.fft_backend,
+				'fft_workers': args.fft_workers, 'precision': args.precision,
+				'factor': args.factor, 'path_tolerance': args.path_tolerance,
+				'reg_weight': args.reg_weight, 'cpu_count': os.cpu_count(),
+				'notes': notes, 'records': records}
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent=2)
+		console.print('See the results at: [cyan italic]%s' % args.output)
+
+	if any(r.get('status') == 'DIFF' for r in records):
+		exit(1)
@@ -5,4 +5,4 @@
 # service docker restart
 # sudo /bin/systemctl restart docker.service
 
-DOCKER_BUILDKIT=1 docker build --build-arg BUILD_DATE=$(date -u +'%Y-%m-%dT%H:%M:%SZ') -t ggr-gear:latest --build-arg VERSION="1.0.0_1.0.4" -f Dockerfile .
+DOCKER_BUILDKIT=1 docker build --build-arg BUILD_DATE=$(date -u +'%Y-%m-%dT%H:%M:%SZ') -t ggr-gear:latest --build-arg VERSION="1.0.0_1.0.5" -f Dockerfile .
@@ -3,65 +3,101 @@ import os
 import sys
 import logging
 
-#get context through fw
-context = flywheel.GearContext()
-config = context.config
+#GGR-recon is installed in /opt/GGR-recon by the base image, and runs in this
+#process: the inputs are read from where they are mounted
+sys.path.insert(0, os.environ.get('GGR_RECON_PATH', '/opt/GGR-recon'))
+from utils import set_fft_backend, set_precision
+from pipeline import GGRReconstructor, split_filename, write_images, \
+        output_name
+from profiling import start_report, finish_report, record
 
+#inputs of the manifest, in order; all but the first one are optional
+INPUTS = ['niftifileone', 'niftifiletwo', 'niftifilethree',
+        'niftifilefour', 'niftifilefive', 'niftifilesix']
 
-#Initialize logger
-logging.basicConfig()
-log = logging.getLogger()
-log.setLevel( logging.INFO )
-log.setLevel( logging.DEBUG )
 
+def parse_weights(s):
+    #weights separated by spaces or commas, e.g., "0.03" or "0.01, 0.03"
+    return [float(w) for w in str(s).replace(',', ' ').split()]
 
-#declare one required flag parameters as folder with dxm
 
+def log_report(log, report):
+    #time and peak memory of each stage, in the order they first ran
+    first = {}
+    for s in report['stages']:
+        first.setdefault(s['name'], s['start'])
+    log.info("%-12s %6s %10s %12s" % ('stage', 'count', 'time (s)',
+            'peak RSS (GB)'))
+    for name in sorted(report['summary'], key=lambda n: first[n]):
+        t = report['summary'][name]
+        log.info("%-12s %6d %10.2f %12.2f" % (name, t['count'], t['time'],
+                t['peak_rss'] / 2**30))
+    log.info("%-12s %6s %10.2f" % ('total', '', report['elapsed']))
 
-if type(context.get_input('niftifilethree')) is dict:
 
-    log.info("Ran 3 inputs")
-    #print(three)
-    path1 = context.get_input('niftifileone')['location']['path']
-    path2 = context.get_input('niftifiletwo')['location']['path']
-    path3 = context.get_input('niftifilethree')['location']['path']
-    nifti1_title = (str(path1)[str(path1)[0:-1].rfind('/')+1:])[:(str(path1)[str(path1)[0:-1].rfind('/')+1:]).find('.')]
-    log.info("The path of first nifti is " + (str(path1)))
-    log.info("The path of second nifti is " + (str(path2)))
-    log.info("The path of third nifti is " + (str(path3)))
-    log.info("Final output will have name " + str(nifti1_title) + "_recon_ggr-w0.03.nii.gz")
-    tempstr = "/flywheel/v0/output/data/"
-    outputstr = "/flywheel/v0/output/recons/"
-    workingstr = "/flywheel/v0/output/working/"
-    os.system("mkdir " + tempstr)
-    os.system("cp " + str(path1) + " " + str(path2) + " " + str(path3) + " /flywheel/v0/output/data")
-    #os.system("pwd")
-    #os.system("ls output/data")
-    os.system("cd /flywheel/v0/output && python3 /opt/GGR-recon/preprocess.py")
-    os.system("cd /flywheel/v0/output && python3 /opt/GGR-recon/recon.py --keep-negative-values --ggr -w 0.03")
-    os.system("rm -rf " + tempstr)
-    os.system("rm -rf " +  workingstr)
-    os.system("mv recon_ggr-w0.03.nii.gz  " + str(nifti1_title) + "_recon_ggr-w0.03.nii.gz")
+def main():
+    #get context through fw
+    context = flywheel.GearContext()
+    config = context.config
 
-else:
+    #Initialize logger
+    logging.basicConfig()
+    log = logging.getLogger()
+    log.setLevel( logging.INFO )
 
-    log.info("Ran 2 inputs")
-    #print(two)
-    path1 = context.get_input('niftifileone')['location']['path']
-    path2 = context.get_input('niftifiletwo')['location']['path']
-    nifti1_title = (str(path1)[str(path1)[0:-1].rfind('/')+1:])[:(str(path1)[str(path1)[0:-1].rfind('/')+1:]).find('.')]
-    log.info("The path of first nifti is " + (str(path1)))
-    log.info("The path of second nifti is " + (str(path2)))
-    log.info("Final output will have name " + str(nifti1_title) + "_recon_ggr-w0.03.nii.gz")
-    tempstr = "/flywheel/v0/output/data/"
-    outputstr = "/flywheel/v0/output/recons/"
-    workingstr = "/flywheel/v0/output/working/"
-    os.system("mkdir " + tempstr)
-    os.system("cp " + str(path1) + " " + str(path2) + " /flywheel/v0/output/data")
-    #os.system("pwd")
-    #os.system("ls output/data")
-    os.system("cd /flywheel/v0/output && python3 /opt/GGR-recon/preprocess.py")
-    os.system("cd /flywheel/v0/output && python3 /opt/GGR-recon/recon.py --keep-negative-values --ggr -w 0.03")
-    os.system("rm -rf " + tempstr)
-    os.system("rm -rf " +  workingstr)
-    os.system("mv recon_ggr-w0.03.nii.gz  " + str(nifti1_title) + "recon_ggr-w0.03.nii.gz")
+    paths = []
+    for name in INPUTS:
+        if isinstance(context.get_input(name), dict):
+            paths.append(context.get_input_path(name))
+    if len(paths) == 0:
+        log.error("No input nifti file")
+        return 1
+    for ii, path in enumerate(paths):
+        log.info("The path of nifti %d is %s" % (ii + 1, path))
+
+    reg = config.get('reg', 'ggr')
+    select_method = config.get('select_weight', 'none')
+    if select_method == 'none':
+        select_method = None
+    size = config.get('size', '')
+    size = [int(s) for s in size.split()] if len(size.strip()) > 0 else None
+    tau_percent = config.get('edge_enhance', 0)
+    if tau_percent == 0:
+        tau_percent = None
+
+    start_report('gear')
+    try:
+        reg_weights = parse_weights(config.get('reg_weights', '0.03'))
+        set_fft_backend('scipy', -1)
+        set_precision(config.get('precision', 'single'))
+        recon = GGRReconstructor(reg=reg, reg_weights=reg_weights,
+                select_method=select_method, size=size,
+                keep_negative_values=config.get('keep_negative_values', True),
+                cache_dir=None, tau_percent=tau_percent)
+        record(n_imgs=len(paths), reg=reg, reg_weights=reg_weights)
+        recon.preprocess(paths)
+        recons = recon.reconstruct()
+    except (RuntimeError, ValueError) as e:
+        log.error("Reconstruction failed: %s" % e)
+        log_report(log, finish_report())
+        return 1
+
+    #outputs named after the first input, e.g., ax_recon_ggr-w0.03.nii.gz,
+    #or ax_recon_ggr-e0.8-w0.03.nii.gz with the edge enhancement
+    title = split_filename(paths[0])[1]
+    for reg_weight, img in recons:
+        out_fn = os.path.join(context.output_dir, title + '_' \
+                + output_name(reg, reg_weight, tau_percent) + '.nii.gz')
+        write_images([img], [out_fn])
+        log.info("Final output: " + out_fn)
+    if recon.criteria != None:
+        weights, rho, eta, gcv = recon.criteria
+        for ii, w in enumerate(weights):
+            log.info("weight %g: residual norm %.4g, reg. norm %.4g, GCV %.4g" \
+                    % (w, rho[ii], eta[ii], gcv[ii]))
+    log_report(log, finish_report())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
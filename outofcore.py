@@ -0,0 +1,192 @@
+import numpy as np
+import os
+import tempfile
+
+from utils import *
+from profiling import stage, record, timed_iter
+
+# Out-of-core deconvolution: the spectra on the padded grid (WY, WW and the
+# spectrum of the gradient reference) are kept in memory-mapped scratch
+# files, and every step runs slab by slab, so that only the high-res
+# volumes and a few slabs of the spectra are held in memory.
+#
+# The 3D transforms are split by axis: the 2D transform of the last two
+# axes runs over slabs along the first axis (z), and the 1D transform of
+# the first axis over slabs along the second one (y). All the spectral
+# operations are voxel-wise, so the spectra are only ever accessed in
+# y-slabs. The half spectrum (rfftn layout) is used throughout.
+
+# complex spectra held per y-slab: the spectrum of the current image, WY,
+# WW, DG, DD and the temporaries of the solve and of the criteria
+_SLAB_SPECTRA = 12
+
+def slabs(n, rows):
+	# (start, stop) of the slabs of a given number of rows along an axis
+	for i in range(0, n, rows):
+		yield i, min(i + rows, n)
+
+def slab_rows(budget, row_bytes, n):
+	# number of rows of the slabs, so that a slab fits in the budget
+	return int(min(max(budget // row_bytes, 1), n))
+
+def scratch_array(path, name, shape, dtype):
+	# zero-initialized array backed by a file of the scratch folder
+	return np.memmap(os.path.join(path, name + '.dat'), dtype=dtype,
+			mode='w+', shape=tuple(shape))
+
+def take_rows(a, y0, y1):
+	# rows y0:y1 along the second axis of a volume, or of a filter or an
+	# operator broadcast along it
+	if np.ndim(a) < 3 or np.shape(a)[1] == 1:
+		return a
+	return a[:, y0:y1]
+
+def forward_fft_slabs(x, grid, scratch_path, budget):
+	# rfftn of x zero-padded to grid, yielded as (y0, y1, spectrum[:, y0:y1])
+	d = x.shape[0]
+	G0, G1, G2 = grid
+	H = G2 // 2 + 1
+	c = np.dtype(complex_dtype()).itemsize
+	T = scratch_array(scratch_path, 'rfft2', [d, G1, H], complex_dtype())
+	for z0, z1 in slabs(d, slab_rows(budget, 2 * G1 * H * c, d)):
+		T[z0:z1] = forward_fft(x[z0:z1], [G1, G2], real=True)
+	for y0, y1 in slabs(G1, slab_rows(budget, _SLAB_SPECTRA * G0 * H * c, G1)):
+		yield y0, y1, fft_axis(T[:, y0:y1], G0, 0)
+	del T
+
+def inverse_fft_slabs(solve_slab, grid, out_shape, scratch_path, budget,
+		keep_negative_values=False):
+	# inverse of forward_fft_slabs cropped to out_shape, where
+	# solve_slab(y0, y1) returns the y-slab of the spectrum; the rows of
+	# the first axis beyond out_shape are dropped right after its transform,
+	# and those of the other axes by cropped_inverse_fft
+	d, n, m = out_shape
+	G0, G1, G2 = grid
+	H = G2 // 2 + 1
+	c = np.dtype(complex_dtype()).itemsize
+	Z = scratch_array(scratch_path, 'irfft1', [d, G1, H], complex_dtype())
+	for y0, y1 in slabs(G1, slab_rows(budget, _SLAB_SPECTRA * G0 * H * c, G1)):
+		Z[:, y0:y1] = fft_axis(solve_slab(y0, y1), G0, 0, inverse=True)[:d]
+
+	x = np.empty([d, n, m], dtype=real_dtype())
+	for z0, z1 in slabs(d, slab_rows(budget, 2 * G1 * H * c, d)):
+		x[z0:z1] = cropped_inverse_fft(Z[z0:z1], [G1, G2], [n, m], True,
+				keep_negative_values)
+	del Z
+	return x
+
+def reconstruct_out_of_core(stacks, filters, grad_ref, reg='ggr',
+		reg_weights=[0.1], select_method=None, keep_negative_values=False,
+		fast_padding=False, memory_budget=None, scratch_dir=None,
+		p=2, alpha=0.6, update_progress=None):
+	# same as pipeline.reconstruct, on the half spectrum
+	# memory_budget: bytes, sets the size of the slabs
+	# scratch_dir: parent folder of the scratch files, by default the
+	#              system temporary folder
+	if update_progress == None:
+		update_progress = lambda desc, advance: None
+	if memory_budget == None:
+		memory_budget = available_memory()
+
+	reg_weights = sorted(set(reg_weights))
+	n_imgs = len(filters)
+	d, n, m = grad_ref.shape
+	grid = padded_grid([d, n, m], fast_padding, True)
+	G0, G1, G2 = grid
+	spec_shape = spectrum_shape(grid, True)
+	# the high-res volumes (the reference, the current image and the
+	# reconstruction) stay in memory, the slabs share the rest
+	c = np.dtype(complex_dtype()).itemsize
+	budget = max(memory_budget
+			- 3 * d * n * m * np.dtype(real_dtype()).itemsize, 0) / 2
+	record(shape=[d, n, m], grid=grid, spectrum_shape=spec_shape,
+			n_imgs=n_imgs, slab_budget=budget)
+
+	with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch_path:
+		WY = scratch_array(scratch_path, 'WY', spec_shape, complex_dtype())
+		WW = scratch_array(scratch_path, 'WW', spec_shape, real_dtype())
+		YY = 0
+		for y, h in zip(timed_iter('load', stacks), filters):
+			with stage('accumulate', shape=y.shape, grid=grid):
+				w = expand_filter(h, grid, True).astype(real_dtype(),
+						copy=False)
+				for y0, y1, Y in forward_fft_slabs(y, grid, scratch_path,
+						budget):
+					ws = take_rows(w, y0, y1)
+					WY[:, y0:y1] += np.conj(ws) * Y
+					WW[:, y0:y1] += (np.conj(ws) * ws).real
+					if select_method != None:
+						YY += spectral_sum(np.abs(Y)**2, grid, True)
+			del y, w
+
+			update_progress('[green]Loading images...', 20/n_imgs)
+
+		update_progress('[cyan]Reconstructing...', 5)
+
+		# the operators are formed slab by slab from their 1D/2D factors
+		# (see ggr_operators), and only the spectrum of the reference is
+		# stored on disk
+		with stage('operators', reg=reg):
+			if reg == 'ggr':
+				GR = scratch_array(scratch_path, 'GR', spec_shape,
+						complex_dtype())
+				RR = 0
+				for y0, y1, Y in forward_fft_slabs(grad_ref, grid, scratch_path,
+						budget):
+					GR[:, y0:y1] = Y
+					RR += spectral_sum(np.abs(Y)**2, grid, True)
+				RR *= ggr_weight_sum(p, alpha)
+				U, S, V, T = ggr_factors(grid, p, alpha, True)
+				U, S, V, T = [f.astype(real_dtype()) for f in (U, S, V, T)]
+
+				def reg_slab(y0, y1):
+					DS = np.tensordot(U, S[:, y0:y1], axes=(0, 0))
+					DD = np.tensordot(V, T[:, y0:y1], axes=(0, 0))
+					return DS * GR[:, y0:y1], DD
+			else:
+				RR = 0
+				dx, dy, dz = tik_factors(grid, True)
+
+				def reg_slab(y0, y1):
+					DD = dx[:,None,None] + dy[None,y0:y1,None] + dz[None,None,:]
+					return 0, DD.astype(real_dtype())
+
+		update_progress('[cyan]Reconstructing...', 30)
+
+		rows = slab_rows(budget, _SLAB_SPECTRA * G0 * spec_shape[2] * c, G1)
+		criteria = None
+		solve_advance = 35
+		if select_method != None:
+			sums = 0
+			with stage('selection', method=select_method,
+					n_weights=len(reg_weights)):
+				for y0, y1 in slabs(G1, rows):
+					DG, DD = reg_slab(y0, y1)
+					sums = sums + np.array(weight_sums(reg_weights,
+							WY[:, y0:y1], WW[:, y0:y1], DG, DD,
+							shape=grid, real=True))
+			rho, eta, gcv = combine_criteria(*sums, YY, RR,
+					n_imgs * np.prod(grid))
+			selected = select_weight(reg_weights, rho, eta, gcv, select_method)
+			criteria = [reg_weights, rho, eta, gcv]
+			reg_weights = [reg_weights[selected]]
+			solve_advance -= 10
+			update_progress('[cyan]Reconstructing...', 10)
+
+		recons = []
+		for reg_weight in reg_weights:
+			def solve_slab(y0, y1):
+				DG, DD = reg_slab(y0, y1)
+				return solve_spectrum(WY[:, y0:y1], WW[:, y0:y1], DG, DD,
+						reg_weight)
+
+			# the solve runs slab by slab within the inverse FFT
+			with stage('solve', weight=reg_weight, grid=grid):
+				x = inverse_fft_slabs(solve_slab, grid, [d, n, m],
+						scratch_path, budget, keep_negative_values)
+			recons.append((reg_weight, x))
+
+			update_progress('[cyan]Reconstructing...',
+					solve_advance/len(reg_weights))
+
+	return recons, criteria
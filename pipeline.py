@@ -0,0 +1,865 @@
+import numpy as np
+import SimpleITK as sitk
+import os
+import pathlib
+import itertools
+import functools
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils import *
+from outofcore import reconstruct_out_of_core
+from tiling import reconstruct_tiled, default_halo
+from profiling import stage, record, timed, timed_iter, nbytes
+
+def split_filename(filename):
+	# folder (with a trailing '/'), base name and extension of a file;
+	# everything after the first dot is the extension, e.g., '.nii.gz'
+	fpname = pathlib.PurePosixPath(filename)
+	base, first_dot, rest = fpname.name.partition('.')
+	p = str(fpname.parent)
+	if not p.endswith('/'):
+		p += '/'
+	return p, str(base), '.' + str(rest)
+
+# =========== Preprocessing =============
+# concurrent registrations when not given: each one is multi-threaded itself
+max_registration_workers = 4
+
+def default_registration_workers(workers=None):
+	if workers != None:
+		return workers
+	return max(1, min(max_registration_workers, os.cpu_count() or 1))
+
+@timed('reorient')
+def read_stacks(filenames, threads=None):
+	# step 0: read the low-res images and make their orientations the same;
+	# the independent images are read concurrently
+	with ThreadPoolExecutor(max_workers=threads) as pool:
+		return list(pool.map(read_oriented, filenames))
+
+@timed('reference')
+def make_reference(img0, size=None, upsampling='bspline'):
+	# step 1: the high-res lattice, the first low-res image resampled
+	# isotropically at its finest spacing
+	if upsampling == 'fourier':
+		return fourier_resample_like(img0, iso_lattice(img0, size))
+	if size == None:
+		return resample_iso_img(img0)
+	return resample_iso_img_with_size(img0, size)
+
+@timed('resample')
+def resample_stacks(imgs, ref, threads=None, transforms=None,
+		upsampling='bspline'):
+	# step 1: resample the other low-res images in the high-res lattice,
+	# through their registration transforms if given; with
+	# upsampling='fourier', the images on the grid of the lattice are
+	# interpolated in the Fourier domain instead, see fourier_resample_like
+	if upsampling == 'fourier':
+		if transforms != None:
+			raise ValueError('the Fourier upsampling does not apply '
+					'transforms')
+		resample = lambda img, tfm: fourier_resample_like(img, ref)
+	else:
+		resample = lambda img, tfm: resample_img_like(img, ref, tfm)
+	if transforms == None:
+		transforms = [None] * len(imgs)
+	with ThreadPoolExecutor(max_workers=threads) as pool:
+		return list(pool.map(resample, imgs, transforms))
+
+def read_series(series):
+	# the 3D volumes of a series: a 4D image (SimpleITK or filename) split
+	# along its last axis, or a list of 3D images; reoriented and cast as
+	# read_oriented does
+	if isinstance(series, (list, tuple)):
+		vols = [imread(s) if not isinstance(s, sitk.Image) else s
+				for s in series]
+	else:
+		img = series if isinstance(series, sitk.Image) else \
+				sitk.ReadImage(str(series))
+		if img.GetDimension() == 3:
+			vols = [img]
+		else:
+			sz = list(img.GetSize())
+			vols = [sitk.Extract(img, sz[:3] + [0], [0, 0, 0, t])
+					for t in range(0, sz[3])]
+	return [sitk.Cast(sitk.DICOMOrient(v, 'LPS'), sitk.sitkFloat32)
+			for v in vols]
+
+def output_name(reg, reg_weight, tau_percent=None, prefix='recon'):
+	# base name of a reconstruction, e.g., recon_ggr-w0.1, with the
+	# threshold of the edge-enhanced GGR, e.g., recon_ggr-e0.8-w0.1
+	edge = '-e%g' % tau_percent if tau_percent != None else ''
+	return '%s_%s%s-w%g' % (prefix, reg, edge, reg_weight)
+
+@timed('write')
+def write_images(imgs, fns, threads=None):
+	with ThreadPoolExecutor(max_workers=threads) as pool:
+		for job in [pool.submit(imwrite, img, fn) for img, fn in zip(imgs, fns)]:
+			job.result()
+
+def register_stacks(fixed_fn, moving_fns, out_fns, tfm_fns,
+		workers=None, timeout=None, engine='crl', threads=None):
+	# step 2: align up the resampled images to the first one; the
+	# registrations run concurrently, each one in its own
+	# crlRigidRegistration process (engine='crl') or in process with
+	# SimpleITK on threads threads (engine='sitk'), and the index of each
+	# image is yielded once it is aligned. A failure cancels the pending
+	# registrations, terminates the running crlRigidRegistration processes
+	# and raises RuntimeError at once (the running SimpleITK registrations
+	# cannot be interrupted, they end in the background).
+	group = ProcessGroup()
+	register = functools.partial(rigid_register, group=group)
+	if engine == 'sitk':
+		register = functools.partial(sitk_register, threads=threads)
+	pool = ThreadPoolExecutor(
+			max_workers=default_registration_workers(workers))
+	try:
+		reg_jobs = {}
+		for ii in range(0, len(moving_fns)):
+			job = pool.submit(register, fixed_fn, moving_fns[ii],
+					out_fns[ii], tfm_fns[ii], timeout)
+			reg_jobs[job] = ii
+
+		for job in as_completed(reg_jobs):
+			try:
+				job.result()
+			except RuntimeError as e:
+				raise RuntimeError('failed to align %s: %s' \
+						% (moving_fns[reg_jobs[job]], e))
+			yield reg_jobs[job]
+	finally:
+		# no wait: within a with block, shutdown would wait for the
+		# running registrations
+		pool.shutdown(wait=False, cancel_futures=True)
+		group.terminate()
+
+@timed('filters')
+def make_filters(imgs, ref):
+	# step 3: create filters for deconvolution
+	# the filters are separable and vary along the slice direction only, so
+	# each one is the 1D spectrum, its (numpy) axis and its blur factor,
+	# see expand_filter
+	sz = ref.GetSize()
+	spacing = ref.GetSpacing()
+	filters = []
+	for img in imgs:
+		fft_win, axis, max_factor = np.ones(1, dtype=np.float32), 0, 1
+		for jj in range(0, 3):
+			factor = img.GetSpacing()[jj] / spacing[jj]
+			if factor > 1 and max_factor < factor:
+				fft_win = gaussian_fft_win(factor, sz[jj] * 2)
+				axis = 2 - jj # x, y, z -> numpy order z, y, x
+				max_factor = factor
+		filters.append((fft_win, axis, max_factor))
+	return filters
+
+@timed('fuse')
+def fuse_stacks(arrays):
+	# step 4: volume fusion, the mean of the aligned images over their
+	# nonzero voxels; arrays can be any iterable and is consumed lazily
+	z, L = None, None
+	for a in arrays:
+		if z is None:
+			z = np.array(a, dtype=np.float32)
+			L = np.ones_like(z)
+			continue
+		z += a
+		L += (a != 0).astype(np.float32)
+
+	z[L!=0] = z[L!=0] / L[L!=0]
+	return z
+
+# =========== Deconvolution =============
+def reconstruct(stacks, filters, grad_ref, reg='ggr', reg_weights=[0.1],
+		select_method=None, keep_negative_values=False, real=True,
+		fast_padding=False, cache_dir=None, memory_budget=None,
+		scratch_dir=None, tau_percent=None, quantile_method='histogram',
+		tile_size=None, tile_halo=None, tile_workers=None,
+		progress=None, task=None):
+	# stacks: high-res images (numpy arrays), consumed one at a time, so
+	#         that a generator keeps the memory footprint constant
+	# filters: convolutional filters of the images, see expand_filter
+	# grad_ref: gradient guidance reference, i.e., the fused image
+	# reg: 'ggr' or 'tik'
+	# reg_weights: the spectra are computed once and shared by all weights
+	# select_method: None, 'lcurve' or 'gcv', see select_weight
+	# fast_padding: pad to sizes with small prime factors instead of 2x
+	# memory_budget: bytes; if the spectra do not fit in it (by default, in
+	#                the available memory) they are memory-mapped in
+	#                scratch_dir, see reconstruct_out_of_core
+	# tau_percent: if set, the edge-enhanced GGR with the tau_percent
+	#              quantile of the gradients as threshold, see
+	#              ggr_edge_spectra; it needs the spectra in memory
+	# quantile_method: 'histogram' or 'select', see approx_quantile
+	# tile_size: if set, reconstruct blocks of this size (voxels) extended
+	#            by tile_halo on tile_workers processes, by default as many
+	#            as fit in the memory budget, see reconstruct_tiled
+	#
+	# returns the reconstructions with their weights, and the selection
+	# criteria [weights, rho, eta, gcv] if select_method is set
+	if progress != None and task != None:
+		update_progress = lambda desc, advance: progress.update(task,
+				description=desc, advance=advance)
+	else:
+		update_progress = lambda desc, advance: None
+
+	reg_weights = sorted(set(reg_weights))
+	n_imgs = len(filters)
+	d, n, m = grad_ref.shape
+	budget = memory_budget
+	if budget == None:
+		budget = available_memory()
+	edge = reg == 'ggr' and tau_percent != None
+	if tile_size != None:
+		halo = tile_halo
+		if halo == None:
+			halo = default_halo(filters)
+		workers = tile_workers
+		if workers == None:
+			block = np.minimum(np.broadcast_to(tile_size, 3)
+					+ 2 * np.broadcast_to(halo, 3), [d, n, m])
+			workers = int(max(1, min(os.cpu_count(), budget
+					// deconvolution_memory(block, real, fast_padding, edge))))
+		record(tiled=True, memory_budget=budget)
+		return reconstruct_tiled(stacks, filters, grad_ref, tile_size,
+				halo=halo, workers=workers, scratch_dir=scratch_dir,
+				update_progress=update_progress, reg=reg,
+				reg_weights=reg_weights, select_method=select_method,
+				keep_negative_values=keep_negative_values, real=real,
+				fast_padding=fast_padding, cache_dir=cache_dir,
+				memory_budget=budget / workers, tau_percent=tau_percent,
+				quantile_method=quantile_method)
+	if deconvolution_memory([d, n, m], real, fast_padding, edge) > budget:
+		if edge:
+			raise ValueError('the edge-enhanced GGR does not fit in the '
+					'memory budget (%.1f GB)' % (budget / 2**30))
+		record(out_of_core=True, memory_budget=budget)
+		return reconstruct_out_of_core(stacks, filters, grad_ref, reg=reg,
+				reg_weights=reg_weights, select_method=select_method,
+				keep_negative_values=keep_negative_values,
+				fast_padding=fast_padding, memory_budget=budget,
+				scratch_dir=scratch_dir, update_progress=update_progress)
+
+	grid = padded_grid([d, n, m], fast_padding, real)
+	record(out_of_core=False, shape=[d, n, m], grid=grid,
+			spectrum_shape=spectrum_shape(grid, real), n_imgs=n_imgs)
+
+	# stream the images: each one is folded into the running sums
+	# WY = sum(conj(w)*y) and WW = sum(conj(w)*w) and then released,
+	# so that the memory footprint does not grow with the number of images
+	WY, WW, YY = None, None, 0
+	for y, h in zip(timed_iter('load', stacks), filters):
+		with stage('fft', shape=y.shape, grid=grid):
+			fft_img = forward_fft(y, grid, real)
+		with stage('accumulate'):
+			w = expand_filter(h, grid, real).astype(real_dtype(), copy=False)
+			WY, WW = accumulate_spectra(fft_img, w, WY, WW)
+			if select_method != None:
+				YY += spectral_sum(np.abs(fft_img)**2, grid, real)
+			record(nbytes=nbytes(WY, WW))
+		del y, fft_img, w
+
+		update_progress('[green]Loading images...', 20/n_imgs)
+
+	update_progress('[cyan]Reconstructing...', 5)
+
+	# the spectra of the regularization do not depend on the weight, so
+	# they are computed once and shared by all the weights
+	with stage('operators', reg=reg, tau_percent=tau_percent if edge else None):
+		if reg == 'ggr':
+			DG, DD, RR = ggr_spectra(grad_ref, grid, dtype=WW.dtype,
+					real=real, cache_dir=cache_dir,
+					tau_percent=tau_percent, quantile_method=quantile_method)
+		else:
+			DG, DD, RR = tik_spectra(grid, dtype=WW.dtype,
+					real=real, cache_dir=cache_dir)
+		record(nbytes=nbytes(DG, DD))
+
+	update_progress('[cyan]Reconstructing...', 30)
+
+	criteria = None
+	solve_advance = 35
+	if select_method != None:
+		with stage('selection', method=select_method,
+				n_weights=len(reg_weights)):
+			rho, eta, gcv = weight_criteria(reg_weights, WY, WW, DG, DD,
+					YY, RR, n_imgs * np.prod(grid), shape=grid, real=real)
+		selected = select_weight(reg_weights, rho, eta, gcv, select_method)
+		criteria = [reg_weights, rho, eta, gcv]
+		reg_weights = [reg_weights[selected]]
+		solve_advance -= 10
+		update_progress('[cyan]Reconstructing...', 10)
+
+	recons = []
+	for reg_weight in reg_weights:
+		with stage('solve', weight=reg_weight):
+			fft_x = solve_spectrum(WY, WW, DG, DD, reg_weight)
+
+		#x = np.clip(ifftn(fft_x).real.astype(np.float32), 0, None)
+		#x = np.abs(ifftn(fft_x)).astype(np.float32)
+		# only the cropped volume is transformed back, see cropped_inverse_fft
+		with stage('inverse_fft', grid=grid, shape=[d, n, m]):
+			x = cropped_inverse_fft(fft_x, grid, [d, n, m], real,
+					keep_negative_values)
+			del fft_x
+		recons.append((reg_weight, x))
+
+		update_progress('[cyan]Reconstructing...',
+				solve_advance/len(reg_weights))
+
+	return recons, criteria
+
+def reconstruct_series(series, filters, grad_ref, reg='ggr',
+		reg_weights=[0.1], keep_negative_values=False, real=True,
+		fast_padding=False, cache_dir=None, memory_budget=None,
+		tau_percent=None, quantile_method='histogram',
+		progress=None, task=None):
+	# series: per volume (e.g., echo), its high-res images in the order of
+	#         filters; the volumes share the stack geometry, so the filters
+	#         and the denominators WW + weight * DD are computed once
+	# grad_ref: gradient guidance reference shared by the volumes, or a list
+	#           of one per volume, whose DG are then computed per volume
+	# the volumes are solved together, in batches that fit in memory_budget
+	# (by default, in the available memory); other arguments as reconstruct
+	#
+	# returns the reconstructions [volume, z, y, x] with their weights
+	if progress != None and task != None:
+		update_progress = lambda desc, advance: progress.update(task,
+				description=desc, advance=advance)
+	else:
+		update_progress = lambda desc, advance: None
+
+	reg_weights = sorted(set(reg_weights))
+	series = list(series)
+	n_vols = len(series)
+	shared_ref = not isinstance(grad_ref, (list, tuple))
+	d, n, m = (grad_ref if shared_ref else grad_ref[0]).shape
+	grid = padded_grid([d, n, m], fast_padding, real)
+	spec_shape = spectrum_shape(grid, real)
+	n_spectrum = np.prod(spec_shape, dtype=np.float64)
+	c, r = [np.dtype(t).itemsize for t in (complex_dtype(), real_dtype())]
+
+	# the spectra held per volume of a batch: WY, the solution and the
+	# inverse transform, and DG with one reference per volume; the shared
+	# ones: WW, DD, one denominator per weight and DG
+	budget = memory_budget
+	if budget == None:
+		budget = available_memory()
+	shared = deconvolution_memory([d, n, m], real, fast_padding,
+			reg == 'ggr' and tau_percent != None) \
+			+ len(reg_weights) * n_spectrum * r
+	per_volume = n_spectrum * ((3 if shared_ref else 4) * c)
+	if shared + per_volume > budget:
+		raise ValueError('a volume of the series does not fit in the memory '
+				'budget (%.1f GB)' % (budget / 2**30))
+	batch = int(min(n_vols, (budget - shared) // per_volume))
+	record(shape=[d, n, m], grid=grid, n_vols=n_vols, batch=batch,
+			shared_reference=shared_ref)
+
+	with stage('operators', reg=reg):
+		WW = 0
+		ws = [expand_filter(h, grid, real).astype(real_dtype(), copy=False)
+				for h in filters]
+		for w in ws:
+			WW = WW + (np.conj(w) * w).real
+		if reg == 'ggr':
+			DD, _ = ggr_operators(grid, dtype=real_dtype(), real=real,
+					cache_dir=cache_dir)
+		else:
+			DD = tik_operator(grid, real_dtype(), real, cache_dir)
+		DG = 0
+		if reg == 'ggr' and shared_ref:
+			DG, _, _ = ggr_spectra(grad_ref, grid, dtype=real_dtype(),
+					real=real, cache_dir=cache_dir, tau_percent=tau_percent,
+					quantile_method=quantile_method)
+		# the reciprocals of the denominators, shared by all the volumes
+		inv_den = {reg_weight: (1 / (WW + reg_weight * DD)).astype(
+				real_dtype(), copy=False) for reg_weight in reg_weights}
+		del WW, DD
+
+	update_progress('[cyan]Reconstructing...', 5)
+
+	recons = [(reg_weight, np.empty([n_vols, d, n, m], dtype=real_dtype()))
+			for reg_weight in reg_weights]
+	for t0 in range(0, n_vols, batch):
+		t1 = min(t0 + batch, n_vols)
+		WY = np.zeros([t1 - t0] + list(spec_shape), dtype=complex_dtype())
+		for jj, stacks in enumerate(series[t0:t1]):
+			with stage('accumulate', volume=t0 + jj):
+				for y, w in zip(timed_iter('load', stacks), ws):
+					WY[jj] += np.conj(w) * forward_fft(y, grid, real)
+			update_progress('[green]Loading images...', 40/n_vols)
+		if reg == 'ggr' and not shared_ref:
+			with stage('operators', reg=reg, volumes=[t0, t1]):
+				DG = np.stack([ggr_spectra(grad_ref[t], grid,
+						dtype=real_dtype(), real=real, cache_dir=cache_dir,
+						tau_percent=tau_percent,
+						quantile_method=quantile_method)[0]
+						for t in range(t0, t1)])
+
+		for reg_weight, x in recons:
+			# one batched solve and inverse transform for the volumes
+			with stage('solve', weight=reg_weight, volumes=[t0, t1]):
+				X = (WY + reg_weight * DG) * inv_den[reg_weight]
+				x[t0:t1] = cropped_inverse_fft(X, grid, [d, n, m], real,
+						keep_negative_values)
+				del X
+			update_progress('[cyan]Reconstructing...',
+					50 * (t1 - t0) / n_vols / len(reg_weights))
+		del WY
+
+	return recons
+
+def downsample_volume(x, factor):
+	# mean over blocks of factor^3 voxels, the volume cropped to an even
+	# number of blocks along each axis, as the high-res lattice is even
+	n = [(d // (2 * factor)) * 2 for d in x.shape]
+	if min(n) == 0:
+		raise ValueError('the volume %s is too small for a preview %d times '
+				'coarser' % (list(x.shape), factor))
+	x = np.asarray(x[:n[0] * factor, :n[1] * factor, :n[2] * factor],
+			dtype=np.float32)
+	return x.reshape(n[0], factor, n[1], factor, n[2], factor).mean(
+			axis=(1, 3, 5))
+
+def coarse_filters(filters, factor):
+	# the filters on a lattice factor times coarser: the blur factors in
+	# coarse voxels, the spectra being recomputed for the coarse grid, see
+	# expand_fft_win; a blur within one coarse voxel is no blur, as in
+	# make_filters
+	coarse = []
+	for fft_win, axis, blur in filters:
+		if axis == None or blur == None:
+			raise ValueError('the preview needs the separable filters of '
+					'this version of preprocess.py')
+		if blur / factor > 1:
+			coarse.append((fft_win, axis, blur / factor))
+		else:
+			coarse.append((np.ones(1, dtype=np.float32), axis, 1))
+	return coarse
+
+def coarse_reference(ref, factor):
+	# the lattice of downsample_volume: spacing factor times larger, the
+	# first voxel at the centre of the first block
+	size = [(d // (2 * factor)) * 2 for d in ref.GetSize()]
+	img = sitk.Image(size, sitk.sitkFloat32)
+	img.SetSpacing([v * factor for v in ref.GetSpacing()])
+	img.SetDirection(ref.GetDirection())
+	img.SetOrigin(ref.TransformContinuousIndexToPhysicalPoint(
+			[(factor - 1) / 2] * 3))
+	return img
+
+def reconstruct_preview(stacks, filters, grad_ref, factor=2, **options):
+	# pipeline.reconstruct on a lattice factor times coarser, e.g., for a
+	# quick look at a case before its full reconstruction; returns the
+	# (weight, volume) of the coarse lattice, see coarse_reference
+	with stage('preview', factor=factor):
+		return reconstruct([downsample_volume(y, factor) for y in stacks],
+				coarse_filters(filters, factor),
+				downsample_volume(grad_ref, factor), **options)[0]
+
+def reference_size(filename, size=None):
+	# size of the high-res lattice of a case, from the header of its first
+	# low-res image only, as make_reference would compute it
+	if size != None:
+		new_sz = np.array(size)
+		new_sz[new_sz % 2 == 1] -= 1
+		return new_sz.tolist()
+	reader = sitk.ImageFileReader()
+	reader.SetFileName(filename)
+	reader.ReadImageInformation()
+	spacing = np.array(reader.GetSpacing())
+	sz = np.array(reader.GetSize())
+	new_sz = np.floor(spacing / min(spacing) * sz).astype(np.int64)
+	new_sz[new_sz % 2 == 1] -= 1
+	return new_sz.tolist()
+
+def deconvolution_memory(sz, real=True, fast_padding=False, edge=False):
+	# coarse model of the peak memory (bytes) of the in-core deconvolution
+	# on a high-res lattice of size sz: about 7 complex spectra (WY, DG, the
+	# spectrum of the current image and the temporaries of the solve) and
+	# 4 real ones (WW, DD and the cached operators) on the padded grid, in
+	# the precision of set_precision; the edge-enhanced GGR holds 4 more
+	# complex ones (the partial transforms of ggr_edge_spectra)
+	grid = padded_grid(sz, fast_padding, real)
+	n_spectrum = np.prod(spectrum_shape(grid, real), dtype=np.float64)
+	return n_spectrum * ((11 if edge else 7) * np.dtype(complex_dtype()).itemsize
+			+ 4 * np.dtype(real_dtype()).itemsize)
+
+def operator_memory(sz, reg='ggr', real=True, fast_padding=False):
+	# memory (bytes) of the regularization operators of a lattice of size
+	# sz, as kept by the operator cache: DD and, for GGR, DS, both real
+	# spectra on the padded grid
+	grid = padded_grid(sz, fast_padding, real)
+	n_spectrum = np.prod(spectrum_shape(grid, real), dtype=np.float64)
+	n_operators = 2 if reg == 'ggr' else 1
+	return n_spectrum * n_operators * np.dtype(real_dtype()).itemsize
+
+def estimate_peak_memory(sz, n_imgs, real=True, fast_padding=False,
+		memory_budget=None, edge=False):
+	# coarse model of the peak memory (bytes) of GGRReconstructor: the
+	# deconvolution, capped by memory_budget as it then runs out of core
+	# (except the edge-enhanced GGR), and the high-res images kept in
+	# memory by the preprocessing
+	n_voxels = np.prod(sz, dtype=np.float64)
+	deconv = deconvolution_memory(sz, real, fast_padding, edge)
+	if memory_budget != None and not edge:
+		deconv = min(deconv, memory_budget)
+	return deconv + (2 * n_imgs + 2) * n_voxels * 4
+
+# =========== End-to-end pipeline =============
+class GGRReconstructor:
+	# Preprocessing and deconvolution of GGR-recon in a single process,
+	# without the files of the working folder:
+	#
+	#   recon = GGRReconstructor(reg='ggr', reg_weights=0.03)
+	#   img = recon([img_ax, img_cor, img_sag]) # SimpleITK images or filenames
+	#
+	# NumPy arrays (z, y, x) are accepted as well, with their spacings
+	# (x, y, z) given by preprocess(stacks, spacings=...). The
+	# registration runs crlRigidRegistration in a temporary folder unless
+	# working_path is set, or SimpleITK in process with
+	# registration='sitk'. The FFT backend and the precision are
+	# process-wide, see set_fft_backend and set_precision.
+	#
+	# With upsampling='fourier', the stacks are taken as aligned, e.g.,
+	# acquired in one session on the geometry of the first one: they are
+	# not registered, and are interpolated onto the high-res lattice by
+	# zero-padding their spectra rather than by BSpline.
+
+	def __init__(self, reg='ggr', reg_weights=0.1, select_method=None,
+			size=None, keep_negative_values=False, real=True,
+			fast_padding=False, threads=None, registration_workers=None,
+			registration_timeout=None, working_path=None, cache_dir=None,
+			memory_budget=None, tau_percent=None,
+			quantile_method='histogram', tile_size=None, tile_halo=None,
+			tile_workers=None, upsampling='bspline', registration='crl',
+			registration_threads=None):
+		if reg not in ['ggr', 'tik']:
+			raise ValueError('reg should be ggr or tik, not %s' % reg)
+		if tau_percent != None and reg != 'ggr':
+			raise ValueError('the edge enhancement only applies to ggr')
+		if tau_percent != None and not 0 < tau_percent < 1:
+			raise ValueError('tau_percent should be in (0, 1)')
+		if quantile_method not in ['histogram', 'select']:
+			raise ValueError('quantile_method should be histogram or select')
+		if np.isscalar(reg_weights):
+			reg_weights = [reg_weights]
+		if np.any(np.array(reg_weights) <= 0):
+			raise ValueError('the regularization weights should be positive')
+		if select_method not in [None, 'lcurve', 'gcv']:
+			raise ValueError('select_method should be lcurve or gcv')
+		if select_method == 'lcurve' and len(set(reg_weights)) < 3:
+			raise ValueError('the L-curve criterion requires at least 3 weights')
+		if size != None and (len(size) != 3 or np.any(np.array(size) <= 0)):
+			raise ValueError('size should comprise 3 positive integers')
+		if tile_size != None and np.any(np.array(tile_size) <= 0):
+			raise ValueError('tile_size should be positive')
+		if tile_size != None and select_method != None:
+			raise ValueError('the weight selection is not available with tiles')
+		if upsampling not in ['bspline', 'fourier']:
+			raise ValueError('upsampling should be bspline or fourier')
+		if registration not in ['crl', 'sitk']:
+			raise ValueError('registration should be crl or sitk')
+
+		self.reg = reg
+		self.reg_weights = list(reg_weights)
+		self.select_method = select_method
+		self.size = size
+		self.keep_negative_values = keep_negative_values
+		self.real = real
+		self.fast_padding = fast_padding
+		self.threads = threads
+		self.registration_workers = registration_workers
+		self.registration_timeout = registration_timeout
+		self.working_path = working_path
+		self.cache_dir = cache_dir
+		self.memory_budget = memory_budget
+		self.tau_percent = tau_percent
+		self.quantile_method = quantile_method
+		self.tile_size = tile_size
+		self.tile_halo = tile_halo
+		self.tile_workers = tile_workers
+		self.upsampling = upsampling
+		self.registration = registration
+		self.registration_threads = registration_threads
+
+		self.reference = None
+		self.stacks = None
+		self.series = None
+		self.filters = None
+		self.mean = None
+		self.criteria = None
+
+	def __call__(self, stacks, spacings=None):
+		# returns the reconstruction, or a list of (weight, image) for a
+		# sweep of several weights without selection
+		self.preprocess(stacks, spacings)
+		recons = self.reconstruct()
+		if len(recons) == 1:
+			return recons[0][1]
+		return recons
+
+	def preprocess(self, stacks, spacings=None):
+		imgs = [None] * len(stacks)
+		fns = []
+		for ii, s in enumerate(stacks):
+			if isinstance(s, sitk.Image):
+				imgs[ii] = sitk.Cast(sitk.DICOMOrient(s, 'LPS'), sitk.sitkFloat32)
+			elif isinstance(s, np.ndarray):
+				img = sitk.GetImageFromArray(s.astype(np.float32))
+				if spacings != None:
+					img.SetSpacing([float(v) for v in spacings[ii]])
+				imgs[ii] = img
+			else:
+				fns.append((ii, str(s)))
+		for (ii, fn), img in zip(fns, read_stacks([fn for _, fn in fns],
+				self.threads)):
+			imgs[ii] = img
+		if len(imgs) == 0:
+			raise ValueError('no image data found')
+
+		ref = make_reference(imgs[0], self.size, self.upsampling)
+		imgs_x = [ref] + resample_stacks(imgs[1:], ref, self.threads,
+				upsampling=self.upsampling)
+		if len(imgs) > 1 and self.upsampling != 'fourier':
+			imgs_x[1:] = self.register(imgs_x)
+
+		self.reference = ref
+		self.stacks = [sitk.GetArrayFromImage(img) for img in imgs_x]
+		self.filters = make_filters(imgs, ref)
+		self.mean = fuse_stacks(self.stacks)
+		return self
+
+	def register(self, imgs_x, transforms=False):
+		# crlRigidRegistration works on files, so the resampled images make a
+		# round trip through the working (or a temporary) folder; with
+		# transforms=True, the transforms are returned along with the images
+		if self.registration == 'sitk':
+			return self.register_in_process(imgs_x, transforms)
+		with tempfile.TemporaryDirectory() as tmp_path:
+			path = self.working_path
+			if path == None:
+				path = tmp_path + '/'
+			names = ['stack%d' % ii for ii in range(0, len(imgs_x))]
+			x_fns = [path + s + '_x.nii' for s in names]
+			write_images(imgs_x, x_fns, self.threads)
+
+			reg_fns = [path + 'reg_' + s + '_x.nii' for s in names[1:]]
+			tfm_fns = [path + 'tfm2_' + s + '.tfm' for s in names[1:]]
+			with stage('register', n_imgs=len(imgs_x)):
+				for ii in register_stacks(x_fns[0], x_fns[1:], reg_fns,
+						tfm_fns, self.registration_workers,
+						self.registration_timeout):
+					pass
+			if transforms:
+				return [imread(fn) for fn in reg_fns], \
+						[sitk.ReadTransform(fn) for fn in tfm_fns]
+			return [imread(fn) for fn in reg_fns]
+
+	def register_in_process(self, imgs_x, transforms=False):
+		# register with sitk_rigid_register, without files
+		def register(img):
+			tfm = sitk_rigid_register(imgs_x[0], img,
+					self.registration_threads, self.registration_timeout)
+			return resample_img_like(img, imgs_x[0], tfm), tfm
+		# as in register_stacks, a failure does not wait for the running
+		# registrations
+		pool = ThreadPoolExecutor(max_workers=default_registration_workers(
+				self.registration_workers))
+		with stage('register', n_imgs=len(imgs_x)):
+			try:
+				jobs = [pool.submit(register, img) for img in imgs_x[1:]]
+				regs = []
+				for ii, job in enumerate(jobs):
+					try:
+						regs.append(job.result())
+					except RuntimeError as e:
+						raise RuntimeError('failed to align stack %d: %s' \
+								% (ii + 1, e))
+			finally:
+				pool.shutdown(wait=False, cancel_futures=True)
+		if transforms:
+			return [r[0] for r in regs], [r[1] for r in regs]
+		return [r[0] for r in regs]
+
+	def preprocess_series(self, series, per_volume_reference=False):
+		# series: per stack orientation, a 4D image (SimpleITK or filename)
+		#         or a list of 3D images, all with the same number of
+		#         volumes acquired on the same geometry, see read_series
+		# per_volume_reference: one fused reference per volume instead of
+		#                       the fusion of all the volumes
+		#
+		# the first volume of each orientation is registered, and its
+		# transform is reused by the other volumes
+		with stage('reorient', n_imgs=len(series)):
+			vols = [read_series(s) for s in series]
+		n_vols = len(vols[0])
+		if n_vols == 0 or any(len(v) != n_vols for v in vols):
+			raise ValueError('the series should have the same number of volumes')
+
+		ref = make_reference(vols[0][0], self.size, self.upsampling)
+		tfms = None
+		if len(vols) > 1 and self.upsampling != 'fourier':
+			imgs_x = [ref] + resample_stacks([v[0] for v in vols[1:]], ref,
+					self.threads)
+			tfms = [None] * len(vols)
+			_, tfms[1:] = self.register(imgs_x, transforms=True)
+
+		self.reference = ref
+		self.series = []
+		for t in range(0, n_vols):
+			imgs_x = resample_stacks([v[t] for v in vols], ref, self.threads,
+					tfms, self.upsampling)
+			self.series.append([sitk.GetArrayFromImage(img) for img in imgs_x])
+		self.filters = make_filters([v[0] for v in vols], ref)
+		if per_volume_reference:
+			self.mean = [fuse_stacks(stacks) for stacks in self.series]
+		else:
+			self.mean = fuse_stacks(itertools.chain(*self.series))
+		return self
+
+	def reconstruct_series(self, progress=None, task=None):
+		# returns, per weight, the list of the reconstructed volumes
+		if self.series == None:
+			raise RuntimeError('call preprocess_series before reconstruct_series')
+		if self.select_method != None:
+			raise ValueError('the weight selection is not available for series')
+
+		with stage('reconstruct', reg=self.reg, n_vols=len(self.series)):
+			recons = reconstruct_series(self.series, self.filters, self.mean,
+					reg=self.reg, reg_weights=self.reg_weights,
+					keep_negative_values=self.keep_negative_values,
+					real=self.real, fast_padding=self.fast_padding,
+					cache_dir=self.cache_dir, memory_budget=self.memory_budget,
+					tau_percent=self.tau_percent,
+					quantile_method=self.quantile_method,
+					progress=progress, task=task)
+		return [(w, [np_to_img(v, self.reference) for v in x])
+				for w, x in recons]
+
+	def preview(self, factor=2):
+		# the reconstruction on a lattice factor times coarser, reusing the
+		# preprocessed stacks; returns a list of (weight, image)
+		if self.stacks == None:
+			raise RuntimeError('call preprocess before preview')
+		recons = reconstruct_preview(self.stacks, self.filters, self.mean,
+				factor, reg=self.reg, reg_weights=self.reg_weights,
+				select_method=self.select_method,
+				keep_negative_values=self.keep_negative_values,
+				real=self.real, fast_padding=self.fast_padding,
+				cache_dir=self.cache_dir, memory_budget=self.memory_budget,
+				tau_percent=self.tau_percent,
+				quantile_method=self.quantile_method)
+		ref = coarse_reference(self.reference, factor)
+		return [(w, np_to_img(x, ref)) for w, x in recons]
+
+	def reconstruct(self, progress=None, task=None):
+		if self.stacks == None:
+			raise RuntimeError('call preprocess before reconstruct')
+
+		with stage('reconstruct', reg=self.reg):
+			recons, self.criteria = reconstruct(self.stacks, self.filters,
+					self.mean, reg=self.reg, reg_weights=self.reg_weights,
+					select_method=self.select_method,
+					keep_negative_values=self.keep_negative_values,
+					real=self.real, fast_padding=self.fast_padding,
+					cache_dir=self.cache_dir, memory_budget=self.memory_budget,
+					scratch_dir=self.working_path,
+					tau_percent=self.tau_percent,
+					quantile_method=self.quantile_method,
+					tile_size=self.tile_size, tile_halo=self.tile_halo,
+					tile_workers=self.tile_workers,
+					progress=progress, task=task)
+		return [(w, np_to_img(x, self.reference)) for w, x in recons]
+
+def run_case(stacks, out_path, options, size=None):
+	# preprocess and reconstruct one case and write img_mean and the
+	# reconstructions to out_path, as preprocess.py and recon.py do;
+	# returns the output filenames and the elapsed time
+	t0 = time.time()
+	recon = GGRReconstructor(size=size, **options)
+	recon.preprocess(stacks)
+
+	if not os.path.isdir(out_path):
+		os.makedirs(out_path)
+	ext = split_filename(str(stacks[0]))[2]
+	if ext == '.':
+		ext = '.nii.gz'
+	out_fns = [out_path + 'img_mean' + ext]
+	write_images([np_to_img(recon.mean, recon.reference)], out_fns)
+	for reg_weight, img in recon.reconstruct():
+		out_fns.append(out_path + output_name(recon.reg, reg_weight,
+				recon.tau_percent) + ext)
+		write_images([img], out_fns[-1:])
+	return out_fns, time.time() - t0
+
+# =========== Command line =============
+# the options shared by recon.py and series.py
+def add_regularization_arguments(parser):
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument('--ggr', action='store_true',
+			help='use GGR regularization, default')
+	group.add_argument('--tik', action='store_true',
+			help='use Tikhonov regularization')
+	parser.add_argument('-w', '--reg-weight', nargs='+',
+			help='weight(s) of the regularization, by default is 0.1; \
+					one reconstruction is generated per weight, \
+					e.g., -w 0.01 0.03 0.1',
+			type=float, default=[0.1])
+	parser.add_argument('--edge-enhance', nargs='?', type=float, const=0.8,
+			metavar='TAU',
+			help='edge-enhanced GGR: the gradients of the reference below \
+					the TAU quantile of their magnitude are attenuated, \
+					by default TAU is 0.8 when given, e.g., --edge-enhance 0.9')
+	parser.add_argument('--quantile-method', choices=['histogram', 'select'],
+			help='computation of the quantile of --edge-enhance, by a \
+					histogram and a selection within one of its bins, or by a \
+					selection over all the voxels, by default is histogram',
+			default='histogram')
+	parser.add_argument('--keep-negative-values', action='store_true',
+			help='keep negative voxel values in the reconstructed image, \
+					by default is false', default=False)
+
+def add_deconvolution_arguments(parser):
+	parser.add_argument('--cache-dir',
+			help='folder to cache the regularization operators on disk \
+					across runs, by default only the memory is used')
+	parser.add_argument('--cache-size', type=float, default=2,
+			help='size (GB) of the operator cache on disk, the least \
+					recently used operators are removed beyond it; \
+					by default is 2')
+	parser.add_argument('--fft-backend', choices=['numpy', 'scipy', 'pyfftw'],
+			help='FFT library, by default is scipy', default='scipy')
+	parser.add_argument('--fft-workers', type=int,
+			help='number of threads of the FFTs (scipy and pyfftw backends), \
+					by default all the CPUs are used', default=-1)
+	parser.add_argument('--precision', choices=['single', 'double'],
+			help='floating-point precision of the deconvolution, single \
+					(float32/complex64) or double (float64/complex128) at \
+					twice the memory, by default is single', default='single')
+	parser.add_argument('--fast-padding', action='store_true',
+			help='zero-pad the images to the next sizes with small prime \
+					factors instead of exactly twice their size, \
+					by default is false', default=False)
+
+def regularization_error(args, reg_weights):
+	# the error of the options of add_regularization_arguments, or None
+	if np.any(np.array(reg_weights) <= 0):
+		return 'the regularization weights should be positive'
+	if args.edge_enhance != None:
+		if args.tik:
+			return '--edge-enhance only applies to the GGR regularization'
+		if not 0 < args.edge_enhance < 1:
+			return 'the quantile of --edge-enhance should be in (0, 1)'
+	return None
+
+def setup_deconvolution(args, fft_wisdom=None):
+	# the FFT backend, the precision and the operator cache of the options
+	# of add_deconvolution_arguments; raises ValueError, e.g., if pyFFTW is
+	# missing
+	set_fft_backend(args.fft_backend, args.fft_workers, fft_wisdom)
+	set_precision(args.precision)
+	set_operator_disk_cache_size(args.cache_size * 2**30)
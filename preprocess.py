@@ -7,9 +7,13 @@ from scipy import signal
 import os
 import time
 import argparse
-import pathlib
+import itertools
+import shutil
 
 from utils import *
+from pipeline import *
+from profiling import start_report, finish_report, stage, record
+from artifacts import ArtifactCache, artifact_key, file_digest
 
 from rich.console import Console
 from rich import box
@@ -33,6 +37,50 @@ parser.add_argument('-r', '--resample', action='store_true',
 		help='resample the first low-res image in the high-res lattice \
 				and then exit. Usually used for determining a user \
 				defined size of the high-res reconstruction')
+parser.add_argument('-j', '--threads', type=int,
+		help='number of images reoriented and resampled concurrently, \
+				by default is chosen from the number of CPUs')
+parser.add_argument('--registration-workers', type=int,
+		help='number of registrations run concurrently, \
+				by default is the number of CPUs up to 4')
+parser.add_argument('--registration', choices=['crl', 'sitk'], default='crl',
+		help='registration engine: the crlRigidRegistration program, or \
+				SimpleITK in process with a multi-resolution pyramid and a \
+				sampled metric; by default is crl')
+parser.add_argument('--registration-threads', type=int,
+		help='threads of each in-process registration, \
+				by default all the CPUs are used')
+parser.add_argument('--registration-timeout', type=float,
+		help='time limit of each registration in seconds, \
+				by default there is no limit')
+parser.add_argument('--report',
+		help='JSON file to write the time, memory and array sizes of each \
+				stage of the preprocessing to')
+parser.add_argument('--profile',
+		help='file to write the cProfile statistics of the run to')
+parser.add_argument('--trace-memory', action='store_true',
+		help='trace the memory allocations with tracemalloc in the report, \
+				by default is false', default=False)
+parser.add_argument('--artifact-cache',
+		help='folder of the cache of the resampled, registered and fused \
+				images, reused by the runs with the same input images and \
+				parameters, by default no cache is used')
+parser.add_argument('--artifact-cache-size', type=float, default=20,
+		help='size (GB) of the artifact cache, the least recently used \
+				artifacts are removed beyond it; by default is 20')
+parser.add_argument('--fourier-upsampling', action='store_true',
+		help='the low-res images are aligned, on the grid of the first one: \
+				skip the registration, and interpolate them onto the \
+				high-res lattice by zero-padding their spectra in recon.py \
+				instead of writing BSpline-resampled images; by default \
+				is false', default=False)
+parser.add_argument('--working-format', choices=['nifti', 'npy'],
+		default='nifti',
+		help='format of the images of the working folder: that of the \
+				inputs, or uncompressed .npy arrays with a JSON geometry \
+				sidecar, memory-mapped by recon.py (the images exchanged \
+				with crlRigidRegistration are then uncompressed NIfTI); \
+				by default is nifti')
 parser.add_argument('-p', '--path', default='/opt/GGR-recon/data/')
 parser.add_argument('-w', '--working_path', default='/opt/GGR-recon/working/')
 parser.add_argument('-o', '--out_path', default='/opt/GGR-recon/recons/')
@@ -40,14 +88,21 @@ args = parser.parse_args()
 flist = args.filenames
 sz = args.size
 resample_only = args.resample
+upsampling = 'fourier' if args.fourier_upsampling else 'bspline'
+threads = args.threads
+registration_workers = args.registration_workers
+registration_timeout = args.registration_timeout
 
 n_imgs = len(flist)
+if args.report != None or args.profile != None:
+	start_report('preprocess', trace_memory=args.trace_memory,
+			profile_fn=args.profile)
 
 if n_imgs == 0:
 	print('No image data found!')
 	exit()
 
-if sz != None and (len(sz) != n_imgs or np.any(np.array(sz) <= 0)):
+if sz != None and (len(sz) != 3 or np.any(np.array(sz) <= 0)):
 	print('SIZE =', sz)
 	print('Error: SIZE should comprise positive integers')
 	exit()
@@ -69,49 +124,80 @@ img_path = []
 img_fn = []
 img_ext = []
 
-
 for filename in flist:
-    fpname =  pathlib.PurePosixPath(filename)
-    base, first_dot, rest = fpname.name.partition('.')
-    #filename = filename.with_name(base)
-    p = str(fpname.parent)
-    if not p.endswith('/'):
-        p += '/'
-    img_path.append( p )
-    img_fn.append( str(base) )
-    img_ext.append( '.'+str(rest) )
+	p, base, ext = split_filename(filename)
+	img_path.append(p)
+	img_fn.append(base)
+	img_ext.append(ext)
+
+# extensions of the images of the working folder; the outputs keep those of
+# the inputs
+if args.working_format == 'nifti':
+	work_ext = img_ext
+elif args.registration == 'crl' and upsampling != 'fourier':
+	work_ext = ['.nii'] * n_imgs
+else:
+	work_ext = ['.npy'] * n_imgs
+
+def artifact_files(name, fn):
+	# the files {name: filename} of an image in the artifact cache, with
+	# the sidecar of an array
+	files = {name: fn}
+	if fn.endswith('.npy'):
+		files[name[:-len('.npy')] + '.json'] = sidecar_fn(fn)
+	return files
 
 console = Console()
 print_header(console)
 
-# step 0: make the orientations the same for all LR images
+in_fns = [img_path[ii] + img_fn[ii] + img_ext[ii] for ii in range(0, n_imgs)]
+for fn in in_fns:
+	print(fn)
+
+# the artifacts of each step are looked up in the cache by a hash of the
+# input images and of the parameters they depend on, and only the missing
+# ones are computed
+cache = None
+if args.artifact_cache != None:
+	cache = ArtifactCache(args.artifact_cache,
+			args.artifact_cache_size * 2**30)
+	with stage('hash', n_imgs=n_imgs):
+		key_x = artifact_key('resample', version,
+				[file_digest(fn) for fn in in_fns], work_ext, sz)
+
+x_fns = [working_path + img_fn[ii] + '_x' + work_ext[ii]
+		for ii in range(0, n_imgs)]
+h_fns = [working_path + 'h_' + img_fn[ii] + '.mat' for ii in range(0, n_imgs)]
+x_files = {}
 for ii in range(0, n_imgs):
-  inputVolume = img_path[ii] + img_fn[ii] + img_ext[ii]
-  outputVolume = working_path + img_fn[ii] + img_ext[ii]
-  print(str(inputVolume))
-  print(str(outputVolume))
-  reader = sitk.ImageFileReader()
-  reader.SetFileName( inputVolume )
-  inputImage = reader.Execute();
-  # Now we clone the input image.
-  reorientedImage = sitk.DICOMOrient( inputImage, 'LPS' )
-  writer = sitk.ImageFileWriter()
-  writer.SetFileName( outputVolume )
-  writer.Execute( reorientedImage )
-
-#print('completed step 0')
-#print('\t- make the orientations the same for all LR images')
-
-
-# step 1: resample the images
-img0 = imread(working_path + img_fn[0] + img_ext[0])
-if sz == None:
-	img0x = resample_iso_img(img0)
-	sz = img0x.GetSize()
+	x_files.update(artifact_files('x%d%s' % (ii, work_ext[ii]), x_fns[ii]))
+	x_files['h%d.mat' % ii] = h_fns[ii]
+# nothing is cached with the Fourier upsampling, which neither resamples
+# nor registers
+cached_x = cache != None and not resample_only and upsampling != 'fourier' \
+		and cache.restore(key_x, x_files)
+
+if cached_x:
+	console.print('[green]Reusing the cached resampled images and filters')
+	img0x = imread(x_fns[0])
 else:
-	img0x = resample_iso_img_with_size(img0, sz)
+	# step 0: make the orientations the same for all LR images
+	# the images are kept in memory for the next steps and the independent
+	# images are read and reoriented concurrently
+	imgs = read_stacks(in_fns, threads)
 
+	#print('completed step 0')
+	#print('\t- make the orientations the same for all LR images')
+
+
+	# step 1: resample the images
+	try:
+		img0x = make_reference(imgs[0], sz, upsampling)
+	except ValueError as e:
+		console.print('[red bold]Error: %s' % e)
+		exit(1)
 sz = img0x.GetSize() # update the variable of image size
+record(size=list(sz), n_imgs=n_imgs, filenames=flist)
 
 # =========== Print summary of the execution =============
 mode = 'Preprocessing'
@@ -140,37 +226,73 @@ if resample_only:
 	console.print('See it at: [green italic]%s' \
 			% out_path + img_fn[0] + '_x' + img_ext[0])
 	console.print('\n\n')
+	finish_report(args.report)
 	exit()
 
-imwrite(img0x, working_path + img_fn[0] + '_x' + img_ext[0])
-
 origin = img0x.GetOrigin()
 spacing = img0x.GetSpacing()
 direction = img0x.GetDirection()
 
-lr_size = np.zeros([3, n_imgs])
-lr_spacing = np.zeros([3, n_imgs])
-lr_size[:,0] = np.array(img0.GetSize(), dtype=np.int64)
-lr_size[lr_size[:,0]%2!=0,0] -= 1
-lr_spacing[:,0] = np.array(img0.GetSpacing())
-for ii in track(range(1, n_imgs), '[yellow]Resampling images...'):
-	img = imread(working_path + img_fn[ii] + img_ext[ii])
-	lr_spacing[:,ii] = np.array(img.GetSpacing())
-	lr_size[:,ii] = np.array(img.GetSize())
+if upsampling == 'fourier':
+	# the reoriented low-res images are written instead of the high-res
+	# ones, and recon.py interpolates them onto the lattice of img_mean;
+	# the fusion interpolates them here one at a time
+	lr_fns = [img_fn[ii] + '_lr' + work_ext[ii] for ii in range(0, n_imgs)]
+	try:
+		z = fuse_stacks(itertools.chain([sitk.GetArrayFromImage(img0x)],
+				(sitk.GetArrayFromImage(fourier_resample_like(img, img0x))
+				for img in track(imgs[1:], '[medium_purple]Fusing images...'))))
+	except ValueError as e:
+		console.print('[red bold]Error: %s' % e)
+		exit(1)
+	write_images(imgs + [np_to_img(z, img0x)],
+			[working_path + fn for fn in lr_fns] \
+			+ [out_path + 'img_mean' + img_ext[0]], threads)
+
+	filters = make_filters(imgs, img0x)
+	with stage('write', n_imgs=n_imgs):
+		for ii in track(range(0, n_imgs), '[cyan]Creating filters...'):
+			save_filter(h_fns[ii], filters[ii])
+	savemat(working_path + 'geo_property.mat', {'sz': sz, 'origin': origin, \
+			'spacing': spacing, 'direction': direction})
+	with open(working_path + 'data_fn.txt', 'w') as f:
+		for ii, fn in enumerate(lr_fns):
+			f.write('%s,%s,fourier\n' % (fn, 'h_'+img_fn[ii]+'.mat'))
 
-	lr_size[:,ii] = np.minimum(lr_size[:,ii],
-			np.around(spacing / lr_spacing[:,ii] * sz)).astype(np.int64)
-	lr_size[lr_size[:,ii]%2!=0,ii] -= 1
+	console.print('\n')
+	console.print('THE PRE-PROCESSING HAS BEEN COMPLETED.')
+	finish_report(args.report)
+	if args.report != None:
+		console.print('See the report at: [cyan italic]%s' % args.report)
+	console.print('\n')
+	exit()
 
-	I = resample_img_like(img, img0x)
-	imwrite(I, working_path + img_fn[ii] + '_x' + img_ext[ii])
+if not cached_x:
+	# the resampled images are only written for the registration of step 2
+	imgs_x = [img0x] + resample_stacks(imgs[1:], img0x, threads)
+	write_images(imgs_x, x_fns, threads)
+	del imgs_x
+
+	# step 3: create filters for deconvolution
+	# just the 1D spectrum of each filter and its axis are stored, and
+	# recon.py broadcasts them onto the high-res grid
+	filters = make_filters(imgs, img0x)
+	with stage('write', n_imgs=n_imgs):
+		for ii in track(range(0, n_imgs), '[cyan]Creating filters...'):
+			save_filter(h_fns[ii], filters[ii])
+	del imgs
+	if cache != None:
+		cache.save(key_x, x_files)
+
+	#print('completed step 3')
+	#print('\t- create filters for deconvolution')
 
 savemat(working_path + 'geo_property.mat', {'sz': sz, 'origin': origin, \
 		'spacing': spacing, 'direction': direction})
 
 prefix = [''] + ['reg_'] * (n_imgs - 1)
 sufix = ['_x'] * n_imgs
-txt = [''.join(s) for s in zip(*[prefix, img_fn, sufix, img_ext])]
+txt = [''.join(s) for s in zip(*[prefix, img_fn, sufix, work_ext])]
 with open(working_path + 'data_fn.txt', 'w') as f:
 	for ii, fn in enumerate(txt):
 		f.write('%s,%s\n' % (fn, 'h_'+img_fn[ii]+'.mat'))
@@ -179,68 +301,55 @@ with open(working_path + 'data_fn.txt', 'w') as f:
 #print('\t- resample the images')
 
 # step 2: align up all resampled images
-for ii in track(range(1, n_imgs), '[magenta]Aligning images...'):
-	cmd = 'crlRigidRegistration -t 2 %s%s_x%s %s%s_x%s \
-			%sreg_%s_x%s %stfm2_%s.tfm > /dev/null 2>&1' % \
-			(working_path, img_fn[0], img_ext[0], \
-			working_path, img_fn[ii], img_ext[ii], \
-			working_path, img_fn[ii], img_ext[ii], \
-			working_path, img_fn[ii])
-	os.system(cmd)
+reg_fns = [None] + [working_path + txt[ii] for ii in range(1, n_imgs)]
+tfm_fns = [None] + [working_path + 'tfm2_' + img_fn[ii] + '.tfm'
+		for ii in range(1, n_imgs)]
+reg_keys, reg_files, todo = [None], [None], []
+for ii in range(1, n_imgs):
+	if args.registration == 'sitk':
+		engine = ['sitk', sitk.Version_VersionString(), sitk_registration]
+	else:
+		engine = [registration_command, shutil.which(registration_command[0])]
+	reg_keys.append(None if cache == None else artifact_key('register', key_x,
+			ii, *engine))
+	reg_files.append(dict(artifact_files('reg' + work_ext[ii], reg_fns[ii]),
+			**{'tfm2.tfm': tfm_fns[ii]}))
+	if cache == None or not cache.restore(reg_keys[ii], reg_files[ii]):
+		todo.append(ii)
+if len(todo) < n_imgs - 1:
+	console.print('[green]Reusing %d cached registrations' \
+			% (n_imgs - 1 - len(todo)))
+
+try:
+	with stage('register', n_imgs=len(todo)):
+		for jj in track(register_stacks(x_fns[0], [x_fns[ii] for ii in todo],
+				[reg_fns[ii] for ii in todo], [tfm_fns[ii] for ii in todo],
+				registration_workers, registration_timeout,
+				args.registration, args.registration_threads),
+				'[magenta]Aligning images...', total=len(todo)):
+			if cache != None:
+				cache.save(reg_keys[todo[jj]], reg_files[todo[jj]])
+except RuntimeError as e:
+	console.print('[red bold]Error: %s' % e)
+	exit(1)
 #print('completed step 2')
 #print('\t- align up all resampled images')
 
-# step 3: create filters for deconvolution
-for ii in track(range(0, n_imgs), '[cyan]Creating filters...'):
-	fft_win = 1
-	max_factor = -np.inf
-	for jj in range(0, 3):
-		factor = lr_spacing[jj,ii] / spacing[jj]
-		if factor > 1:
-			# FWHM in the unit of number of pixel and convert it to sigma
-			sigma = factor / 2.355
-			filter_len = sz[jj] *2
-			gw = signal.windows.gaussian(filter_len, std=sigma)
-			gw /= np.sum(gw)
-			# put it onto 3D space
-			shape = np.ones(3, dtype=np.int64)
-			shape[jj] = filter_len
-			gw = np.reshape(gw, shape)
-			gw = np.roll(gw, -filter_len//2, axis=jj)
-			# move it to Fourier domain
-			GW = np.abs(fftn(gw, [sz[0]*2, sz[1]*2, sz[2]*2]))
-
-			w1_sz = np.array([sz[0]*2, sz[1]*2, sz[2]*2], dtype=np.int64)
-			w1_sz[jj] = lr_size[jj,ii]# // 2
-			w0_sz = np.array([sz[0]*2, sz[1]*2, sz[2]*2], dtype=np.int64)
-			w0_sz[jj] -= lr_size[jj,ii]*2
-			w = np.concatenate([np.ones(w1_sz), \
-					np.zeros(w0_sz), np.ones(w1_sz)], axis=jj)
-			#w = np.abs(fftn(ifftn(w), [sz[0]*2, sz[1]*2, sz[2]*2]))
-			#fft_win *= np.transpose(w * GW + 1j * w * GW, axes=[2,1,0])
-			if max_factor < factor:
-				#fft_win = np.transpose(w * GW + 1j * w * GW, axes=[2,1,0])
-				fft_win = np.transpose(GW, axes=[2,1,0])
-				max_factor = factor
-
-	savemat(working_path+'h_'+img_fn[ii]+'.mat', {'fft_win': fft_win})
-
-#print('completed step 3')
-#print('\t- create filters for deconvolution')
-
 # step 4: volume fusion
-z = sitk.GetArrayFromImage(img0x)
-L = np.ones_like(z)
-for ii in track(range(1, n_imgs), '[medium_purple]Fusing images...'):
-	img = imread(working_path + 'reg_' + img_fn[ii] + '_x' + img_ext[ii])
-	a = sitk.GetArrayFromImage(img)
-	z += a
-	L += (a != 0).astype(np.float32)
-
-z[L!=0] = z[L!=0] / L[L!=0]
+# the aligned images are read one at a time as they are fused
+mean_fn = out_path + 'img_mean' + img_ext[0]
+mean_key = None if cache == None else artifact_key('fuse', key_x, reg_keys)
+if cache != None and cache.restore(mean_key, {'mean' + img_ext[0]: mean_fn}):
+	console.print('[green]Reusing the cached fused image')
+else:
+	z = fuse_stacks(itertools.chain([sitk.GetArrayFromImage(img0x)],
+			(read_voxels(working_path + txt[ii]) for ii in
+			track(range(1, n_imgs), '[medium_purple]Fusing images...'))))
 
-img_z = np_to_img(z, img0x)
-imwrite(img_z, out_path + 'img_mean' + img_ext[0])
+	img_z = np_to_img(z, img0x)
+	write_images([img_z], [mean_fn])
+	if cache != None:
+		cache.save(mean_key, {'mean' + img_ext[0]: mean_fn})
 
 #print('completd step 4')
 #print('\t- volume fusion')
@@ -248,4 +357,7 @@ imwrite(img_z, out_path + 'img_mean' + img_ext[0])
 # rainbow = RainbowHighlighter()
 console.print('\n')
 console.print('THE PRE-PROCESSING HAS BEEN COMPLETED.')
+finish_report(args.report)
+if args.report != None:
+	console.print('See the report at: [cyan italic]%s' % args.report)
 console.print('\n')
@@ -0,0 +1,206 @@
+import numpy as np
+import cProfile
+import contextlib
+import functools
+import json
+import os
+import platform
+import resource
+import time
+import tracemalloc
+
+# Per-stage instrumentation: while a report is active (start_report), each
+# stage() records its wall time, the peak RSS of the process and, with
+# trace_memory, the peak of the memory traced by tracemalloc (which
+# includes the NumPy arrays), along with the sizes given by record(). The
+# stages nest; without an active report they cost nothing.
+#
+#   start_report('recon', trace_memory=False, profile_fn='recon.prof')
+#   with stage('solve', weight=0.1):
+#       ...
+#       record(shape=x.shape)
+#   finish_report('report.json')
+
+_report = None
+
+def peak_rss():
+	# peak resident set size (bytes) since the last reset_peak_rss
+	return _proc_status('VmHWM:')
+
+def current_rss():
+	return _proc_status('VmRSS:')
+
+def _proc_status(key):
+	try:
+		with open('/proc/self/status', 'r') as f:
+			for line in f:
+				if line.startswith(key):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	# ru_maxrss is in kB on Linux and never reset
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def reset_peak_rss():
+	# reset the peak resident set size of the process (Linux only)
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+	except OSError:
+		pass
+
+class Report:
+	def __init__(self, name, trace_memory=False, profile_fn=None):
+		self.name = name
+		self.trace_memory = trace_memory
+		self.profile_fn = profile_fn
+		self.info = {}
+		self.stages = []
+		# the open stages, innermost last
+		self.open = []
+		self.t0 = time.perf_counter()
+		self.start_time = time.time()
+		self.profiler = None
+		if trace_memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+		if profile_fn != None:
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+
+	def _fold_peaks(self):
+		# the peaks since the last reset belong to all the open stages
+		rss = peak_rss()
+		traced = tracemalloc.get_traced_memory()[1] \
+				if self.trace_memory else None
+		for s in self.open:
+			s['peak_rss'] = max(s['peak_rss'], rss)
+			if traced != None:
+				s['peak_traced'] = max(s['peak_traced'], traced)
+
+	def _reset_peaks(self):
+		reset_peak_rss()
+		if self.trace_memory:
+			tracemalloc.reset_peak()
+
+	def enter(self, name, info):
+		self._fold_peaks()
+		s = {'name': name, 'parent': self.open[-1]['name']
+				if len(self.open) > 0 else None,
+				'start': time.perf_counter() - self.t0, 'time': None,
+				'rss_start': current_rss(), 'peak_rss': 0, 'info': info}
+		if self.trace_memory:
+			s['peak_traced'] = 0
+		self.stages.append(s)
+		self.open.append(s)
+		self._reset_peaks()
+		return s
+
+	def exit(self, s):
+		self._fold_peaks()
+		s['time'] = time.perf_counter() - self.t0 - s['start']
+		self.open.remove(s)
+		self._reset_peaks()
+
+	def summary(self):
+		# time, count and peaks aggregated by stage name
+		total = {}
+		for s in self.stages:
+			t = total.setdefault(s['name'], {'count': 0, 'time': 0,
+					'peak_rss': 0})
+			t['count'] += 1
+			t['time'] += s['time'] if s['time'] != None else 0
+			t['peak_rss'] = max(t['peak_rss'], s['peak_rss'])
+			if 'peak_traced' in s:
+				t['peak_traced'] = max(t.get('peak_traced', 0),
+						s['peak_traced'])
+		return total
+
+	def to_dict(self):
+		return {'name': self.name, 'start_time': self.start_time,
+				'elapsed': time.perf_counter() - self.t0,
+				'host': platform.node(), 'cpu_count': os.cpu_count(),
+				'info': self.info, 'summary': self.summary(),
+				'stages': self.stages}
+
+def _json_default(o):
+	if isinstance(o, np.generic):
+		return o.item()
+	if isinstance(o, np.ndarray):
+		return o.tolist()
+	return str(o)
+
+def start_report(name, trace_memory=False, profile_fn=None):
+	# start collecting the stages of this process
+	global _report
+	_report = Report(name, trace_memory, profile_fn)
+	return _report
+
+def finish_report(fn=None):
+	# stop collecting, write the JSON report to fn and the cProfile
+	# statistics to the profile_fn of start_report; returns the report
+	global _report
+	report, _report = _report, None
+	if report == None:
+		return None
+	if report.profiler != None:
+		report.profiler.disable()
+		report.profiler.dump_stats(report.profile_fn)
+	if report.trace_memory:
+		tracemalloc.stop()
+	d = report.to_dict()
+	if fn != None:
+		with open(fn, 'w') as f:
+			json.dump(d, f, indent=2, default=_json_default)
+	return d
+
+@contextlib.contextmanager
+def _stage(report, name, info):
+	s = report.enter(name, info)
+	try:
+		yield s
+	finally:
+		report.exit(s)
+
+def stage(name, **info):
+	# context manager timing a stage; info: sizes, shapes, etc.
+	if _report == None:
+		return contextlib.nullcontext()
+	return _stage(_report, name, info)
+
+def timed(name=None):
+	# decorator running each call of a function as a stage
+	def decorator(func):
+		stage_name = func.__name__ if name == None else name
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with stage(stage_name):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorator
+
+def timed_iter(name, iterable, **info):
+	# yield the items of iterable, each one produced as a stage, e.g., to
+	# time the images read by a generator as they are consumed
+	it = iter(iterable)
+	end = object()
+	while True:
+		with stage(name, **info) as s:
+			item = next(it, end)
+		if item is end:
+			if s != None:
+				_report.stages.remove(s)
+			return
+		yield item
+
+def record(**info):
+	# add information to the innermost open stage, or to the report
+	if _report == None:
+		return
+	if len(_report.open) > 0:
+		_report.open[-1]['info'].update(info)
+	else:
+		_report.info.update(info)
+
+def nbytes(*arrays):
+	# total size (bytes) of arrays, ignoring scalars
+	return int(sum(a.nbytes for a in arrays if isinstance(a, np.ndarray)))
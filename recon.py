@@ -14,6 +14,8 @@ import warnings
 warnings.filterwarnings("ignore")
 
 from utils import *
+from pipeline import *
+from profiling import start_report, finish_report, stage, record, timed_iter
 
 from rich.console import Console
 from rich import box
@@ -26,26 +28,109 @@ parser = argparse.ArgumentParser()
 parser.add_argument('-V', '--version', action='version',
 		version='%s version : v %s %s' % (app_name, version, release_date),
 		help='show version')
-group = parser.add_mutually_exclusive_group()
-group.add_argument('--ggr', action='store_true',
-		help='use GGR regularization, default')
-group.add_argument('--tik', action='store_true',
-		help='use Tikhonov regularization')
-parser.add_argument('-w', '--reg-weight',
-		help='weight of the regularization, by default is 0.1',
-		type=float, default=0.1)
-parser.add_argument('--keep-negative-values', action='store_true',
-		help='keep negative voxel values in the reconstructed image, by default is false',
+add_regularization_arguments(parser)
+parser.add_argument('--reg-weight-range', nargs=3, type=float,
+		metavar=('START', 'STOP', 'NUM'),
+		help='sweep NUM weights log-spaced from START to STOP, \
+				overrides -w; e.g., --reg-weight-range 0.001 1 10')
+parser.add_argument('--select-weight', choices=['lcurve', 'gcv'],
+		help='select one of the swept weights automatically by the \
+				L-curve or the generalized cross-validation (GCV) \
+				criterion, and only generate its reconstruction')
+add_deconvolution_arguments(parser)
+parser.add_argument('--full-spectrum', action='store_true',
+		help='solve on the full complex spectrum instead of the half \
+				spectrum of the real-to-complex transform, by default is false',
 		default=False)
+parser.add_argument('--fft-wisdom',
+		help='file to load and save the pyFFTW wisdom (plans) across runs, \
+				by default is ./working/cache/fftw_wisdom.pkl',
+		default='./working/cache/fftw_wisdom.pkl')
+parser.add_argument('--memory-budget', type=float,
+		help='memory (GB) of the deconvolution; when the spectra do not fit \
+				in it they are memory-mapped in the working folder and \
+				processed slab by slab, by default is the available memory')
+parser.add_argument('--tile-size', nargs='+', type=int, metavar='N',
+		help='reconstruct blocks of N voxels (one size, or three in the \
+				numpy order z y x) on a pool of processes and blend them, so \
+				that the memory follows the size of the blocks, e.g., \
+				--tile-size 128')
+parser.add_argument('--tile-halo', nargs='+', type=int, metavar='N',
+		help='voxels added to each side of the blocks shared with another \
+				one, by default twice the reach (3 sigma) of the blur \
+				filters and of the GGR stencil')
+parser.add_argument('--tile-workers', type=int,
+		help='number of blocks reconstructed at once, by default as many \
+				as fit in the memory budget, up to the number of CPUs')
+parser.add_argument('--preview', nargs='?', type=int, const=2,
+		metavar='FACTOR',
+		help='first reconstruct on a lattice FACTOR (2 by default) times \
+				coarser and write it as preview_*, then the full-resolution \
+				reconstruction from the same loaded images')
+parser.add_argument('--report',
+		help='JSON file to write the time, memory and array sizes of each \
+				stage of the reconstruction to')
+parser.add_argument('--profile',
+		help='file to write the cProfile statistics of the run to')
+parser.add_argument('--trace-memory', action='store_true',
+		help='trace the memory allocations with tracemalloc in the report, \
+				by default is false', default=False)
 args = parser.parse_args()
 
-reg_weight = args.reg_weight
-reg = 1 # ggr: 1, tik: 0
+reg_weights = args.reg_weight
+if args.reg_weight_range != None:
+	start, stop, num = args.reg_weight_range
+	reg_weights = np.geomspace(start, stop, int(num)).tolist()
+reg_weights = sorted(set(reg_weights))
+select_method = args.select_weight
+error = regularization_error(args, reg_weights)
+if error != None:
+	print('Error: %s' % error)
+	exit()
+if select_method == 'lcurve' and len(reg_weights) < 3:
+	print('Error: the L-curve criterion requires at least 3 weights')
+	exit()
+reg_name = 'ggr'
 reg_desc = 'GGR'
 if args.tik:
-	reg = 0 # 'tik'
+	reg_name = 'tik'
 	reg_desc = 'Tikhonov'
+tau_percent = args.edge_enhance
+tile_size, tile_halo = args.tile_size, args.tile_halo
+for v in [tile_size, tile_halo]:
+	if v != None and len(v) not in [1, 3]:
+		print('Error: --tile-size and --tile-halo take one or three values')
+		exit()
+if tile_size != None:
+	if np.any(np.array(tile_size) <= 0):
+		print('Error: the size of the blocks should be positive')
+		exit()
+	if select_method != None:
+		print('Error: --select-weight is not available with --tile-size')
+		exit()
+if tau_percent != None:
+	reg_desc = 'GGR (edge %g)' % tau_percent
+if args.preview != None and args.preview < 2:
+	print('Error: the factor of --preview should be at least 2')
+	exit()
 keep_negative_values = args.keep_negative_values
+# all the volumes are real, so their spectra are Hermitian symmetric and
+# the half spectrum (rfftn layout) carries all the information
+real = not args.full_spectrum
+cache_dir = args.cache_dir
+fast_padding = args.fast_padding
+memory_budget = args.memory_budget
+if memory_budget != None:
+	memory_budget *= 2**30
+try:
+	setup_deconvolution(args, args.fft_wisdom)
+except ValueError as e:
+	print('Error: %s' % e)
+	exit()
+
+if args.report != None or args.profile != None:
+	start_report('recon', trace_memory=args.trace_memory,
+			profile_fn=args.profile)
 
 path = './data/'#'/opt/GGR-recon/data/'
 working_path = './working/'#'/opt/GGR-recon/working/'
@@ -61,12 +146,15 @@ if not os.path.isdir(working_path):
 geo = loadmat(working_path + 'geo_property.mat')
 sz = geo['sz'][0]
 
-img_fn, h_fn = [], []
+# an optional third field 'fourier' marks a low-res image interpolated onto
+# the high-res lattice here, see preprocess.py --fourier-upsampling
+img_fn, h_fn, upsampling = [], [], []
 with open(working_path + 'data_fn.txt', 'r') as f:
 	for line in f:
 		fn = line[:-1].split(',')
 		img_fn.append(fn[0])
 		h_fn.append(fn[1])
+		upsampling.append(fn[2] if len(fn) > 2 else None)
 
 n_imgs = len(img_fn)
 
@@ -74,6 +162,13 @@ if n_imgs == 0:
 	print('No image data found!')
 	exit()
 
+record(size=sz.tolist(), n_imgs=n_imgs, reg=reg_name,
+		reg_weights=reg_weights, select_method=select_method,
+		fft_backend=args.fft_backend, fft_workers=args.fft_workers,
+		precision=args.precision, tau_percent=tau_percent,
+		quantile_method=args.quantile_method, tile_size=tile_size,
+		tile_halo=tile_halo)
+
 console = Console()
 # =========== Print summary of the execution =============
 print_header(console)
@@ -86,7 +181,10 @@ table.add_column('Reg. weight', justify='center')
 table.add_column('Image size', justify='center', no_wrap=True)
 table.add_column('# images', justify='center')
 table.add_column('Resolution (mm)', justify='center', no_wrap=True)
-table.add_row(reg_desc, str(reg_weight), str(sz),
+reg_weight_desc = ', '.join('%g' % w for w in reg_weights)
+if select_method != None:
+	reg_weight_desc = '%s of [%s]' % (select_method, reg_weight_desc)
+table.add_row(reg_desc, reg_weight_desc, str(sz),
 		str(n_imgs), str(geo['spacing'][0][0]))
 console.print(table, justify='center')
 console.print('\n')
@@ -105,16 +203,6 @@ def update_progress(task, desc, advance=1):
 with progress:
 	task = progress.add_task('[blue]Starting...', total=100)#, start=False)
 	
-	m, n, d = sz
-	fft_img = np.empty([d*2, n*2, m*2, n_imgs], dtype=np.complex64)
-	w = np.empty_like(fft_img)
-	for ii in range(0, n_imgs):
-		img = imread(working_path + img_fn[ii])
-		fft_img[...,ii] = fftn(sitk.GetArrayFromImage(img), [d*2, n*2, m*2])
-		w[...,ii] = loadmat(working_path + h_fn[ii])['fft_win']
-		
-		update_progress(task, '[green]Loading images...', advance=20/n_imgs)
-	
 	mean_fns = glob.glob(out_path + 'img_mean.*')
 	if len(mean_fns) > 1:
 		console.print('[red bold]Error: Please check you "recons" folder to make sure there is only [i][u]ONE[/u][/i] file named "img_mean", and then run [i]recon.py[/i] again.')
@@ -123,35 +211,109 @@ with progress:
 	mean_fn = mean_fns[0]
 	ext = mean_fn[len(out_path + 'img_mean'):]
 	
-	mean_img = imread(mean_fn)
-	mean_arr = sitk.GetArrayFromImage(mean_img)
+	with stage('load', filename=mean_fn):
+		mean_img = imread(mean_fn)
+		mean_arr = sitk.GetArrayFromImage(mean_img)
 	
-	update_progress(task, '[cyan]Reconstructing...', advance=5)
-	
-	if reg == 1: # ggr: 1, tik: 0
-		fft_x = recon_ggr(fft_img, w, mean_arr,
-				ggr_weight=reg_weight, progress=progress, task=task)
-		out_fn = out_path + 'recon_ggr-w' + str(reg_weight) + ext
-	else:
-		fft_x = recon_tik(fft_img, w,
-				tv_weight=reg_weight, progress=progress, task=task)
-		out_fn = out_path + 'recon_tik-w' + str(reg_weight) + ext
-	
-	#x = np.clip(ifftn(fft_x).real.astype(np.float32), 0, None)
-	#x = np.abs(ifftn(fft_x)).astype(np.float32)
-	if keep_negative_values:
-		x = ifftn(fft_x).real.astype(np.float32)[:d,:n,:m]
-	else:
-		x = np.clip(ifftn(fft_x).real.astype(np.float32), 0, None)[:d,:n,:m]
-	
-	update_progress(task, '[yellow]Saving image...', advance=5)
+	# the images are read one at a time as they are consumed, the .npy
+	# arrays being memory-mapped rather than copied
+	def read_stack(fn, upsampling):
+		if upsampling != 'fourier':
+			return read_voxels(working_path + fn)
+		with stage('resample', filename=fn):
+			return sitk.GetArrayFromImage(fourier_resample_like(
+					imread(working_path + fn), mean_img))
+	stacks = (read_stack(fn, u) for fn, u in zip(img_fn, upsampling))
+	with stage('load', filenames=h_fn):
+		filters = [load_filter(working_path + fn) for fn in h_fn]
+	if tile_size != None:
+		halo = tile_halo if tile_halo != None else default_halo(filters)
+		if np.any(np.broadcast_to(halo, 3) > np.broadcast_to(tile_size, 3)):
+			progress.console.print('[yellow]Warning: the halo (%s voxels) is '
+					'larger than the blocks (%s voxels), which then reach most '
+					'of their neighbours' % tuple('x'.join(str(v) for v in
+					np.broadcast_to(t, 3)) for t in [halo, tile_size]))
+
+	out_fns = []
+	if args.preview != None:
+		# the images are loaded once for both reconstructions
+		stacks = list(timed_iter('load', stacks))
+		update_progress(task, '[cyan]Previewing...', advance=0)
+		try:
+			previews = reconstruct_preview(stacks, filters, mean_arr,
+					args.preview, reg=reg_name, reg_weights=reg_weights,
+					select_method=select_method,
+					keep_negative_values=keep_negative_values, real=real,
+					fast_padding=fast_padding, cache_dir=cache_dir,
+					memory_budget=memory_budget, tau_percent=tau_percent,
+					quantile_method=args.quantile_method)
+		except ValueError as e:
+			progress.stop()
+			console.print('[red bold]Error: %s' % e)
+			exit()
+		coarse_img = coarse_reference(mean_img, args.preview)
+		for reg_weight, x in previews:
+			out_fn = out_path + output_name(reg_name, reg_weight,
+					tau_percent, 'preview') + ext
+			with stage('write', filename=out_fn):
+				imwrite(np_to_img(x, coarse_img), out_fn)
+			progress.console.print('See the preview at: [cyan italic]%s' \
+					% out_fn)
+			out_fns.append(out_fn)
+		del previews
+	try:
+		with stage('reconstruct', reg=reg_name):
+			recons, criteria = reconstruct(stacks, filters, mean_arr,
+					reg=reg_name, reg_weights=reg_weights,
+					select_method=select_method,
+					keep_negative_values=keep_negative_values, real=real,
+					fast_padding=fast_padding, cache_dir=cache_dir,
+					memory_budget=memory_budget, scratch_dir=working_path,
+					tau_percent=tau_percent,
+					quantile_method=args.quantile_method,
+					tile_size=tile_size, tile_halo=tile_halo,
+					tile_workers=args.tile_workers,
+					progress=progress, task=task)
+	except ValueError as e:
+		progress.stop()
+		console.print('[red bold]Error: %s' % e)
+		exit()
+	save_fft_wisdom()
 	
-	img_x = np_to_img(x, mean_img)
-	imwrite(img_x, out_fn)
+	for reg_weight, x in recons:
+		update_progress(task, '[yellow]Saving image...', advance=5/len(recons))
+		
+		out_fn = out_path + output_name(reg_name, reg_weight, tau_percent) \
+				+ ext
+		img_x = np_to_img(x, mean_img)
+		with stage('write', filename=out_fn):
+			imwrite(img_x, out_fn)
+		out_fns.append(out_fn)
 	
 	update_progress(task, '[green bold]Completed! :ok_hand:', advance=5)
 
+if criteria != None:
+	table = Table(title='Regularization weight selection (%s)' % select_method,
+			box=box.HORIZONTALS,
+			show_header=True, header_style='bold magenta')
+	table.add_column('Reg. weight', justify='center')
+	table.add_column('Residual norm', justify='center')
+	table.add_column('Reg. norm', justify='center')
+	table.add_column('GCV', justify='center')
+	swept_weights, rho, eta, gcv = criteria
+	for ii, w in enumerate(swept_weights):
+		style = 'bold green' if w == recons[0][0] else None
+		table.add_row('%g' % w, '%.4g' % rho[ii], '%.4g' % eta[ii],
+				'%.4g' % gcv[ii], style=style)
+	console.print('\n')
+	console.print(table, justify='center')
+
 rainbow = RainbowHighlighter()
 console.print('\n')
 console.print(rainbow('High-res reconstruction has been generated'))
-console.print('See the image at: [cyan italic]%s\n' % out_fn)
+for out_fn in out_fns:
+	console.print('See the image at: [cyan italic]%s' % out_fn)
+finish_report(args.report)
+if args.report != None:
+	console.print('See the report at: [cyan italic]%s' % args.report)
+console.print('\n')
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import SimpleITK as sitk
+import os
+import argparse
+
+import warnings
+warnings.filterwarnings("ignore")
+
+from utils import *
+from pipeline import *
+from profiling import start_report, finish_report, stage, record
+
+from rich.console import Console
+from rich import box
+from rich.table import Table
+from rich.progress import Progress, TextColumn, \
+		BarColumn, TimeElapsedColumn
+
+# Series mode: multi-echo or repeated acquisitions, N volumes per stack
+# orientation on the same geometry, e.g.,
+#
+#   series.py -f ax_echoes.nii.gz cor_echoes.nii.gz sag_echoes.nii.gz
+#
+# Each input is a 4D image of N volumes. The first volume of each
+# orientation is registered and its transform reused by the others; the
+# filters, and so the denominators of the deconvolution, are shared by the
+# volumes, which are solved together. The reconstructions are written as
+# one 4D image per weight, or one file per volume with --split.
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-V', '--version', action='version',
+			version='%s version : v %s %s' % (app_name, version, release_date),
+			help='show version')
+	parser.add_argument('-f', '--filenames', nargs='+', required=True,
+			help='4D low-res images, one per stack orientation, with the same \
+					number of volumes; e.g., -f ax.nii.gz cor.nii.gz sag.nii.gz')
+	parser.add_argument('-s', '--size', nargs='+', type=int,
+			help='size of the high-res reconstruction, optional; \
+					e.g., -s 312 384 330')
+	parser.add_argument('-o', '--out_path', default='./recons/')
+	add_regularization_arguments(parser)
+	parser.add_argument('--per-volume-reference', action='store_true',
+			help='guide the GGR of each volume by its own fused image instead \
+					of the fusion of all the volumes, by default is false',
+			default=False)
+	parser.add_argument('--fourier-upsampling', action='store_true',
+			help='the stacks are aligned, on the grid of the first one: skip \
+					the registration and interpolate them by zero-padding \
+					their spectra instead of BSpline, by default is false',
+			default=False)
+	parser.add_argument('--split', action='store_true',
+			help='write one file per volume instead of a 4D image, \
+					by default is false', default=False)
+	parser.add_argument('--threads', type=int,
+			help='number of images resampled concurrently, \
+					by default is chosen from the number of CPUs')
+	parser.add_argument('--registration', choices=['crl', 'sitk'], default='crl',
+			help='registration engine: crlRigidRegistration, or SimpleITK \
+					in process; by default is crl')
+	parser.add_argument('--registration-timeout', type=float,
+			help='time limit of each registration in seconds')
+	add_deconvolution_arguments(parser)
+	parser.add_argument('--memory-budget', type=float,
+			help='memory (GB) of the deconvolution, which sets how many volumes \
+					are solved together, by default is the available memory')
+	parser.add_argument('--report',
+			help='JSON file to write the time, memory and array sizes of each \
+					stage to')
+	args = parser.parse_args()
+
+	reg_name = 'tik' if args.tik else 'ggr'
+	reg_weights = sorted(set(args.reg_weight))
+	error = regularization_error(args, reg_weights)
+	if error != None:
+		print('Error: %s' % error)
+		exit()
+	out_path = args.out_path
+	if not out_path.endswith('/'):
+		out_path += '/'
+	cache_dir = args.cache_dir
+	memory_budget = args.memory_budget
+	if memory_budget != None:
+		memory_budget *= 2**30
+	try:
+		setup_deconvolution(args)
+		recon = GGRReconstructor(reg=reg_name, reg_weights=reg_weights,
+				size=args.size, keep_negative_values=args.keep_negative_values,
+				fast_padding=args.fast_padding, threads=args.threads,
+				registration_timeout=args.registration_timeout,
+				registration=args.registration,
+				cache_dir=cache_dir, memory_budget=memory_budget,
+				tau_percent=args.edge_enhance,
+				quantile_method=args.quantile_method,
+				upsampling='fourier' if args.fourier_upsampling else 'bspline')
+	except ValueError as e:
+		print('Error: %s' % e)
+		exit()
+
+	if args.report != None:
+		start_report('series')
+	if not os.path.isdir(out_path):
+		os.makedirs(out_path)
+	ext = split_filename(args.filenames[0])[2]
+
+	console = Console()
+	print_header(console)
+
+	with Progress(TextColumn("[progress.description]{task.description}"),
+			"[progress.percentage]({task.percentage:>3.1f}%)",
+			BarColumn(bar_width=None), TimeElapsedColumn(),
+			console=console, refresh_per_second=2) as progress:
+		task = progress.add_task('[blue]Preprocessing...', total=100)
+		try:
+			recon.preprocess_series(args.filenames, args.per_volume_reference)
+		except (RuntimeError, ValueError) as e:
+			progress.stop()
+			console.print('[red bold]Error: %s' % e)
+			exit(1)
+		n_vols = len(recon.series)
+		progress.update(task, advance=5)
+
+		table = Table(title='Summary of %s/series.py execution' % app_name,
+				box=box.HORIZONTALS,
+				show_header=True, header_style='bold magenta')
+		table.add_column('Reg. method', justify='center')
+		table.add_column('Reg. weight', justify='center')
+		table.add_column('Image size', justify='center', no_wrap=True)
+		table.add_column('# images', justify='center')
+		table.add_column('# volumes', justify='center')
+		table.add_row(reg_name.upper(), ', '.join('%g' % w for w in reg_weights),
+				str(list(recon.reference.GetSize())), str(len(args.filenames)),
+				str(n_vols))
+		console.print(table, justify='center')
+		console.print('\n')
+		record(size=list(recon.reference.GetSize()), n_vols=n_vols,
+				reg=reg_name, reg_weights=reg_weights)
+
+		try:
+			recons = recon.reconstruct_series(progress=progress, task=task)
+		except ValueError as e:
+			progress.stop()
+			console.print('[red bold]Error: %s' % e)
+			exit(1)
+		save_fft_wisdom()
+
+		out_fns = []
+		if args.per_volume_reference:
+			means = [np_to_img(z, recon.reference) for z in recon.mean]
+		else:
+			means = [np_to_img(recon.mean, recon.reference)]
+		for reg_weight, imgs in [(None, means)] + recons:
+			name = 'img_mean' if reg_weight == None \
+					else output_name(reg_name, reg_weight, args.edge_enhance)
+			if args.split or len(imgs) == 1:
+				fns = [out_path + name + ('_t%03d' % t if len(imgs) > 1 else '') \
+						+ ext for t in range(0, len(imgs))]
+				write_images(imgs, fns, args.threads)
+			else:
+				# imwrite does not cast 4D images, the volumes are cast first
+				fns = [out_path + name + ext]
+				with stage('write', filename=fns[0]):
+					sitk.WriteImage(sitk.JoinSeries([sitk.Cast(img,
+							sitk.sitkFloat32) for img in imgs]), fns[0])
+			out_fns += fns
+		progress.update(task, description='[green bold]Completed! :ok_hand:',
+				completed=100)
+
+	rainbow = RainbowHighlighter()
+	console.print('\n')
+	console.print(rainbow('High-res reconstructions have been generated'))
+	for out_fn in out_fns:
+		if out_fn.find('recon_') >= 0:
+			console.print('See the image at: [cyan italic]%s' % out_fn)
+	finish_report(args.report)
+	console.print('\n')
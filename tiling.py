@@ -0,0 +1,163 @@
+import numpy as np
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import *
+from profiling import stage, record, timed_iter
+
+# Tiled deconvolution: the high-res lattice is split into blocks, each one
+# extended by a halo on the sides it shares with its neighbours, and every
+# extended block is reconstructed on its own (on a pool of processes) by
+# pipeline.reconstruct. The blocks are blended back with linear ramps
+# across the boundaries, which sum to one, so that the memory follows the
+# size of the blocks rather than the field of view.
+#
+# The halo covers the blur of the filters and the stencil of the GGR
+# shifts, see default_halo; beyond it, a block sees a truncated (zero-padded)
+# neighbourhood, as the whole volume does at its own border. A halo larger
+# than the blocks makes each extended block reach most of its neighbours,
+# and the memory no longer follows the size of the blocks.
+
+def filter_support(h, tol=1e-3):
+	# radius (voxels, numpy order) of the spatial kernel of a filter
+	# (fft_win, axis, factor), beyond which less than tol of its mass lies
+	fft_win, axis, factor = h
+	if axis == None:
+		kernels = [np.abs(np.fft.ifftn(fft_win)).sum(axis=tuple(
+				a for a in range(0, 3) if a != ax)) for ax in range(0, 3)]
+	else:
+		kernels = [np.ones(1)] * 3
+		kernels[axis] = np.abs(np.fft.ifft(np.ravel(fft_win)))
+	support = []
+	for k in kernels:
+		# mass within each radius of the origin, the kernel wraps around
+		i = np.arange(0, k.size)
+		mass = np.cumsum(np.bincount(np.minimum(i, k.size - i), weights=k))
+		support.append(int(np.searchsorted(mass, (1 - tol) * mass[-1])))
+	return support
+
+def default_halo(filters, p=2, scale=2):
+	# halo (voxels, numpy order) of the blocks: scale times the reach of
+	# the widest blur, 3 sigma of its Gaussian, plus the GGR stencil; the
+	# regularized inverse spreads further than the blur itself. The dense
+	# filters of older versions fall back on filter_support.
+	reach = [0, 0, 0]
+	for h in filters:
+		fft_win, axis, factor = h
+		if axis == None or factor == None:
+			reach = list(np.maximum(reach, filter_support(h)))
+		elif np.size(fft_win) > 1:
+			reach[axis] = max(reach[axis],
+					int(np.ceil(3 * factor / 2.355)))
+	return [int(scale * (r + p)) for r in reach]
+
+def tile_bounds(n, tile, halo):
+	# (core start, core stop, start, stop) of the blocks along an axis of
+	# length n, the extended ones clipped to the volume
+	bounds = []
+	for c0 in range(0, n, tile):
+		c1 = min(c0 + tile, n)
+		bounds.append((c0, c1, max(c0 - halo, 0), min(c1 + halo, n)))
+	return bounds
+
+def blend_weights(c0, c1, e0, e1, n, ramp):
+	# 1D weights of a block over its extent [e0, e1): 1 in the core, linear
+	# ramps of width 2*ramp centred on the inner boundaries; the ramps of
+	# two neighbours sum to one
+	i = np.arange(e0, e1) + 0.5
+	w = np.ones(e1 - e0, dtype=np.float32)
+	if ramp > 0:
+		if c0 > 0:
+			w *= np.clip((i - c0 + ramp) / (2 * ramp), 0, 1)
+		if c1 < n:
+			w *= np.clip((c1 + ramp - i) / (2 * ramp), 0, 1)
+	else:
+		w[(i < c0) | (i > c1)] = 0
+	return w
+
+def init_tile_worker(fft_backend_name, fft_workers, precision_name):
+	set_fft_backend(fft_backend_name, fft_workers)
+	set_precision(precision_name)
+
+def reconstruct_tile(fns, filters, region, options):
+	# reconstruct the block region = [(start, stop)] * 3 from the volumes
+	# memory-mapped in fns, the last one being the gradient reference
+	# (imported here, as pipeline imports this module)
+	from pipeline import reconstruct
+	crop = tuple(slice(e0, e1) for e0, e1 in region)
+	arrays = [np.load(fn, mmap_mode='r') for fn in fns]
+	stacks = (np.array(a[crop]) for a in arrays[:-1])
+	recons, _ = reconstruct(stacks, filters, np.array(arrays[-1][crop]),
+			**options)
+	return recons
+
+def reconstruct_tiled(stacks, filters, grad_ref, tile_size, halo=None,
+		workers=None, scratch_dir=None, p=2, update_progress=None,
+		**options):
+	# same as pipeline.reconstruct, block by block
+	# tile_size: size (voxels) of the blocks, one for all the axes or three
+	# halo: voxels added on each inner side, by default default_halo(filters)
+	# workers: number of processes, by default the number of CPUs
+	# options: passed to pipeline.reconstruct for each block
+	if update_progress == None:
+		update_progress = lambda desc, advance: None
+	if options.get('select_method') != None:
+		raise ValueError('the weight selection needs the whole volume, '
+				'it is not available with tiles')
+	if workers == None:
+		workers = os.cpu_count()
+	shape = list(grad_ref.shape)
+	tile_size = list(np.broadcast_to(tile_size, 3))
+	if halo == None:
+		halo = default_halo(filters, p)
+	halo = list(np.broadcast_to(halo, 3))
+	bounds = [tile_bounds(shape[a], int(tile_size[a]), int(halo[a]))
+			for a in range(0, 3)]
+	tiles = [(bz, by, bx) for bz in bounds[0] for by in bounds[1]
+			for bx in bounds[2]]
+	record(tile_size=tile_size, halo=halo, n_tiles=len(tiles),
+			workers=workers)
+
+	fft_name, fft_workers = fft_backend()
+	if fft_workers == None or fft_workers < 1:
+		fft_workers = max(1, os.cpu_count() // workers)
+	with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch_path:
+		# the volumes are memory-mapped by the workers, which only read
+		# their blocks
+		fns = []
+		for ii, y in enumerate(timed_iter('load', stacks)):
+			fns.append(os.path.join(scratch_path, 'stack%d.npy' % ii))
+			np.save(fns[-1], np.asarray(y, dtype=np.float32))
+			del y
+			update_progress('[green]Loading images...', 10/len(filters))
+		fns.append(os.path.join(scratch_path, 'grad_ref.npy'))
+		np.save(fns[-1], np.asarray(grad_ref, dtype=np.float32))
+
+		out, weight_sum = {}, np.zeros(shape, dtype=np.float32)
+		with stage('tiles', n_tiles=len(tiles)), \
+				ProcessPoolExecutor(max_workers=workers,
+					initializer=init_tile_worker,
+					initargs=(fft_name, fft_workers, precision())) as pool:
+			jobs = {pool.submit(reconstruct_tile, fns, filters,
+					[b[2:] for b in tile], options): tile for tile in tiles}
+			for job in as_completed(jobs):
+				tile = jobs[job]
+				ramps = [min(h // 2, b[1] - b[0]) for h, b in zip(halo, tile)]
+				wz, wy, wx = [blend_weights(*b, n, r) for b, n, r
+						in zip(tile, shape, ramps)]
+				w = wz[:,None,None] * wy[None,:,None] * wx[None,None,:]
+				crop = tuple(slice(b[2], b[3]) for b in tile)
+				for reg_weight, x in job.result():
+					if reg_weight not in out:
+						out[reg_weight] = np.zeros(shape, dtype=real_dtype())
+					out[reg_weight][crop] += w * x
+				weight_sum[crop] += w
+				update_progress('[cyan]Reconstructing...', 80/len(tiles))
+
+	recons = []
+	for reg_weight in sorted(out):
+		x = out[reg_weight]
+		x /= np.maximum(weight_sum, np.finfo(np.float32).tiny)
+		recons.append((reg_weight, x))
+	return recons, None
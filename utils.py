@@ -1,6 +1,20 @@
 import numpy as np
 import SimpleITK as sitk
-from numpy.fft import fftn, ifftn
+import os
+import subprocess
+import hashlib
+import json
+import time
+import threading
+from signal import SIGKILL
+import pickle
+import functools
+import collections
+from numpy.fft import fft
+import numpy.fft
+import scipy.fft
+from scipy import signal
+from scipy.io import loadmat, savemat
 from random import randint
 from rich.panel import Panel
 from rich.highlighter import Highlighter
@@ -22,11 +36,53 @@ class RainbowHighlighter(Highlighter):
 			text.stylize(f"color({randint(1, 255)})", index, index + 1)
 
 def imread(fn):
+	if str(fn).endswith('.npy'):
+		x, geometry = read_array(fn)
+		img = sitk.GetImageFromArray(np.asarray(x, dtype=np.float32))
+		img.SetOrigin(geometry['origin'])
+		img.SetSpacing(geometry['spacing'])
+		img.SetDirection(geometry['direction'])
+		return img
 	return sitk.ReadImage(fn, sitk.sitkFloat32)
 
+def read_oriented(fn, orientation='LPS'):
+	# read an image, reorient it and cast it as imread does
+	img = sitk.DICOMOrient(sitk.ReadImage(fn), orientation)
+	return sitk.Cast(img, sitk.sitkFloat32)
+
 def imwrite(img, fn):
+	if str(fn).endswith('.npy'):
+		write_array(img, fn)
+		return
 	sitk.WriteImage(sitk.Cast(img, sitk.sitkFloat32), fn)
 
+# uncompressed working format: the voxels (numpy order z, y, x, float32) in
+# a .npy file, memory-mapped when read, and the geometry in a JSON sidecar
+# of the same name, e.g., ax_x.npy and ax_x.json
+def sidecar_fn(fn):
+	return str(fn)[:-len('.npy')] + '.json'
+
+def write_array(img, fn):
+	np.save(fn, sitk.GetArrayViewFromImage(img).astype(np.float32,
+			copy=False))
+	with open(sidecar_fn(fn), 'w') as f:
+		json.dump({'origin': img.GetOrigin(), 'spacing': img.GetSpacing(),
+				'direction': img.GetDirection()}, f)
+
+def read_array(fn, mmap=True):
+	# the voxels, memory-mapped read-only unless mmap=False, and the
+	# geometry {'origin', 'spacing', 'direction'}
+	x = np.load(fn, mmap_mode='r' if mmap else None)
+	with open(sidecar_fn(fn), 'r') as f:
+		geometry = json.load(f)
+	return x, geometry
+
+def read_voxels(fn):
+	# the voxels of an image as read by imread, without a copy for .npy
+	if str(fn).endswith('.npy'):
+		return read_array(fn)[0]
+	return sitk.GetArrayFromImage(imread(fn))
+
 def np_to_img(x, ref):
 	img = sitk.GetImageFromArray(x)
 	img.SetOrigin(ref.GetOrigin())
@@ -63,8 +119,11 @@ def resample_iso_img_with_size(img, sz):
 
 	return resample_img(img, new_spacing, new_sz.tolist())
 
-def resample_img_like(img, ref):
+def resample_img_like(img, ref, transform=None):
+	# transform: maps the points of ref to img, e.g., a rigid registration
 	r = sitk.ResampleImageFilter()
+	if transform != None:
+		r.SetTransform(transform)
 	r.SetInterpolator(sitk.sitkBSpline)
 	r.SetDefaultPixelValue(0)
 	r.SetOutputOrigin(ref.GetOrigin())
@@ -73,127 +132,928 @@ def resample_img_like(img, ref):
 	r.SetSize(ref.GetSize())
 	return r.Execute(img)
 
+def iso_lattice(img, sz=None):
+	# empty image on the high-res lattice of resample_iso_img, or of
+	# resample_iso_img_with_size if sz is given
+	spacing = np.array(img.GetSpacing())
+	new_spacing = np.array([min(spacing)] * 3)
+	if sz == None:
+		new_sz = np.floor(spacing / new_spacing * np.array(img.GetSize()))
+	else:
+		new_sz = np.array(sz)
+	new_sz = new_sz.astype(np.uint32)
+	new_sz[new_sz % 2 == 1] -= 1
+
+	lattice = sitk.Image(new_sz.tolist(), sitk.sitkFloat32)
+	lattice.SetOrigin(img.GetOrigin())
+	lattice.SetSpacing(new_spacing.tolist())
+	lattice.SetDirection(img.GetDirection())
+	return lattice
+
+def fourier_interp_axis(x, axis, factor, offset, n):
+	# band-limited interpolation along one axis: the samples of x, factor
+	# high-res voxels apart with the first one at the (continuous) index
+	# offset, onto the high-res voxels 0..n-1. The spectrum is zero-padded
+	# to factor times its length, the Nyquist bin split between both
+	# sides, and a fractional offset is a linear phase; the samples are
+	# periodic, as for the DFT, and the voxels they do not cover are 0.
+	L = x.shape[axis]
+	offset_int = int(np.floor(offset + 1e-3))
+	offset_frac = offset - offset_int
+	if abs(offset_frac) < 1e-3:
+		offset_frac = 0
+	M = L * factor
+	if factor > 1 or offset_frac != 0:
+		X = fft_axis(x, L, axis, real=True)
+		shape = list(X.shape)
+		shape[axis] = M // 2 + 1
+		Xp = np.zeros(shape, dtype=complex_dtype())
+		index = [slice(None)] * x.ndim
+		index[axis] = slice(0, L // 2 + 1)
+		Xp[tuple(index)] = X
+		if L % 2 == 0 and factor > 1:
+			index[axis] = L // 2
+			Xp[tuple(index)] *= 0.5
+		if offset_frac != 0:
+			k = np.arange(0, M // 2 + 1)
+			phase = np.exp(-2j * np.pi * k * offset_frac / M)
+			Xp *= np.expand_dims(phase.astype(complex_dtype()),
+					tuple(a for a in range(0, x.ndim) if a != axis))
+		x = fft_axis(Xp, M, axis, inverse=True, real=True) * factor
+
+	shape = list(x.shape)
+	shape[axis] = n
+	out = np.zeros(shape, dtype=x.dtype)
+	t0, t1 = max(0, -offset_int), min(M, n - offset_int)
+	if t0 < t1:
+		src, dst = [slice(None)] * x.ndim, [slice(None)] * x.ndim
+		src[axis] = slice(t0, t1)
+		dst[axis] = slice(t0 + offset_int, t1 + offset_int)
+		out[tuple(dst)] = x[tuple(src)]
+	return out
+
+def fourier_resample_like(img, ref):
+	# img on the lattice of ref as resample_img_like, by band-limited
+	# interpolation (zero-padding of the spectrum) along each axis instead
+	# of the BSpline; only for an image on the grid of ref: the same axes,
+	# spacings that are integer multiples of those of ref, e.g., a stack
+	# acquired with the reference geometry. Raises ValueError otherwise.
+	if not np.allclose(img.GetDirection(), ref.GetDirection(), atol=1e-4):
+		raise ValueError('the axes of the image are not those of the '
+				'high-res lattice')
+	factors = np.array(img.GetSpacing()) / np.array(ref.GetSpacing())
+	if np.any(np.abs(factors - np.round(factors)) > 1e-3) \
+			or np.any(np.round(factors) < 1):
+		raise ValueError('the spacings of the image are not multiples of '
+				'those of the high-res lattice')
+	offsets = ref.TransformPhysicalPointToContinuousIndex(img.GetOrigin())
+	x = sitk.GetArrayFromImage(img).astype(real_dtype())
+	for jj in range(0, 3):
+		# x, y, z -> numpy order z, y, x
+		x = fourier_interp_axis(x, 2 - jj, int(round(factors[jj])),
+				offsets[jj], ref.GetSize()[jj])
+	return np_to_img(x.astype(np.float32), ref)
+
+# command of rigid_register, without its file arguments
+registration_command = ['crlRigidRegistration', '-t', '2']
+
+def kill_session(proc):
+	# kill a process started with start_new_session=True and the processes
+	# it started, e.g., those of a wrapper script, which would otherwise
+	# keep its pipes open
+	if proc.poll() == None:
+		try:
+			os.killpg(proc.pid, SIGKILL)
+		except ProcessLookupError:
+			pass
+
+class ProcessGroup:
+	# the external processes of concurrent jobs, so that the running ones
+	# can be killed at once, e.g., when another job fails; no process
+	# starts once the group is terminated. The processes should be started
+	# in their own sessions, see kill_session.
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.procs = set()
+		self.terminated = False
+
+	def start(self, cmd, **kwargs):
+		with self.lock:
+			if self.terminated:
+				raise RuntimeError('cancelled')
+			proc = subprocess.Popen(cmd, **kwargs)
+			self.procs.add(proc)
+		return proc
+
+	def finish(self, proc):
+		with self.lock:
+			self.procs.discard(proc)
+
+	def terminate(self):
+		with self.lock:
+			self.terminated = True
+			for proc in self.procs:
+				kill_session(proc)
+
+def rigid_register(fixed_fn, moving_fn, out_fn, tfm_fn, timeout=None,
+		group=None):
+	# align the moving image to the fixed one with crlRigidRegistration;
+	# raises RuntimeError if it fails, times out or writes no output.
+	# The process is started in the ProcessGroup group if given.
+	cmd = registration_command + [fixed_fn, moving_fn, out_fn, tfm_fn]
+	start = group.start if group != None else subprocess.Popen
+	try:
+		proc = start(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+				start_new_session=True)
+	except FileNotFoundError:
+		raise RuntimeError('crlRigidRegistration not found, check the PATH')
+	try:
+		_, err = proc.communicate(timeout=timeout)
+	except subprocess.TimeoutExpired:
+		kill_session(proc)
+		proc.communicate()
+		raise RuntimeError('timed out after %g s' % timeout)
+	finally:
+		if group != None:
+			group.finish(proc)
+
+	if proc.returncode != 0:
+		err = err.decode(errors='replace').strip().splitlines()
+		raise RuntimeError('exit status %d%s' % (proc.returncode,
+				': ' + err[-1] if len(err) > 0 else ''))
+	if not os.path.isfile(out_fn):
+		raise RuntimeError('no registered image written to ' + out_fn)
+
+# parameters of sitk_rigid_register: a pyramid of shrink factors and
+# smoothing sigmas (voxels), and the fraction of the voxels sampled by the
+# metric at each level
+sitk_registration = {'shrink_factors': [4, 2, 1],
+		'smoothing_sigmas': [2, 1, 0], 'sampling': 0.1, 'bins': 50,
+		'iterations': 200, 'seed': 1}
+
+# transforms of the stack pairs already registered in this process, least
+# recently used first; the registrations run on threads, hence the lock
+_transform_cache = collections.OrderedDict()
+_transform_cache_size = 64
+_transform_cache_lock = threading.Lock()
+
+def image_digest(img):
+	# SHA-256 of the voxels and the geometry of an image
+	h = hashlib.sha256(sitk.GetArrayViewFromImage(img).tobytes())
+	h.update(str((img.GetOrigin(), img.GetSpacing(),
+			img.GetDirection())).encode())
+	return h.hexdigest()
+
+def sitk_rigid_register(fixed, moving, threads=None, timeout=None):
+	# align the moving image to the fixed one in process with SimpleITK:
+	# Mattes mutual information on a random sample of the voxels, over a
+	# multi-resolution pyramid, from the centred geometry. Returns the
+	# Euler3DTransform mapping the points of fixed to moving, reused if the
+	# same pair is seen again; raises RuntimeError on a timeout.
+	params = sitk_registration
+	key = (image_digest(fixed), image_digest(moving),
+			str(sorted(params.items())))
+	with _transform_cache_lock:
+		if key in _transform_cache:
+			_transform_cache.move_to_end(key)
+			return sitk.Transform(_transform_cache[key])
+
+	R = sitk.ImageRegistrationMethod()
+	if threads != None:
+		R.SetNumberOfThreads(threads)
+	R.SetMetricAsMattesMutualInformation(params['bins'])
+	R.SetMetricSamplingStrategy(R.RANDOM)
+	R.SetMetricSamplingPercentage(params['sampling'], params['seed'])
+	R.SetInterpolator(sitk.sitkLinear)
+	R.SetOptimizerAsRegularStepGradientDescent(learningRate=1.0,
+			minStep=1e-4, numberOfIterations=params['iterations'],
+			gradientMagnitudeTolerance=1e-6)
+	R.SetOptimizerScalesFromPhysicalShift()
+	R.SetShrinkFactorsPerLevel(params['shrink_factors'])
+	R.SetSmoothingSigmasPerLevel(params['smoothing_sigmas'])
+	R.SmoothingSigmasAreSpecifiedInPhysicalUnitsOff()
+	R.SetInitialTransform(sitk.CenteredTransformInitializer(fixed, moving,
+			sitk.Euler3DTransform(),
+			sitk.CenteredTransformInitializerFilter.GEOMETRY), inPlace=False)
+
+	t0, timed_out = time.time(), [False]
+	def check_time():
+		if timeout != None and time.time() - t0 > timeout:
+			timed_out[0] = True
+			R.StopRegistration()
+	R.AddCommand(sitk.sitkIterationEvent, check_time)
+	tfm = R.Execute(fixed, moving)
+	if timed_out[0]:
+		raise RuntimeError('timed out after %g s' % timeout)
+
+	tfm = sitk.Euler3DTransform(sitk.CompositeTransform(tfm).GetBackTransform())
+	with _transform_cache_lock:
+		_transform_cache[key] = tfm
+		while len(_transform_cache) > _transform_cache_size:
+			_transform_cache.popitem(last=False)
+	return sitk.Transform(tfm)
+
+def sitk_register(fixed_fn, moving_fn, out_fn, tfm_fn, timeout=None,
+		threads=None):
+	# rigid_register with sitk_rigid_register instead of
+	# crlRigidRegistration, writing the same outputs: the moving image
+	# resampled in the lattice of the fixed one, and the transform
+	fixed, moving = imread(fixed_fn), imread(moving_fn)
+	tfm = sitk_rigid_register(fixed, moving, threads, timeout)
+	imwrite(resample_img_like(moving, fixed, tfm), out_fn)
+	sitk.WriteTransform(tfm, tfm_fn)
+
 def dumb_update(task, advance):
 	pass
 
-def recon_tik(y, w, tv_weight=0.1, progress=None, task=None):
-	advance = 65/6
-	if progress != None and task!=None:
-		update_progress = progress.update
+def spectrum_shape(shape, real=False):
+	# shape of the spectrum of a real volume of the given shape; with
+	# real=True only the non-redundant half (rfftn layout) is kept
+	shape = list(shape)
+	if real:
+		shape[-1] = shape[-1] // 2 + 1
+	return shape
+
+# floating-point types of the deconvolution, see set_precision
+_precision = {'name': 'single', 'real': np.float32, 'complex': np.complex64}
+
+def set_precision(name='single'):
+	# 'single' keeps the images, the spectra and the operators of the
+	# deconvolution in float32/complex64; 'double' in float64/complex128,
+	# at twice the memory, e.g., to check the accuracy of the former
+	if name == 'single':
+		real, cplx = np.float32, np.complex64
+	elif name == 'double':
+		real, cplx = np.float64, np.complex128
 	else:
-		update_progress = dumb_update
+		raise ValueError('unknown precision %s' % name)
+	_precision.update(name=name, real=real, complex=cplx)
 
-	d, n, m, n_imgs_per_echo = y.shape
-	dx = np.zeros([d,n,m])
-	dx[0,0,0] = -1
-	dx[1,0,0] = 1
-	dx = np.abs(fftn(dx, [d,n,m]))
+def precision():
+	return _precision['name']
 
-	update_progress(task, advance=advance)
+def real_dtype():
+	return _precision['real']
 
-	dy = np.zeros([d,n,m])
-	dy[0,0,0] = -1
-	dy[0,1,0] = 1
-	dy = np.abs(fftn(dy, [d,n,m]))
+def complex_dtype():
+	return _precision['complex']
 
-	update_progress(task, advance=advance)
+# FFT backend of forward_fft/inverse_fft, see set_fft_backend
+_fft_backend = {'name': 'numpy', 'module': numpy.fft, 'kwargs': {},
+		'wisdom_fn': None}
 
-	dz = np.zeros([d,n,m])
-	dz[0,0,0] = -1
-	dz[0,0,1] = 1
-	dz = np.abs(fftn(dz, [d,n,m]))
+def set_fft_backend(name='numpy', workers=None, wisdom_fn=None):
+	# name: 'numpy', 'scipy' (scipy.fft) or 'pyfftw'
+	# workers: number of threads of scipy.fft/pyFFTW, -1 for all CPUs
+	# wisdom_fn: pyFFTW wisdom file, loaded here and updated by
+	#            save_fft_wisdom; the plans are then measured (FFTW_MEASURE)
+	#            once and reused by the next runs, rather than estimated
+	#            (FFTW_ESTIMATE, the default of pyFFTW), which leaves no
+	#            wisdom to keep
+	if name == 'numpy':
+		module, kwargs = numpy.fft, {}
+	elif name == 'scipy':
+		module, kwargs = scipy.fft, {'workers': workers}
+	elif name == 'pyfftw':
+		try:
+			import pyfftw
+			import pyfftw.interfaces.scipy_fft
+		except ImportError:
+			raise ValueError('the pyfftw backend requires pyFFTW, '
+					'install it with pip install pyfftw')
+		pyfftw.interfaces.cache.enable()
+		if wisdom_fn != None:
+			pyfftw.config.PLANNER_EFFORT = 'FFTW_MEASURE'
+			if os.path.isfile(wisdom_fn):
+				with open(wisdom_fn, 'rb') as f:
+					pyfftw.import_wisdom(pickle.load(f))
+		else:
+			pyfftw.config.PLANNER_EFFORT = 'FFTW_ESTIMATE'
+		module, kwargs = pyfftw.interfaces.scipy_fft, {'workers': workers}
+	else:
+		raise ValueError('unknown FFT backend %s' % name)
 
-	update_progress(task, advance=advance)
+	_fft_backend.update(name=name, module=module, kwargs=kwargs,
+			wisdom_fn=wisdom_fn)
 
-	w_tik = np.conj(dx)*dx + np.conj(dy)*dy + np.conj(dz)*dz
+def fft_backend():
+	# (name, workers) of the current backend, e.g., to set up subprocesses
+	return _fft_backend['name'], _fft_backend['kwargs'].get('workers')
 
-	update_progress(task, advance=advance)
+def save_fft_wisdom():
+	# several processes may share the wisdom file: the plans saved by the
+	# others since it was loaded are merged, and the file is written aside
+	# and renamed
+	if _fft_backend['name'] == 'pyfftw' and _fft_backend['wisdom_fn'] != None:
+		import pyfftw
+		wisdom_fn = _fft_backend['wisdom_fn']
+		wisdom_path = os.path.dirname(wisdom_fn)
+		if wisdom_path != '':
+			os.makedirs(wisdom_path, exist_ok=True)
+		if os.path.isfile(wisdom_fn):
+			with open(wisdom_fn, 'rb') as f:
+				pyfftw.import_wisdom(pickle.load(f))
+		tmp_fn = '%s.%d.tmp' % (wisdom_fn, os.getpid())
+		with open(tmp_fn, 'wb') as f:
+			pickle.dump(pyfftw.export_wisdom(), f)
+		os.replace(tmp_fn, wisdom_fn)
+
+def padded_grid(shape, fast=False, real=False):
+	# grid of the deconvolution: the high-res lattice zero-padded to twice
+	# its size, or to the next sizes with small prime factors if fast=True
+	grid = [s*2 for s in shape]
+	if fast:
+		grid = [scipy.fft.next_fast_len(s, real=real) for s in grid]
+	return grid
+
+# The transforms below run in, and return, the types of set_precision; the
+# inputs are cast first, as the backends transform float32 and complex64
+# arrays in single precision.
+def forward_fft(x, shape, real=False):
+	fft_mod, kwargs = _fft_backend['module'], _fft_backend['kwargs']
+	axes = list(range(-len(shape), 0))
+	if real:
+		X = fft_mod.rfftn(np.asarray(x, dtype=real_dtype()), shape,
+				axes=axes, **kwargs)
+	else:
+		X = fft_mod.fftn(np.asarray(x, dtype=complex_dtype()), shape,
+				axes=axes, **kwargs)
+	return X.astype(complex_dtype(), copy=False)
+
+def inverse_fft(X, shape, real=False):
+	# returns the real part of the inverse transform on the given grid
+	fft_mod, kwargs = _fft_backend['module'], _fft_backend['kwargs']
+	axes = list(range(-len(shape), 0))
+	X = np.asarray(X, dtype=complex_dtype())
+	if real:
+		x = fft_mod.irfftn(X, shape, axes=axes, **kwargs)
+	else:
+		x = fft_mod.ifftn(X, shape, axes=axes, **kwargs).real
+	return x.astype(real_dtype(), copy=False)
+
+def cropped_inverse_fft(X, shape, out_shape, real=False,
+		keep_negative_values=True, n_slabs=8):
+	# inverse_fft(X, shape, real) cropped to out_shape over its last axes,
+	# computed axis by axis: each 1D transform runs in slabs along the next
+	# axis and its rows beyond out_shape are dropped right away, and the
+	# real part is clipped (unless keep_negative_values) and cast within the
+	# last one, so that no temporary spans the padded grid
+	k = len(shape)
+	Y = X
+	for a in range(-k, 0):
+		last = a == -1
+		slab_axis = -2 if last else a + 1
+		out_sz = list(Y.shape)
+		out_sz[a] = out_shape[a]
+		out = np.empty(out_sz, dtype=real_dtype() if last else complex_dtype())
+		crop = [slice(None)] * Y.ndim
+		crop[a] = slice(0, out_shape[a])
+		sl = [slice(None)] * Y.ndim
+		step = -(-Y.shape[slab_axis] // n_slabs)
+		for s0 in range(0, Y.shape[slab_axis], step):
+			sl[slab_axis] = slice(s0, s0 + step)
+			y = fft_axis(Y[tuple(sl)], shape[a], a, inverse=True,
+					real=real and last)[tuple(crop)]
+			if last and not real:
+				y = y.real
+			if last and not keep_negative_values:
+				np.clip(y, 0, None, out=y)
+			out[tuple(sl)] = y
+			del y
+		Y = out
+	return Y
+
+def fft_axis(X, n, axis, inverse=False, real=False):
+	# complex (inverse) FFT of length n along one axis; with real=True, the
+	# real-to-complex one (rfft layout) and its inverse, which is real
+	fft_mod, kwargs = _fft_backend['module'], _fft_backend['kwargs']
+	if real and inverse:
+		x = fft_mod.irfft(np.asarray(X, dtype=complex_dtype()), n, axis=axis,
+				**kwargs)
+		return x.astype(real_dtype(), copy=False)
+	if real:
+		X = fft_mod.rfft(np.asarray(X, dtype=real_dtype()), n, axis=axis,
+				**kwargs)
+	elif inverse:
+		X = fft_mod.ifft(np.asarray(X, dtype=complex_dtype()), n, axis=axis,
+				**kwargs)
+	else:
+		X = fft_mod.fft(np.asarray(X, dtype=complex_dtype()), n, axis=axis,
+				**kwargs)
+	return X.astype(complex_dtype(), copy=False)
+
+def available_memory():
+	# memory (bytes) available to new allocations
+	try:
+		with open('/proc/meminfo', 'r') as f:
+			for line in f:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+@functools.lru_cache(maxsize=64)
+def gaussian_fft_win(factor, filter_len):
+	# FWHM in the unit of number of pixel and convert it to sigma
+	sigma = factor / 2.355
+	gw = signal.windows.gaussian(filter_len, std=sigma)
+	gw /= np.sum(gw)
+	gw = np.roll(gw, -filter_len//2)
+	# move it to Fourier domain; read-only as it is shared by the cache
+	fft_win = np.abs(fft(gw))
+	fft_win.flags.writeable = False
+	return fft_win
+
+def expand_fft_win(fft_win, axis, shape, real=False, factor=None):
+	# reshape a 1D filter spectrum so that it broadcasts along the given
+	# axis of the grid, cropped to the rfftn layout if real=True; the
+	# spectrum is recomputed from the blur factor for other grid lengths,
+	# and for a higher precision than the stored one, see set_precision
+	fft_win = np.asarray(fft_win).ravel()
+	if fft_win.size > 1 and fft_win.size != shape[axis] and factor == None:
+		raise ValueError('filter of length %d does not fit the grid %s' \
+				% (fft_win.size, shape))
+	if fft_win.size > 1 and factor != None and (fft_win.size != shape[axis]
+			or fft_win.dtype.itemsize < np.dtype(real_dtype()).itemsize):
+		fft_win = gaussian_fft_win(factor, shape[axis])
+	if real and axis == len(shape) - 1 and fft_win.size == shape[-1]:
+		fft_win = fft_win[:shape[-1] // 2 + 1]
+	win_sz = [1] * len(shape)
+	win_sz[axis] = fft_win.size
+	return fft_win.astype(real_dtype()).reshape(win_sz)
+
+def load_filter(fn):
+	# (fft_win, axis, factor) as written by preprocess.py; dense filter
+	# volumes written by older versions come with axis None
+	h = loadmat(fn)
+	if 'fft_win_1d' in h:
+		factor = h['factor'].item() if 'factor' in h else None
+		return h['fft_win_1d'], int(h['axis'].item()), factor
+	return h['fft_win'], None, None
+
+def save_filter(fn, h):
+	# the spectrum is stored in single precision, recon.py recomputes it
+	# from the blur factor in double precision
+	fft_win, axis, factor = h
+	savemat(fn, {'fft_win_1d': np.asarray(fft_win, dtype=np.float32),
+			'axis': axis, 'factor': factor})
+
+def expand_filter(h, shape, real=False):
+	# broadcastable filter on the grid from an (fft_win, axis, factor)
+	# triple, see make_filters
+	fft_win, axis, factor = h
+	if axis != None:
+		return expand_fft_win(fft_win, axis, shape, real, factor)
+	if np.ndim(fft_win) == len(shape) and list(np.shape(fft_win)) != list(shape):
+		raise ValueError('dense filters require the grid %s, '
+				'run preprocess.py again' % (np.shape(fft_win),))
+	if real:
+		fft_win = half_spectrum(fft_win, shape)
+	return fft_win
+
+def half_spectrum(w, shape):
+	# crop a full-layout filter to the rfftn layout of the given grid;
+	# scalars and filters broadcast along the last axis are left as is
+	w = np.asarray(w)
+	if w.ndim == len(shape) and w.shape[-1] == shape[-1]:
+		w = w[..., :shape[-1] // 2 + 1]
+	return w
+
+def accumulate_spectra(y, w, WY=None, WW=None):
+	# y: one interpolated low-res image in Fourier domain
+	# w: its convolutional filter
+	# WY, WW: running sums of conj(w)*y and conj(w)*w, updated in place
+	if WY is None:
+		WY = np.zeros(y.shape, dtype=y.dtype)
+		WW = np.zeros(y.shape, dtype=y.real.dtype)
+	WY += np.conj(w) * y
+	WW += (np.conj(w) * w).real
+	return WY, WW
 
-	wy, ww = 0, 0
-	for jj in range(0, n_imgs_per_echo):
-		wy += np.conj(w[...,jj]) * y[...,jj]
-		ww += np.conj(w[...,jj]) * w[...,jj]
+# operators kept in memory, least recently used first, see
+# set_operator_cache_size
+_operator_cache = collections.OrderedDict()
+_operator_cache_size = [None]
+# size (bytes) of the operator cache on disk, see cached_operator
+_operator_disk_cache_size = [2 * 2**30]
+
+def set_operator_cache_size(n=None):
+	# number of operators kept in memory, e.g., by a long-lived process
+	# serving many grids; None for no limit
+	_operator_cache_size[0] = n
+	_evict_operators()
+
+def _evict_operators():
+	n = _operator_cache_size[0]
+	while n != None and len(_operator_cache) > n:
+		_operator_cache.popitem(last=False)
+
+def set_operator_disk_cache_size(size=2 * 2**30):
+	# size (bytes) of the operator cache on disk, beyond which the least
+	# recently used operators are removed; None for no limit
+	_operator_disk_cache_size[0] = size
+
+def _evict_disk_operators(cache_dir):
+	size = _operator_disk_cache_size[0]
+	if size == None:
+		return
+	entries = []
+	for e in os.scandir(cache_dir):
+		if e.name.endswith('.npz') and not e.name.endswith('.tmp.npz'):
+			try:
+				st = e.stat()
+				entries.append((st.st_mtime, st.st_size, e.path))
+			except OSError:
+				continue
+	total = sum(e[1] for e in entries)
+	for _, n_bytes, fn in sorted(entries):
+		if total <= size:
+			break
+		try:
+			os.remove(fn)
+		except OSError:
+			# removed meanwhile by another process
+			pass
+		total -= n_bytes
+
+def cached_operator(key, build, cache_dir=None):
+	# memoize an operator in memory and, if cache_dir is set, on disk; the
+	# disk cache is only worth it for operators slower to build than to
+	# read, and is bounded by set_operator_disk_cache_size
+	if key in _operator_cache:
+		_operator_cache.move_to_end(key)
+		return _operator_cache[key]
+
+	fn = None
+	if cache_dir != None:
+		fn = os.path.join(cache_dir,
+				'_'.join(str(k) for k in key).replace(' ', '') + '.npz')
+	if fn != None and os.path.isfile(fn):
+		with np.load(fn) as f:
+			ops = tuple(f['op%d' % ii] for ii in range(len(f.files)))
+		# the modification time orders the eviction
+		try:
+			os.utime(fn)
+		except OSError:
+			pass
+	else:
+		ops = build()
+		if fn != None:
+			# written aside and renamed, as several processes may share
+			# the cache
+			os.makedirs(cache_dir, exist_ok=True)
+			tmp_fn = fn[:-len('.npz')] + '.%d.tmp.npz' % os.getpid()
+			np.savez(tmp_fn, **{'op%d' % ii: op for ii, op in enumerate(ops)})
+			os.replace(tmp_fn, fn)
+			_evict_disk_operators(cache_dir)
+
+	_operator_cache[key] = ops
+	_evict_operators()
+	return ops
+
+def diff_spectrum(n, step, real=False):
+	# magnitude spectrum of the difference x[i+step] - x[i] on a grid of
+	# length n, the 1D factor of the separable difference operators
+	if step == 0:
+		s = np.ones(n)
+	else:
+		h = np.zeros(step + 1)
+		h[0], h[-1] = -1, 1
+		s = np.abs(fft(h, n))
+	if real:
+		s = s[:n // 2 + 1]
+	return s
+
+def tik_factors(shape, real=False):
+	# squared spectra of the first-order differences along the three axes
+	d, n, m = shape
+	return diff_spectrum(d, 1)**2, diff_spectrum(n, 1)**2, \
+			diff_spectrum(m, 1, real)**2
+
+def tik_operator(shape, dtype=np.float32, real=False, cache_dir=None):
+	# sum of the squared spectra of the first-order differences along
+	# the three axes
+	def build():
+		dx, dy, dz = [f.astype(dtype) for f in tik_factors(shape, real)]
+		return (dx[:,None,None] + dy[None,:,None] + dz[None,None,:],)
+
+	key = ('tik', *shape, np.dtype(dtype).name, 'rfft' if real else 'fft')
+	return cached_operator(key, build, cache_dir)[0]
+
+def ggr_shifts(p=2):
+	# the shifts (ll, pp, qq) of the GGR regularization
+	for ll in range(-p, p+1):
+		for pp in range(0, p+1):
+			for qq in range(0, p+1):
+				if ll+pp+qq < 0 or (ll==0 and pp==0 and qq==0):
+					continue
+				yield ll, pp, qq
+
+def ggr_factors(shape, p=2, alpha=0.6, real=False):
+	# factors of the GGR operators, DS = tensordot(U, S, axes=(0, 0)) and
+	# DD = tensordot(V, T, axes=(0, 0)), see ggr_operators
+	d, n, m = shape
+	shifts = range(-p, p+1)
+	u, v = [], []
+	for ll in shifts:
+		s = diff_spectrum(d, abs(ll)) * alpha**abs(ll)
+		u.append(s)
+		v.append(s * diff_spectrum(d, abs(ll)))
+	U, V = np.array(u), np.array(v)
+
+	s2 = [diff_spectrum(n, pp) * alpha**pp for pp in range(0, p+1)]
+	s3 = [diff_spectrum(m, qq, real) * alpha**qq for qq in range(0, p+1)]
+	d2 = [diff_spectrum(n, pp) for pp in range(0, p+1)]
+	d3 = [diff_spectrum(m, qq, real) for qq in range(0, p+1)]
+
+	S = np.zeros([len(shifts), n, s3[0].size])
+	T = np.zeros_like(S)
+	for ll, pp, qq in ggr_shifts(p):
+		S[ll+p] += np.outer(s2[pp], s3[qq])
+		T[ll+p] += np.outer(s2[pp] * d2[pp], s3[qq] * d3[qq])
+	return U, S, V, T
+
+def ggr_operators(shape, p=2, alpha=0.6, dtype=np.float32, real=False,
+		cache_dir=None):
+	# DD = sum a*conj(D)*D and DS = sum a*conj(D) over the shifts
+	# (ll, pp, qq), where D = d1*d2*d3 and a = alpha**(|ll|+|pp|+|qq|);
+	# the GGR term is then DG = DS * fftn(grad_ref)
+	#
+	# Both a and D factor over the three axes, so each sum is formed as
+	# sum_ll u_ll (x) S_ll, with 1D factors u_ll along the first axis and
+	# S_ll the 2D sum over (pp, qq); a single tensor contraction then
+	# yields the volume without any per-shift temporaries.
+	def build():
+		U, S, V, T = ggr_factors(shape, p, alpha, real)
+		DS = np.tensordot(U.astype(dtype), S.astype(dtype), axes=(0, 0))
+		DD = np.tensordot(V.astype(dtype), T.astype(dtype), axes=(0, 0))
+		return DD, DS
+
+	key = ('ggr', *shape, 'p%d' % p, 'a%g' % alpha, np.dtype(dtype).name,
+			'rfft' if real else 'fft')
+	return cached_operator(key, build, cache_dir)
+
+def recon_tik(y, w, tv_weight=0.1, progress=None, task=None):
+	WY, WW = None, None
+	for jj in range(0, y.shape[-1]):
+		WY, WW = accumulate_spectra(y[...,jj], w[...,jj], WY, WW)
+
+	return solve_tik(WY, WW, tv_weight=tv_weight,
+			progress=progress, task=task)
+
+def solve_tik(WY, WW, tv_weight=0.1, shape=None, real=False,
+		cache_dir=None, progress=None, task=None):
+	# shape: spatial grid, required if WY and WW are on the rfftn layout
+	advance = 65/2
+	if progress != None and task!=None:
+		update_progress = progress.update
+	else:
+		update_progress = dumb_update
+
+	if shape == None:
+		shape = WY.shape
+	DG, DD, _ = tik_spectra(shape, dtype=WW.dtype, real=real,
+			cache_dir=cache_dir)
 
 	update_progress(task, advance=advance)
 
-	fft_x = wy / (ww + tv_weight * w_tik)
+	fft_x = solve_spectrum(WY, WW, DG, DD, tv_weight)
 
 	update_progress(task, advance=advance)
 
-	return fft_x.astype(np.complex64)
+	return fft_x
 
 def recon_ggr(y, w, grad_ref, ggr_weight=0.1,
 		tau_percent=0.8, p=2, alpha=0.6, progress=None, task=None):
-	# y: interpolated low-res images in Fourier domain
-	# w: convolutional filters
+	WY, WW = None, None
+	for jj in range(0, y.shape[-1]):
+		WY, WW = accumulate_spectra(y[...,jj], w[...,jj], WY, WW)
+
+	return solve_ggr(WY, WW, grad_ref, ggr_weight=ggr_weight,
+			tau_percent=tau_percent, p=p, alpha=alpha,
+			progress=progress, task=task)
+
+def solve_ggr(WY, WW, grad_ref, ggr_weight=0.1,
+		tau_percent=0.8, p=2, alpha=0.6, shape=None, real=False,
+		cache_dir=None, edge=False, quantile_method='histogram',
+		progress=None, task=None):
+	# WY: sum of conj(w)*y over the low-res images, see accumulate_spectra
+	# WW: sum of conj(w)*w over the low-res images
 	# grad_ref: spatial gradient images
 	# ggr_weight: regularization weight
-	# tau_percent: edge-enhanced function
+	# tau_percent: edge-enhanced function, quantile of the threshold
 	# p: scale of gradients
 	# alpha: bilateral TV
+	# shape: spatial grid, required if WY and WW are on the rfftn layout
+	# real: WY and WW hold the half spectrum (rfftn layout)
+	# cache_dir: folder of the on-disk operator cache, see ggr_operators
+	# edge: edge-enhanced GGR with tau_percent, see ggr_edge_spectra
+	# quantile_method: 'histogram' or 'select', see approx_quantile
 
-	advance = 25/3
+	advance = 25/2
 	if progress != None and task != None:
 		update_progress = progress.update
 	else:
-		update_progress = dumb_udpate
+		update_progress = dumb_update
 
 	# created gradient operators
-	d, n, m, n_imgs_per_echo = y.shape
-	d1_m1 = np.abs(fftn(np.array([[[-1]],[[1]]], dtype=np.float32), [d,n,m]))
-	d1_p1 = np.abs(fftn(np.array([[[1]],[[-1]]], dtype=np.float32), [d,n,m]))
-	d2_m1 = np.abs(fftn(np.array([[[-1],[1]]], dtype=np.float32), [d,n,m]))
-	d2_p1 = np.abs(fftn(np.array([[[1],[-1]]], dtype=np.float32), [d,n,m]))
-	d3_m1 = np.abs(fftn(np.array([[[-1,1]]], dtype=np.float32), [d,n,m]))
-	d3_p1 = np.abs(fftn(np.array([[[1,-1]]], dtype=np.float32), [d,n,m]))
-
-	d1_m2 = np.abs(fftn(np.array([[[-1]],[[0]],[[1]]], dtype=np.float32), [d,n,m]))
-	d1_p2 = np.abs(fftn(np.array([[[1]],[[0]],[[-1]]], dtype=np.float32), [d,n,m]))
-	d2_m2 = np.abs(fftn(np.array([[[-1],[0],[1]]], dtype=np.float32), [d,n,m]))
-	d2_p2 = np.abs(fftn(np.array([[[1],[0],[-1]]], dtype=np.float32), [d,n,m]))
-	d3_m2 = np.abs(fftn(np.array([[[-1,0,1]]], dtype=np.float32), [d,n,m]))
-	d3_p2 = np.abs(fftn(np.array([[[1,0,-1]]], dtype=np.float32), [d,n,m]))
-
-	d1 = [d1_m2, d1_m1, 1, d1_p1, d1_p2]
-	d2 = [d2_m2, d2_m1, 1, d2_p1, d2_p2]
-	d3 = [d3_m2, d3_m1, 1, d3_p1, d3_p2]
-
-	GR = fftn(grad_ref, [d,n,m])
+	if shape == None:
+		shape = WY.shape
+	DG, DD, _ = ggr_spectra(grad_ref, shape, p=p, alpha=alpha,
+			dtype=WW.dtype, real=real, cache_dir=cache_dir,
+			tau_percent=tau_percent if edge else None,
+			quantile_method=quantile_method)
+
+	update_progress(task, advance=40+advance)
+
+	fft_x = solve_spectrum(WY, WW, DG, DD, ggr_weight)
 
 	update_progress(task, advance=advance)
 
-	# deconvolution
-	DG, DD = 0, 0
-	for ll in range(-p, p+1):
-		for pp in range(0, p+1):
-			for qq in range(0, p+1):
-				if ll+pp+qq < 0 or (ll==0 and pp==0 and qq==0):
-					continue
+	return fft_x
 
-				a = alpha**(abs(ll)+abs(pp)+abs(qq))
-				D = d1[ll+p] * d2[pp+p] * d3[qq+p]
-				#g = ifftn(D * GR).real.astype(np.float32)
-				#g = g[:d,:n,:m]
+def tik_spectra(shape, dtype=np.float32, real=False, cache_dir=None):
+	# DG, DD and the constant part of the regularization norm of the
+	# Tikhonov regularization, see solve_spectrum and weight_criteria
+	return 0, tik_operator(shape, dtype, real, cache_dir), 0
 
-				#sg = np.sort(np.abs(g)).flatten()
-				#tau = sg[int(sg.size * tau_percent)]
+def ggr_spectra(grad_ref, shape, p=2, alpha=0.6, dtype=np.float32,
+		real=False, cache_dir=None, tau_percent=None,
+		quantile_method='histogram'):
+	# DG, DD and the constant part of the regularization norm of the
+	# GGR regularization, see solve_spectrum and weight_criteria
+	# tau_percent: if set, the edge-enhanced GGR, see ggr_edge_spectra
+	DD, DS = ggr_operators(shape, p=p, alpha=alpha, dtype=dtype,
+			real=real, cache_dir=cache_dir)
+	GR = forward_fft(grad_ref, shape, real)
+	if tau_percent != None:
+		DG, RR = ggr_edge_spectra(GR, grad_ref.shape, shape, p, alpha,
+				tau_percent, quantile_method, real)
+		return DG, DD, RR
 
-				#G = fftn(g / (1 + (tau / g)**4), [d,n,m])
+	DG = DS * GR
 
-				DG += a * np.conj(D) * GR
-				DD += a * np.conj(D) * D
+	RR = ggr_weight_sum(p, alpha) * spectral_sum(np.abs(GR)**2, shape, real)
 
-				update_progress(task, advance=1)
+	return DG, DD, RR
 
-	WY, WW = 0, 0
-	for jj in range(0, n_imgs_per_echo):
-		WY += np.conj(w[...,jj]) * y[...,jj]
-		WW += np.conj(w[...,jj]) * w[...,jj]
+def edge_enhance(g, tau):
+	# g / (1 + (tau/g)**4), written so that it is 0 at g = 0
+	if tau == 0:
+		return g
+	g4 = g**4
+	return g * g4 / (g4 + g.dtype.type(tau)**4)
 
-	update_progress(task, advance=advance)
+def approx_quantile(a, q, method='histogram', bins=1024):
+	# the element of rank int(a.size * q) of a, without sorting a:
+	#   'select': selection (np.partition) on a copy of a
+	#   'histogram': a histogram locates the bin of the element, and the
+	#                selection only runs on the elements of that bin
+	a = np.ravel(a)
+	k = min(int(a.size * q), a.size - 1)
+	if method == 'select':
+		return np.partition(a, k)[k]
+	if method != 'histogram':
+		raise ValueError('unknown quantile method %s' % method)
 
-	fft_x = (WY + ggr_weight * DG) / (WW + ggr_weight * DD)
+	lo, hi = a.min(), a.max()
+	if lo == hi:
+		return lo
+	counts, edges = np.histogram(a, bins, range=(lo, hi))
+	c = np.cumsum(counts)
+	ii = np.searchsorted(c, k + 1)
+	if ii > 0:
+		k -= c[ii-1]
+	# the last bin of np.histogram includes its upper edge
+	if ii == bins - 1:
+		in_bin = a >= edges[ii]
+	else:
+		in_bin = (a >= edges[ii]) & (a < edges[ii+1])
+	return np.partition(a[in_bin], k)[k]
 
-	update_progress(task, advance=advance)
+def ggr_edge_spectra(GR, out_shape, shape, p=2, alpha=0.6, tau_percent=0.8,
+		quantile_method='histogram', real=False):
+	# DG and the constant part of the regularization norm of the
+	# edge-enhanced GGR, where the gradient of the reference of each shift
+	# g = ifftn(D * GR) is replaced by edge_enhance(g, tau), with tau the
+	# tau_percent quantile of |g| over the image (out_shape):
+	#   DG = sum a * D * fftn(edge_enhance(g, tau))
+	#
+	# The shifts ll and -ll share D, and so g, and D = d1*d2*d3 is
+	# separable: the inverse transforms run axis by axis along a tree
+	# (ll, then pp, then qq) so that each partial transform is shared by
+	# the shifts below it, and the forward transforms are summed back
+	# along the same tree.
+	d, n, m = out_shape
+	n_grid = np.prod(shape, dtype=np.float64)
+	rdt = real_dtype()
+	d1 = [diff_spectrum(shape[0], l).astype(rdt)[:,None,None]
+			for l in range(0, p+1)]
+	d2 = [diff_spectrum(shape[1], pp).astype(rdt)[None,:,None]
+			for pp in range(0, p+1)]
+	d3 = [diff_spectrum(shape[2], qq, real).astype(rdt)[None,None,:]
+			for qq in range(0, p+1)]
+
+	coef = {}
+	for ll, pp, qq in ggr_shifts(p):
+		key = (abs(ll), pp, qq)
+		coef[key] = coef.get(key, 0) + alpha**(abs(ll)+abs(pp)+abs(qq))
+
+	DG = np.zeros(GR.shape, dtype=complex_dtype())
+	RR = 0
+	for l in range(0, p+1):
+		A = fft_axis(d1[l] * GR, shape[0], 0, inverse=True)
+		S1 = 0
+		for pp in range(0, p+1):
+			qs = [qq for qq in range(0, p+1) if (l, pp, qq) in coef]
+			if len(qs) == 0:
+				continue
+			B = fft_axis(d2[pp] * A, shape[1], 1, inverse=True)
+			S2 = 0
+			for qq in qs:
+				g = fft_axis(d3[qq] * B, shape[2], 2, inverse=True, real=real)
+				if not real:
+					g = g.real
+				tau = approx_quantile(np.abs(g[:d,:n,:m]), tau_percent,
+						quantile_method)
+				e = edge_enhance(g, tau)
+				# |fftn(e)|^2 sums to n_grid * |e|^2 (Parseval)
+				RR += coef[(l, pp, qq)] * n_grid * np.sum(e**2, dtype=np.float64)
+				S2 = S2 + rdt(coef[(l, pp, qq)]) * d3[qq] \
+						* fft_axis(e, shape[2], 2, real=real)
+				del g, e
+			S1 = S1 + d2[pp] * fft_axis(S2, shape[1], 1)
+			del B, S2
+		DG += d1[l] * fft_axis(S1, shape[0], 0)
+		del A, S1
+	return DG, RR
+
+def ggr_weight_sum(p=2, alpha=0.6):
+	return sum(alpha**(abs(ll)+abs(pp)+abs(qq))
+			for ll, pp, qq in ggr_shifts(p))
+
+def solve_spectrum(WY, WW, DG, DD, weight):
+	return ((WY + weight * DG) / (WW + weight * DD)).astype(complex_dtype(),
+			copy=False)
+
+def spectral_sum(A, shape, real=False):
+	# sum of A over the full spectrum; on the rfftn layout the columns
+	# other than the zero and Nyquist frequencies stand for two bins
+	total = A.sum(dtype=np.float64)
+	if real:
+		total = 2 * total - A[...,0].sum(dtype=np.float64)
+		if shape[-1] % 2 == 0:
+			total -= A[...,-1].sum(dtype=np.float64)
+	return total
+
+def weight_criteria(weights, WY, WW, DG, DD, YY, RR, n_data,
+		shape=None, real=False):
+	# residual norm rho, regularization norm eta and GCV score of the
+	# solution of each weight, evaluated in the Fourier domain from the
+	# accumulated spectra only:
+	#   rho = sum |w*X - y|^2 = YY - 2 Re(conj(X) WY) + WW |X|^2
+	#   eta = sum a |D X - GR|^2 = RR - 2 Re(conj(X) DG) + DD |X|^2
+	#   gcv = n_data * rho / (n_data - trace(H))^2, trace(H) = sum WW/(WW + weight*DD)
+	# YY: sum of |y|^2 over the low-res images
+	# RR: constant part of the regularization norm, see ggr_spectra
+	# n_data: number of samples in the low-res images
+	return combine_criteria(*weight_sums(weights, WY, WW, DG, DD,
+			shape, real), YY, RR, n_data)
+
+def weight_sums(weights, WY, WW, DG, DD, shape=None, real=False):
+	# the sums of weight_criteria over the spectra, which are additive and
+	# can be accumulated slab by slab along any axis but the last one
+	if shape == None:
+		shape = WY.shape
+	rs, es, trs = [], [], []
+	for weight in weights:
+		den = WW + weight * DD
+		X = (WY + weight * DG) / den
+		X2 = np.abs(X)**2
+		rs.append(spectral_sum(WW * X2 - 2 * np.real(np.conj(X) * WY),
+				shape, real))
+		es.append(spectral_sum(DD * X2 - 2 * np.real(np.conj(X) * DG),
+				shape, real))
+		trs.append(spectral_sum(WW / den, shape, real))
+	return np.array(rs), np.array(es), np.array(trs)
+
+def combine_criteria(rs, es, trs, YY, RR, n_data):
+	tiny = np.finfo(np.float32).tiny
+	rho = np.maximum(YY + rs, tiny)
+	eta = np.maximum(RR + es, tiny)
+	gcv = n_data * rho / (n_data - trs)**2
+	return rho, eta, gcv
+
+def select_weight(weights, rho, eta, gcv, method='gcv'):
+	# index of the weight chosen by the minimum of the GCV score, or by
+	# the corner (maximum curvature) of the L-curve (log rho, log eta)
+	if method == 'gcv':
+		return int(np.argmin(gcv))
 
-	return fft_x.astype(np.complex64)
+	t = np.log(weights)
+	x, y = np.log(rho), np.log(eta)
+	dx, dy = np.gradient(x, t), np.gradient(y, t)
+	ddx, ddy = np.gradient(dx, t), np.gradient(dy, t)
+	kappa = (dx * ddy - ddx * dy) / (dx**2 + dy**2)**1.5
+	return int(np.nanargmax(kappa))
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from rich.console import Console
+from rich import box
+from rich.table import Table
+
+# Worker mode: a long-lived service reconstructing the cases submitted over
+# a Unix socket, e.g.,
+#
+#   worker.py serve -j 2 &
+#   worker.py submit -f ax.nii.gz cor.nii.gz sag.nii.gz -o ./recons/ -w 0.03
+#   worker.py stop
+#
+# The cases run on a pool of worker processes started once, so that the
+# imports, the FFT plans and the regularization operators of each grid
+# stay in memory from one case to the next. Each request is one line of
+# JSON, answered by one line of JSON once the case is done:
+#
+#   {"stacks": [...], "out_path": "...", "options": {...}, "size": null}
+#   {"status": "ok", "outputs": [...], "elapsed": 1.2, "stages": {...}}
+#
+# {"command": "status"} and {"command": "stop"} query and stop the service.
+#
+# The client commands only need the standard library: the reconstruction
+# is imported by the service and its worker processes.
+
+def default_socket():
+	return os.path.join(os.environ.get('XDG_RUNTIME_DIR',
+			tempfile.gettempdir()), 'ggr-recon-%d.sock' % os.getuid())
+
+def init_worker(fft_backend, fft_workers, fft_wisdom, precision,
+		n_operators, cache_size):
+	import warnings
+	warnings.filterwarnings("ignore")
+	from utils import set_fft_backend, set_precision, \
+			set_operator_cache_size, set_operator_disk_cache_size
+	set_fft_backend(fft_backend, fft_workers, fft_wisdom)
+	set_precision(precision)
+	set_operator_cache_size(n_operators)
+	set_operator_disk_cache_size(cache_size)
+
+def run_job(stacks, out_path, options, size):
+	# run_case, with the time of each stage; the FFT plans measured by the
+	# case are saved to the wisdom file at once, as the worker processes
+	# end without notice
+	from pipeline import run_case
+	from profiling import start_report, finish_report
+	from utils import save_fft_wisdom
+	start_report('job')
+	try:
+		out_fns, elapsed = run_case(stacks, out_path, options, size)
+	finally:
+		report = finish_report()
+	save_fft_wisdom()
+	stages = {name: round(s['time'], 3)
+			for name, s in report['summary'].items()}
+	return out_fns, elapsed, stages
+
+class Service:
+	def __init__(self, make_pool, options, max_jobs):
+		# the pool is recreated when one of its processes dies
+		self.make_pool = make_pool
+		self.pool = make_pool()
+		self.options = options
+		# the pool queues the cases beyond its number of processes
+		self.max_jobs = max_jobs
+		self.lock = threading.Lock()
+		self.counts = {'running': 0, 'done': 0, 'failed': 0, 'restarts': 0}
+		self.t0 = time.time()
+
+	def restart(self, pool):
+		# a dead process (e.g., killed out of memory) breaks the whole pool,
+		# which fails its other cases too: only the first of them replaces it
+		with self.lock:
+			if self.pool is pool:
+				pool.shutdown(wait=False, cancel_futures=True)
+				self.pool = self.make_pool()
+				self.counts['restarts'] += 1
+
+	def shutdown(self):
+		with self.lock:
+			self.pool.shutdown()
+
+	def status(self):
+		with self.lock:
+			return dict(self.counts, jobs=self.max_jobs,
+					uptime=time.time() - self.t0, pid=os.getpid())
+
+	def run(self, request):
+		# the options of the request override those of the service
+		options = dict(self.options, **request.get('options', {}))
+		out_path = request['out_path']
+		if not out_path.endswith('/'):
+			out_path += '/'
+		with self.lock:
+			self.counts['running'] += 1
+			pool = self.pool
+		args = (request['stacks'], out_path, options, request.get('size'))
+		try:
+			try:
+				future = pool.submit(run_job, *args)
+			except BrokenProcessPool:
+				# the pool broke before the job, which can run on a new one
+				self.restart(pool)
+				with self.lock:
+					pool = self.pool
+				future = pool.submit(run_job, *args)
+			out_fns, elapsed, stages = future.result()
+		except BrokenProcessPool as e:
+			self.restart(pool)
+			with self.lock:
+				self.counts['failed'] += 1
+			return {'status': 'error', 'error': 'a worker process died '
+					'during the job, the pool has been restarted (%s)' % e}
+		except Exception as e:
+			with self.lock:
+				self.counts['failed'] += 1
+			return {'status': 'error', 'error': '%s: %s' \
+					% (type(e).__name__, e)}
+		finally:
+			with self.lock:
+				self.counts['running'] -= 1
+		with self.lock:
+			self.counts['done'] += 1
+		return {'status': 'ok', 'outputs': out_fns, 'elapsed': elapsed,
+				'stages': stages}
+
+class RequestHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		service = self.server.service
+		try:
+			request = json.loads(self.rfile.readline())
+			if not isinstance(request, dict):
+				raise TypeError('a JSON object is expected')
+			command = request.get('command', 'run')
+			if command == 'status':
+				reply = dict(service.status(), status='ok')
+			elif command == 'stop':
+				reply = {'status': 'ok'}
+				threading.Thread(target=self.server.shutdown).start()
+			elif command == 'run':
+				reply = service.run(request)
+			else:
+				reply = {'status': 'error',
+						'error': 'unknown command %s' % command}
+		except (ValueError, KeyError, TypeError) as e:
+			reply = {'status': 'error', 'error': 'bad request: %s' % e}
+		self.wfile.write((json.dumps(reply) + '\n').encode())
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	# the replies of the running cases are sent before the service stops
+	daemon_threads = False
+
+def request(socket_path, message):
+	# send one request to the service and wait for its reply
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+		s.connect(socket_path)
+		s.sendall((json.dumps(message) + '\n').encode())
+		with s.makefile('r') as f:
+			return json.loads(f.readline())
+
+def serve(args, console):
+	from utils import app_name, print_header
+	print_header(console)
+	if os.path.exists(args.socket):
+		try:
+			request(args.socket, {'command': 'status'})
+			console.print('[red bold]Error: a worker already listens on %s' \
+					% args.socket)
+			exit(1)
+		except OSError:
+			# left by a service that did not stop cleanly
+			os.remove(args.socket)
+
+	n_jobs = max(1, args.jobs)
+	fft_workers = args.fft_workers
+	if fft_workers == None:
+		fft_workers = max(1, os.cpu_count() // n_jobs)
+	cache_dir = args.cache_dir
+	memory_budget = args.memory_limit * 2**30 / n_jobs \
+			if args.memory_limit != None else None
+	options = {'cache_dir': cache_dir, 'memory_budget': memory_budget,
+			'threads': args.threads, 'registration_workers': 1,
+			'registration': args.registration,
+			'registration_threads': args.threads}
+
+	table = Table(title='Summary of %s/worker.py execution' % app_name,
+			box=box.HORIZONTALS,
+			show_header=True, header_style='bold magenta')
+	table.add_column('Socket', justify='center')
+	table.add_column('# jobs', justify='center')
+	table.add_column('FFT', justify='center')
+	table.add_column('Precision', justify='center')
+	table.add_row(args.socket, str(n_jobs),
+			'%s x %d' % (args.fft_backend, fft_workers), args.precision)
+	console.print(table, justify='center')
+	console.print('\n')
+
+	make_pool = lambda: ProcessPoolExecutor(max_workers=n_jobs,
+			initializer=init_worker,
+			initargs=(args.fft_backend, fft_workers, args.fft_wisdom,
+				args.precision, args.operator_cache_size,
+				args.cache_size * 2**30))
+	with Server(args.socket, RequestHandler) as server:
+		server.service = Service(make_pool, options, n_jobs)
+		console.print('[green]Listening on %s' % args.socket)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			os.remove(args.socket)
+			server.service.shutdown()
+	console.print('[green]Stopped')
+
+def submit(args, console):
+	# relative paths are relative to the folder of the client
+	message = {'stacks': [os.path.abspath(fn) for fn in args.filenames],
+			'out_path': os.path.abspath(args.out_path) + '/',
+			'size': args.size,
+			'options': {'reg': 'tik' if args.tik else 'ggr',
+				'reg_weights': args.reg_weight,
+				'select_method': args.select_weight,
+				'keep_negative_values': args.keep_negative_values,
+				'fast_padding': args.fast_padding}}
+	reply = request(args.socket, message)
+	if reply['status'] != 'ok':
+		console.print('[red bold]Error: %s' % reply['error'])
+		exit(1)
+	for fn in reply['outputs']:
+		console.print('See the image at: [cyan italic]%s' % fn)
+	console.print('Completed in %.2f s (%s)' % (reply['elapsed'],
+			', '.join('%s %.2f s' % s for s in reply['stages'].items())))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--socket', default=default_socket(),
+			help='Unix socket of the service, by default is \
+					$XDG_RUNTIME_DIR/ggr-recon-UID.sock')
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	p = commands.add_parser('serve', help='start the service')
+	p.add_argument('-j', '--jobs', type=int, default=1,
+			help='maximum number of cases reconstructed concurrently, \
+					the others wait in a queue; by default is 1')
+	p.add_argument('--memory-limit', type=float,
+			help='memory (GB) shared by the concurrent cases, \
+					by default each case may use the available memory')
+	p.add_argument('--threads', type=int, default=1,
+			help='threads of the preprocessing of each case, by default is 1')
+	p.add_argument('--registration', choices=['crl', 'sitk'], default='crl',
+			help='registration engine: crlRigidRegistration, or SimpleITK \
+					in process; by default is crl')
+	p.add_argument('--fft-backend', choices=['numpy', 'scipy', 'pyfftw'],
+			help='FFT library, by default is scipy', default='scipy')
+	p.add_argument('--fft-workers', type=int,
+			help='threads of the FFTs of each case, \
+					by default the CPUs are shared by the jobs')
+	p.add_argument('--fft-wisdom',
+			help='pyFFTW wisdom file loaded by the worker processes, \
+					which add the plans measured by each case to it')
+	p.add_argument('--precision', choices=['single', 'double'],
+			default='single',
+			help='floating-point precision of the deconvolution, \
+					by default is single')
+	p.add_argument('--cache-dir',
+			help='folder of the operator cache on disk shared by the \
+					worker processes, by default only the memory is used')
+	p.add_argument('--cache-size', type=float, default=2,
+			help='size (GB) of the operator cache on disk, the least \
+					recently used operators are removed beyond it; \
+					by default is 2')
+	p.add_argument('--operator-cache-size', type=int, default=8,
+			help='number of operators kept in memory by each worker \
+					process, the least recently used are dropped; \
+					by default is 8')
+
+	p = commands.add_parser('submit', help='reconstruct a case')
+	p.add_argument('-f', '--filenames', nargs='+', required=True,
+			help='filenames of the low-res images')
+	p.add_argument('-o', '--out_path', default='./recons/')
+	p.add_argument('-s', '--size', nargs='+', type=int,
+			help='size of the high-res reconstruction, optional')
+	group = p.add_mutually_exclusive_group()
+	group.add_argument('--ggr', action='store_true',
+			help='use GGR regularization, default')
+	group.add_argument('--tik', action='store_true',
+			help='use Tikhonov regularization')
+	p.add_argument('-w', '--reg-weight', nargs='+', type=float,
+			help='weight(s) of the regularization, by default is 0.1',
+			default=[0.1])
+	p.add_argument('--select-weight', choices=['lcurve', 'gcv'],
+			help='select one of the weights automatically, see recon.py')
+	p.add_argument('--keep-negative-values', action='store_true',
+			help='keep negative voxel values in the reconstructed images',
+			default=False)
+	p.add_argument('--fast-padding', action='store_true', default=False,
+			help='zero-pad the images to sizes with small prime factors')
+
+	commands.add_parser('status', help='show the state of the service')
+	commands.add_parser('stop', help='stop the service once the running \
+			cases are done')
+	args = parser.parse_args()
+
+	console = Console()
+	try:
+		if args.command == 'serve':
+			serve(args, console)
+		elif args.command == 'submit':
+			submit(args, console)
+		else:
+			reply = request(args.socket, {'command': args.command})
+			console.print(reply)
+	except OSError as e:
+		console.print('[red bold]Error: no worker on %s (%s)' \
+				% (args.socket, e))
+		exit(1)